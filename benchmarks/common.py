@@ -0,0 +1,51 @@
+"""Shared setup for the benchmark scripts."""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kit_web_ui.settings')
+os.environ.setdefault('DJANGO_SECRET_KEY', 'benchmark')
+
+
+def setup_django():
+    import django
+    from django.conf import settings
+
+    db_settings = settings.DATABASES['default']
+    if db_settings['ENGINE'].endswith('sqlite3'):
+        # Keep the seeded tables on disk rather than in memory
+        tmpdir = tempfile.mkdtemp()
+        db_settings['TEST'] = {'NAME': os.path.join(tmpdir, 'benchmark.sqlite3')}
+
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    """Create a throwaway migrated database, the configured database is untouched."""
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def create_teams(teams):
+    """Create users and MQTT configs for `teams` teams, returning the configs."""
+    from django.contrib.auth.models import User
+
+    from kit_web_ui.models import MqttConfig
+
+    return [
+        MqttConfig.objects.create(
+            name=f"Team {team}", user=User.objects.create_user(f"team{team}"),
+            username=f"team{team}", topic_root=f"team{team}", team_number=team,
+        )
+        for team in range(1, teams + 1)
+    ]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of decoding received messages to the rows run-ingest stores.
+
+Decodes --messages messages for --teams teams, a mix of log, state and camera
+messages using the images of the test logger, with decode_message using the
+json module and orjson, and the previous decode path which converted the
+timestamp to an ISO string. The date of each row is also prepared for the
+database and for the run summaries, as when a batch is written. The rate is
+reported in messages a second on a single core.
+No database is used, with --store-frames the frames are written to a
+temporary directory.
+
+Run from the base of the repository with the django environment loaded:
+    python benchmarks/ingest_decode.py --messages 20000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from common import setup_django
+
+IMAGE_DIR = Path(__file__).resolve().parent.parent / 'test_logger'
+# Every tenth message is a camera image, as published by the test logger
+SUBTOPICS = ['logs'] * 8 + ['state', 'camera/annotated']
+
+
+def legacy_decode(message, router):
+    """Decoding as done before the decode stage, for comparison."""
+    from django.conf import settings
+
+    from kit_web_ui.frames import CAMERA_TAG, FRAME_SUBTOPICS, store_payload
+    from kit_web_ui.models import MqttData
+
+    now = datetime.fromtimestamp(message.received, tz=timezone.utc)
+    try:
+        payload = json.loads(message.payload)
+    except json.JSONDecodeError:
+        return None
+    message_config, subtopic = router.route(message.topic)
+    try:
+        timestamp = datetime.fromtimestamp(payload.get('timestamp'), timezone.utc).isoformat()
+    except Exception:
+        timestamp = now.isoformat()
+    run_uuid = payload.get('run_uuid', '')
+    if subtopic.startswith('camera'):
+        if settings.KIT_UI['STORE_FRAMES'] and subtopic in FRAME_SUBTOPICS:
+            payload = store_payload(payload)
+        else:
+            payload = {'data': CAMERA_TAG}
+    return MqttData(
+        date=timestamp, config=message_config, subtopic=subtopic,
+        payload=payload, run_uuid=run_uuid,
+    )
+
+
+def make_messages(teams, count):
+    from kit_web_ui.ingest import RawMessage
+
+    images = [path.read_text().strip() for path in sorted(IMAGE_DIR.glob('img-*.jpg.txt'))]
+    run_uuids = [uuid.uuid4().hex for _ in range(teams)]
+    messages = []
+    for num in range(count):
+        team = num % teams
+        subtopic = SUBTOPICS[(num // teams) % len(SUBTOPICS)]
+        payload = {'run_uuid': run_uuids[team], 'timestamp': time.time()}
+        if subtopic == 'logs':
+            payload.update({
+                'message': f"[{num:06d}.259] Test Message", 'raw_message': "Test Message",
+                'level': "USERCODE", 'name': "usercode",
+            })
+        elif subtopic == 'state':
+            payload['state'] = 'Running'
+        else:
+            payload['data'] = images[num % len(images)]
+        messages.append(RawMessage(
+            f"team{team + 1}/{subtopic}", json.dumps(payload).encode(), time.time()))
+    return messages
+
+
+def measure(name, decode, messages):
+    from django.db import connection
+
+    from kit_web_ui.models import MqttData
+
+    date_field = MqttData._meta.get_field('date')
+    start = time.perf_counter()
+    for message in messages:
+        row = decode(message)
+        # As done by update_runs and bulk_create for each row
+        date_field.get_db_prep_save(date_field.to_python(row.date), connection)
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{name}: {elapsed / len(messages) * 1e6:.1f} us per message, "
+        f"{len(messages) / elapsed:,.0f} msgs/s per core"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--teams', type=int, default=40, help='Number of teams')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages to decode')
+    parser.add_argument(
+        '--store-frames', action='store_true',
+        help='Store camera frames as files rather than only a tag')
+    args = parser.parse_args()
+
+    os.environ['STORE_FRAMES'] = 'true' if args.store_frames else 'false'
+    os.environ['FRAME_DIR'] = tempfile.mkdtemp()
+    setup_django()
+    from kit_web_ui import ingest
+    from kit_web_ui.models import MqttConfig
+
+    configs = [
+        MqttConfig(pk=team, name=f"Team {team}", topic_root=f"team{team}", team_number=team)
+        for team in range(1, args.teams + 1)
+    ]
+    router = ingest.TopicRouter(configs)
+    messages = make_messages(args.teams, args.messages)
+
+    measure('previous', lambda message: legacy_decode(message, router), messages)
+    backend = ingest.orjson
+    # Decode with the json module even if orjson is installed
+    ingest.orjson = None
+    measure('json', lambda message: ingest.decode_message(message, router), messages)
+    ingest.orjson = backend
+    if backend is None:
+        print("orjson: not installed")
+    else:
+        measure('orjson', lambda message: ingest.decode_message(message, router), messages)
+
+
+if __name__ == '__main__':
+    main()
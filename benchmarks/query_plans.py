@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Compare query plans for the MqttData read paths before and after a migration.
+
+A throwaway test database is created using the configured database backend,
+migrated to --before and seeded with --rows messages spread over --teams teams,
+using the models as they were at that migration.
+Each query shape used by the views is then timed and explained, the database
+is migrated to --after and the queries are timed and explained again.
+
+Run from the base of the repository with the django environment loaded:
+    python benchmarks/query_plans.py --rows 2000000
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from common import setup_django, test_database
+
+# Subtopics and their relative frequency in a run
+SUBTOPICS = [
+    ('logs', 40),
+    ('camera/annotated', 8),
+    ('state', 1),
+    ('connected', 1),
+]
+
+
+def create_teams(teams, migration):
+    """Create users and MQTT configs for `teams` teams with the models at `migration`."""
+    from django.db import connection
+    from django.db.migrations.executor import MigrationExecutor
+
+    # The current models may have fields not yet added at the migration
+    apps = MigrationExecutor(connection).loader.project_state(('kit_web_ui', migration)).apps
+    User = apps.get_model('auth', 'User')
+    MqttConfig = apps.get_model('kit_web_ui', 'MqttConfig')
+
+    return [
+        MqttConfig.objects.create(
+            name=f"Team {team}", user=User.objects.create(username=f"team{team}"),
+            username=f"team{team}", topic_root=f"team{team}", team_number=team,
+        )
+        for team in range(1, teams + 1)
+    ]
+
+
+def seed(rows, teams, migration):
+    from django.db import connection, transaction
+    from django.db.models import Max
+
+    from kit_web_ui.models import MqttData
+
+    configs = [config.pk for config in create_teams(teams, migration)]
+
+    subtopics = [name for name, _ in SUBTOPICS]
+    weights = [weight for _, weight in SUBTOPICS]
+    table = MqttData._meta.db_table
+    insert = (
+        f'INSERT INTO {table} (date, config_id, subtopic, payload, run_uuid) '
+        'VALUES (%s, %s, %s, %s, %s)'
+    )
+
+    start = datetime(2024, 3, 1, 9, tzinfo=timezone.utc)
+    run_length = 2000
+    written = 0
+    while written < rows:
+        with transaction.atomic(), connection.cursor() as cursor:
+            batch = []
+            for config in configs:
+                run_uuid = uuid.uuid4().hex
+                run_start = start + timedelta(seconds=random.randrange(30 * 86400))
+                batch.append((
+                    run_start, config, 'state', '{"state": "Running"}', run_uuid))
+                for num in range(run_length):
+                    subtopic = random.choices(subtopics, weights)[0]
+                    payload = {
+                        'logs': f'{{"message": "[{num:04d}.259] Test Message"}}',
+                        'camera/annotated': '{"data": "camera image"}',
+                        'state': '{"state": "Finished"}',
+                        'connected': '{"state": "connected"}',
+                    }[subtopic]
+                    batch.append((
+                        run_start + timedelta(seconds=num), config, subtopic, payload,
+                        run_uuid,
+                    ))
+            cursor.executemany(insert, batch)
+            written += len(batch)
+        print(f"Seeded {written} rows", end="\r", flush=True)
+    print()
+
+    return MqttData.objects.aggregate(Max('run_uuid'))['run_uuid__max']
+
+
+def query_shapes(run_uuid):
+    """The query shapes used by utils.py and views.py, keyed by the caller name."""
+    from django.db.models import Count, F, Min, OuterRef, Subquery
+
+    from kit_web_ui.models import MqttConfig, MqttData
+
+    user = MqttData.objects.filter(run_uuid=run_uuid).values_list(
+        'config__user__username', flat=True).first()
+
+    newest_state = MqttData.objects.filter(config=OuterRef("id"), subtopic='state')
+    newest_connected = MqttData.objects.filter(config=OuterRef("id"), subtopic='connected')
+
+    return {
+        'get_logs': MqttData.objects.filter(
+            subtopic='logs', run_uuid=run_uuid, config__user__username=user,
+        ).values_list('payload', flat=True),
+        'recall camera': MqttData.objects.filter(
+            subtopic='camera/annotated', run_uuid=run_uuid, config__user__username=user,
+        ).values_list('payload', flat=True).order_by('-date')[:1],
+        'get_image_counts': MqttData.objects.filter(
+            subtopic='camera/annotated',
+        ).values(name=F('config__name')).annotate(images=Count('pk')),
+        'get_robot_state (per team)': MqttConfig.objects.annotate(
+            latest_state=Subquery(newest_state.values("payload__state")[:1]),
+            latest_connected=Subquery(newest_connected.values("payload__state")[:1]),
+        ).values('name', 'latest_state', 'latest_connected'),
+        'get_run_data': MqttData.objects.filter(
+            subtopic='state', payload__state__exact='Running',
+        ).values('run_uuid', team_name=F('config__name')).order_by(
+            'config__team_number').annotate(start=Min('date')),
+    }
+
+
+def explain(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+
+
+def measure(run_uuid, repeats):
+    for name, queryset in query_shapes(run_uuid).items():
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            list(queryset.all())
+            timings.append(time.perf_counter() - start)
+        print(f"{name}: best {min(timings) * 1000:.1f} ms of {repeats}")
+        for line in explain(queryset):
+            print(f"    {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=2_000_000, help='Rows to seed')
+    parser.add_argument('--teams', type=int, default=40, help='Number of teams')
+    parser.add_argument('--repeats', type=int, default=5, help='Timing repeats per query')
+    parser.add_argument('--before', default='0005_mqttdata', help='Migration before')
+    parser.add_argument('--after', default='0006_mqttdata_indexes', help='Migration after')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.core.management import call_command
+
+    with test_database() as connection:
+        call_command('migrate', 'kit_web_ui', args.before, verbosity=0)
+        run_uuid = seed(args.rows, args.teams, args.before)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        print(f"\n=== Before ({args.before}) ===")
+        measure(run_uuid, args.repeats)
+
+        start = time.perf_counter()
+        call_command('migrate', 'kit_web_ui', args.after, verbosity=0)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        print(f"\nMigrated to {args.after} in {time.perf_counter() - start:.1f} s")
+
+        print(f"\n=== After ({args.after}) ===")
+        measure(run_uuid, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
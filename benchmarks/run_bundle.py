@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Measure the time and memory taken to generate the run bundle of one run.
+
+A throwaway test database is created using the configured database backend
+and seeded with a run of --duration seconds, with a log line every second
+and a camera image every 10 seconds, as published by test_logger.
+The bundle is then generated through the run_bundle view, and with the
+previous approach of building the whole archive in memory for comparison.
+The run is seeded again with the images in the frame store, as run-ingest
+now stores them, and its bundle is generated through the view. Each bundle is
+generated once untimed and then --repeat times, reporting the fastest. The
+frame files were just written, so they are read from the page cache.
+
+Run from the base of the repository with the django environment loaded:
+    python benchmarks/run_bundle.py --duration 3600
+"""
+import argparse
+import base64
+import resource
+import tempfile
+import time
+import tracemalloc
+import uuid
+import zipfile
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+
+from common import create_teams, setup_django, test_database
+
+IMAGE_DIR = Path(__file__).resolve().parent.parent / 'test_logger'
+
+
+def seed(duration, config, store_frames=False):
+    from kit_web_ui.frames import store_payload
+    from kit_web_ui.models import MqttData
+
+    images = [
+        (IMAGE_DIR / f'img-{num:02d}.jpg.txt').read_text(encoding='utf-8')
+        for num in range(1, 6)
+    ]
+    run_uuid = uuid.uuid4().hex
+    start = datetime(2024, 3, 1, 9, tzinfo=timezone.utc)
+
+    rows = [MqttData(
+        date=start, config=config, subtopic='state',
+        payload={'state': 'Running', 'run_uuid': run_uuid}, run_uuid=run_uuid,
+    )]
+    for num in range(duration):
+        rows.append(MqttData(
+            date=start + timedelta(seconds=num), config=config, subtopic='logs',
+            payload={'message': f"[{num:04d}.259] Test Message", 'run_uuid': run_uuid},
+            run_uuid=run_uuid,
+        ))
+        if num % 10 == 0:
+            payload = {'data': images[(num // 10) % len(images)], 'run_uuid': run_uuid}
+            rows.append(MqttData(
+                date=start + timedelta(seconds=num), config=config,
+                subtopic='camera/annotated',
+                payload=store_payload(payload) if store_frames else payload,
+                run_uuid=run_uuid,
+            ))
+        if len(rows) >= 500:
+            MqttData.objects.bulk_create(rows)
+            rows = []
+    MqttData.objects.bulk_create(rows)
+
+    return config.user, run_uuid
+
+
+def in_memory_bundle(user, run_uuid):
+    """The bundle as generated before streaming, for comparison."""
+    from kit_web_ui.models import MqttData
+    from kit_web_ui.utils import get_logs
+
+    base_query = MqttData.objects.filter(run_uuid=run_uuid, config__user=user)
+    log_lines = [log['message'] for log in get_logs(user.username, run_uuid)]
+
+    byte_data = BytesIO()
+    with zipfile.ZipFile(byte_data, "w", zipfile.ZIP_DEFLATED, False) as output_file:
+        output_file.writestr('log.txt', '\n'.join(log_lines))
+        for img in base_query.filter(subtopic='camera/annotated'):
+            img_data = base64.b64decode(img.payload['data'].split()[-1])
+            output_file.writestr(f'img-{img.date:%Y-%m-%dT%H-%M-%S}-.jpg', img_data)
+    byte_data.seek(0)
+    return [byte_data.getvalue()]
+
+
+def view_bundle(user, run_uuid):
+    from django.conf import settings
+    from django.test import Client
+
+    settings.ALLOWED_HOSTS = ['*']
+    client = Client()
+    client.force_login(user)
+    response = client.get(f'/run_bundle/{run_uuid}')
+    return response.streaming_content
+
+
+def measure(name, generate, user, run_uuid, repeat):
+    # Generated once untimed, so whichever bundle is measured first doesn't
+    # include the imports and setup of the first request
+    for _ in generate(user, run_uuid):
+        pass
+
+    elapsed = float('inf')
+    tracemalloc.start()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = sum(len(chunk) for chunk in generate(user, run_uuid))
+        elapsed = min(elapsed, time.perf_counter() - start)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{name}: best {elapsed:.2f} s, {size / 2**20:.1f} MiB archive, "
+        f"peak allocated {peak / 2**20:.1f} MiB, process max RSS {max_rss:.0f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--duration', type=int, default=3600, help='Length of the run in seconds')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='Times each bundle is generated')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+
+    with test_database(), tempfile.TemporaryDirectory() as frame_dir:
+        settings.KIT_UI['FRAME_DIR'] = frame_dir
+        config = create_teams(1)[0]
+        user, run_uuid = seed(args.duration, config)
+        _, frames_run_uuid = seed(args.duration, config, store_frames=True)
+
+        # The streamed bundles run first so the max RSS isn't inflated by the
+        # in-memory bundle
+        measure('streamed from frame store', view_bundle, user, frames_run_uuid, args.repeat)
+        measure('streamed', view_bundle, user, run_uuid, args.repeat)
+        measure('in memory', in_memory_bundle, user, run_uuid, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Measure ingest throughput of run-ingest-shards through a local MQTT broker.
+
+A throwaway database is created with --teams teams, run-ingest-shards is
+started with each of the --shards counts, and --messages log messages are
+published to the configured MQTT broker across the teams with QoS 1. The rate
+the messages are written to the database is reported, and the stored rows are
+checked so every message was written exactly once.
+
+The broker has to accept MQTTv5 shared subscriptions for --mode shared, such
+as mosquitto 2 started with `mosquitto -p 1883`. With SQLite the writes of
+the processes are serialised by the database, so use SQLITE_TUNED=true or
+PostgreSQL to measure the scaling of the processes.
+
+Run from the base of the repository with the django environment loaded:
+    python benchmarks/sharded_ingest.py --shards 1 2 4 --messages 50000
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from common import create_teams, setup_django, test_database
+
+SETTINGS_MODULE = """\
+from {settings} import *  # noqa: F401,F403
+
+DATABASES['default']['NAME'] = {name!r}
+"""
+
+
+def publish(args):
+    import paho.mqtt.client as mqtt
+    from django.conf import settings
+
+    client = mqtt.Client(
+        callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+        protocol=mqtt.MQTTProtocolVersion.MQTTv5,
+    )
+    if settings.MQTT_BROKER['USERNAME']:
+        client.username_pw_set(
+            settings.MQTT_BROKER['USERNAME'], settings.MQTT_BROKER['PASSWORD'])
+    client.max_inflight_messages_set(1000)
+    client.connect(settings.MQTT_BROKER['HOST'], settings.MQTT_BROKER['PORT'])
+    client.loop_start()
+
+    run_uuids = [uuid.uuid4().hex for _ in range(args.teams)]
+    infos = []
+    for num in range(args.messages):
+        team = num % args.teams
+        payload = {
+            'run_uuid': run_uuids[team],
+            'timestamp': time.time(),
+            'message': f"[{num:06d}.259] Test Message",
+            'seq': num,
+        }
+        infos.append(client.publish(f"team{team + 1}/logs", json.dumps(payload), qos=1))
+    for info in infos:
+        info.wait_for_publish()
+    client.loop_stop()
+    client.disconnect()
+
+
+def run_shards(args, shards, env):
+    from django.db import connection
+
+    from kit_web_ui.models import MqttData
+
+    MqttData.objects.all().delete()
+    connection.close()
+
+    supervisor = subprocess.Popen(
+        [
+            sys.executable, '-m', 'django', 'run-ingest-shards',
+            '--shards', str(shards), '--mode', args.mode,
+            '--', '--stats-interval', '0', '--batch-size', str(args.batch_size),
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        # Wait for the processes to load the configs and subscribe
+        time.sleep(args.startup)
+
+        start = time.perf_counter()
+        publish(args)
+        written = 0
+        deadline = time.perf_counter() + args.timeout
+        while written < args.messages and time.perf_counter() < deadline:
+            time.sleep(0.1)
+            written = MqttData.objects.count()
+        elapsed = time.perf_counter() - start
+        # Any duplicate written after the last message arrived
+        time.sleep(1)
+    finally:
+        supervisor.send_signal(signal.SIGTERM)
+        supervisor.wait()
+
+    seqs = list(MqttData.objects.values_list('payload__seq', flat=True))
+    connection.close()
+    print(
+        f"{shards} shards ({args.mode}): {written / elapsed:,.0f} msgs/s, "
+        f"{len(set(seqs))}/{args.messages} messages written, "
+        f"{len(seqs) - len(set(seqs))} duplicates"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--shards', type=int, nargs='+', default=[1, 2, 4],
+        help='Numbers of run-ingest processes to measure')
+    parser.add_argument(
+        '--mode', choices=['hash', 'shared'], default='hash',
+        help='How the messages are split between the processes')
+    parser.add_argument('--teams', type=int, default=40, help='Number of teams')
+    parser.add_argument('--messages', type=int, default=50000, help='Messages to publish')
+    parser.add_argument(
+        '--batch-size', type=int, default=100, help='Messages written per transaction')
+    parser.add_argument(
+        '--startup', type=float, default=5, help='Seconds to wait for the processes to start')
+    parser.add_argument(
+        '--timeout', type=float, default=300, help='Seconds to wait for the messages')
+    args = parser.parse_args()
+
+    setup_django()
+    with test_database() as connection:
+        create_teams(args.teams)
+        connection.close()
+
+        # The processes load the settings themselves, so they're pointed at the test database
+        settings_dir = tempfile.mkdtemp()
+        Path(settings_dir, 'benchmark_settings.py').write_text(SETTINGS_MODULE.format(
+            settings=os.environ['DJANGO_SETTINGS_MODULE'],
+            name=connection.settings_dict['NAME'],
+        ))
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': 'benchmark_settings',
+            'PYTHONPATH': os.pathsep.join([settings_dir, *sys.path]),
+            'INGEST_SPOOL_DIR': '',
+            'MQTT_STATUS_TOPIC': '',
+        }
+        for shards in args.shards:
+            run_shards(args, shards, env)
+
+
+if __name__ == '__main__':
+    main()
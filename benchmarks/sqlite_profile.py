@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Measure ingest throughput on SQLite with concurrent status page readers.
+
+A throwaway SQLite database is created and --messages messages for --teams
+teams are written by the run-ingest batch writers, while --readers processes
+each run the robot state query behind status.json --read-rate times a second,
+as the uwsgi processes would. The write rate, the read rate and the number of
+messages and reads that failed because the database was locked are reported
+for the default SQLite settings and for the tuned settings enabled by
+SQLITE_TUNED.
+
+The database is created in the system temporary directory, if it is on tmpfs
+the cost of syncing to disk isn't measured. Set TMPDIR to a directory on disk.
+
+Run from the base of the repository with the django environment loaded:
+    python benchmarks/sqlite_profile.py --messages 20000 --readers 5
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+from common import create_teams, setup_django, test_database
+
+PROFILES = {
+    'default': 'false',
+    'tuned': 'true',
+}
+SUBTOPICS = ['logs', 'logs', 'logs', 'logs', 'logs', 'camera/annotated', 'state']
+
+
+def make_messages(teams, count):
+    from kit_web_ui.ingest import RawMessage
+
+    run_uuids = [uuid.uuid4().hex for _ in range(teams)]
+    start = time.time()
+    messages = []
+    for num in range(count):
+        team = num % teams
+        subtopic = SUBTOPICS[(num // teams) % len(SUBTOPICS)]
+        payload = {'run_uuid': run_uuids[team], 'timestamp': start + num / 100}
+        if subtopic == 'logs':
+            payload['message'] = f"[{num:06d}.259] Test Message"
+        elif subtopic == 'state':
+            payload['state'] = 'Running'
+        else:
+            payload['data'] = 'camera image'
+        messages.append(RawMessage(
+            f"team{team + 1}/{subtopic}", json.dumps(payload).encode(), time.time()))
+    return messages
+
+
+def read_states(stop, results, interval):
+    from django.db import OperationalError, connection
+
+    from kit_web_ui.utils import get_robot_state
+
+    reads = 0
+    errors = 0
+    # Wait between reads, so the readers don't take all the CPU from the writer
+    while not stop.wait(interval):
+        try:
+            get_robot_state()
+            reads += 1
+        except OperationalError:
+            errors += 1
+    connection.close()
+    results.put((reads, errors))
+
+
+def run_profile(args):
+    from datetime import datetime, timezone
+
+    from django.db import connections
+
+    from kit_web_ui.ingest import BatchWriter, IngestQueue, TopicRouter
+    from kit_web_ui.models import MqttData
+
+    # Failed batches are counted from the rows written
+    logging.getLogger('kit_web_ui.ingest').setLevel(logging.CRITICAL)
+
+    with test_database() as connection:
+        router = TopicRouter(create_teams(args.teams))
+        messages = make_messages(args.teams, args.messages)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+
+        def decode(message):
+            config, subtopic = router.route(message.topic)
+            payload = json.loads(message.payload)
+            return MqttData(
+                date=datetime.fromtimestamp(payload['timestamp'], timezone.utc),
+                config=config,
+                subtopic=subtopic,
+                payload=payload,
+                run_uuid=payload['run_uuid'],
+            )
+
+        # Each process needs its own connection
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        stop = context.Event()
+        results = context.Queue()
+        readers = [
+            context.Process(target=read_states, args=(stop, results, 1 / args.read_rate))
+            for _ in range(args.readers)
+        ]
+        for reader in readers:
+            reader.start()
+        time.sleep(0.5)
+
+        ingest_queue = IngestQueue(maxsize=len(messages) + 1)
+        for message in messages:
+            ingest_queue.put(message)
+        ingest_queue.close()
+
+        start = time.perf_counter()
+        writers = [
+            BatchWriter(ingest_queue, decode, batch_size=args.batch_size, max_latency=0.5)
+            for _ in range(args.workers)
+        ]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        reads = errors = 0
+        for reader in readers:
+            reader_reads, reader_errors = results.get()
+            reads += reader_reads
+            errors += reader_errors
+        for reader in readers:
+            reader.join()
+
+        written = MqttData.objects.count()
+        print(
+            f"{args.profile} (journal_mode={journal_mode}): "
+            f"{written / elapsed:,.0f} msgs/s written, "
+            f"{written}/{len(messages)} messages written, "
+            f"{reads / elapsed:,.0f} status reads/s, {errors} reads failed"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--profile', choices=[*PROFILES, 'both'], default='both',
+        help='The SQLite settings to measure')
+    parser.add_argument('--teams', type=int, default=40, help='Number of teams')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages to ingest')
+    parser.add_argument(
+        '--readers', type=int, default=5, help='Processes reading the robot states')
+    parser.add_argument(
+        '--read-rate', type=float, default=50, help='Reads per second by each reader')
+    parser.add_argument('--workers', type=int, default=1, help='Ingest writer threads')
+    parser.add_argument(
+        '--batch-size', type=int, default=100, help='Messages written per transaction')
+    args = parser.parse_args()
+
+    if args.profile == 'both':
+        # The profile is selected when the settings are loaded, so each runs in a new process
+        for profile in PROFILES:
+            subprocess.run(
+                [sys.executable, __file__, *sys.argv[1:], '--profile', profile],
+                check=True,
+            )
+        return
+
+    os.environ['USE_POSTGRES'] = 'false'
+    os.environ['SQLITE_TUNED'] = PROFILES[args.profile]
+    setup_django()
+    run_profile(args)
+
+
+if __name__ == '__main__':
+    main()
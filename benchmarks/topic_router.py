@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of routing message topics to their team's MqttConfig.
+
+Routes --messages topics spread over --teams teams using the TopicRouter
+from run-ingest, and the previous approach of comparing the topic against
+every topic root in turn, reporting the routing rate of each.
+No database is used.
+
+Run from the base of the repository with the django environment loaded:
+    python benchmarks/topic_router.py --teams 500 --rate 10000
+"""
+import argparse
+import random
+import time
+
+from common import setup_django
+
+SUBTOPICS = ['logs', 'logs', 'logs', 'logs', 'camera/annotated', 'state', 'connected']
+
+
+def linear_route(topic_root_mapping, topic):
+    """Routing as done before TopicRouter, for comparison."""
+    for topic_root, config in topic_root_mapping.items():
+        if topic.startswith(topic_root + "/"):
+            return config, topic[len(topic_root) + 1:]
+    return None, topic
+
+
+def measure(name, route, topics, target_rate):
+    start = time.perf_counter()
+    for topic in topics:
+        route(topic)
+    elapsed = time.perf_counter() - start
+
+    rate = len(topics) / elapsed
+    print(
+        f"{name}: {elapsed / len(topics) * 1e6:.2f} us per message, "
+        f"{rate:,.0f} msgs/s, {target_rate / rate:.2%} of a core at {target_rate:,} msgs/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--teams', type=int, default=500, help='Number of teams')
+    parser.add_argument('--messages', type=int, default=10000, help='Messages to route')
+    parser.add_argument(
+        '--rate', type=int, default=10000, help='Message rate to report the CPU cost at')
+    parser.add_argument(
+        '--nested', action='store_true',
+        help='Use two level topic roots with a wildcard, i.e. robots/+/teamN')
+    args = parser.parse_args()
+
+    setup_django()
+    from kit_web_ui.ingest import TopicRouter
+    from kit_web_ui.models import MqttConfig
+
+    if args.nested:
+        roots = [f"robots/+/team{team}" for team in range(1, args.teams + 1)]
+        prefix = "robots/arena/"
+    else:
+        roots = [f"team{team}" for team in range(1, args.teams + 1)]
+        prefix = ""
+
+    configs = [
+        MqttConfig(name=f"Team {num}", topic_root=root, team_number=num)
+        for num, root in enumerate(roots, start=1)
+    ]
+    router = TopicRouter(configs)
+    mapping = {config.topic_root: config for config in configs}
+
+    topics = [
+        f"{prefix}team{random.randint(1, args.teams)}/{random.choice(SUBTOPICS)}"
+        for _ in range(args.messages)
+    ]
+    # Sanity check both approaches agree
+    if not args.nested:
+        for topic in topics[:100]:
+            assert router.route(topic) == linear_route(mapping, topic)
+
+    measure('TopicRouter', router.route, topics, args.rate)
+    if not args.nested:
+        measure('linear scan', lambda topic: linear_route(mapping, topic), topics, args.rate)
+
+
+if __name__ == '__main__':
+    main()
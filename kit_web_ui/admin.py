@@ -2,7 +2,9 @@ from django.conf import settings
 from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
 
-from .models import AuditEvent, Broker, BrokerListener, MqttConfig, MqttData
+from .models import (
+    AuditEvent, Broker, BrokerListener, MqttConfig, MqttData, RobotState, Run,
+)
 from .utils import generate_password, generate_wordlist
 
 
@@ -32,6 +34,19 @@ class MqttDataAdmin(admin.ModelAdmin):
     search_fields = ("run_uuid", "config__name", "subtopic")
 
 
+class RobotStateAdmin(admin.ModelAdmin):
+    list_display = ("config", "state", "connected", "last_seen", "run_uuid")
+    list_filter = ("state", "connected")
+    search_fields = ("config__name", "run_uuid")
+
+
+class RunAdmin(admin.ModelAdmin):
+    list_display = (
+        "config", "run_uuid", "start", "end", "final_state", "log_count", "image_count")
+    list_filter = ("start", "config", "final_state")
+    search_fields = ("run_uuid", "config__name")
+
+
 class AuditEventAdmin(admin.ModelAdmin):
     list_display = ("date", "user", "action", "code", "extra_data", "target_other")
     list_filter = ("date", "user", "action", "code")
@@ -75,4 +90,6 @@ admin.site.register(Broker, BrokerAdmin)
 admin.site.register(BrokerListener, BrokerListenerAdmin)
 admin.site.register(MqttConfig, MqttConfigAdmin)
 admin.site.register(MqttData, MqttDataAdmin)
+admin.site.register(RobotState, RobotStateAdmin)
+admin.site.register(Run, RunAdmin)
 admin.site.register(AuditEvent, AuditEventAdmin)
@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class KitWebUiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'kit_web_ui'
+
+    def ready(self) -> None:
+        from django.core.signals import request_finished
+        from django.db.backends.signals import connection_created
+
+        from kit_web_ui.db import (
+            configure_sqlite, count_connection, count_request,
+        )
+
+        connection_created.connect(configure_sqlite)
+        connection_created.connect(count_connection)
+        request_finished.connect(count_request)
@@ -0,0 +1,122 @@
+"""
+Per-run archives of MqttData rows that have been removed from the database.
+
+Each archived run is written to a gzipped JSON lines file under
+KIT_UI['ARCHIVE_DIR'], at `<config id>/<run uuid>.jsonl.gz`, with one row per
+line in date order. Rows keep their original id and date, so log cursors
+issued before a run was archived remain valid. The Run is marked as archived
+once its rows have been written and deleted from the database.
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import re
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Iterable, Iterator, NamedTuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from kit_web_ui.models import MqttData, Run
+
+# Run UUIDs come from the robots, only ones that are safe as filenames are archived
+SAFE_RUN_UUID = re.compile(r'[A-Za-z0-9_-]+')
+
+
+class ArchivedRow(NamedTuple):
+    id: int
+    date: datetime
+    subtopic: str
+    payload: Any
+
+
+def archive_path(config_id: int, run_uuid: str) -> Path:
+    """Return the archive file of a run, raises ValueError for unsafe run UUIDs."""
+    if not SAFE_RUN_UUID.fullmatch(run_uuid):
+        raise ValueError(f"Run UUID can't be used as a filename: {run_uuid!r}")
+    return Path(settings.KIT_UI['ARCHIVE_DIR']) / str(config_id) / f'{run_uuid}.jsonl.gz'
+
+
+def write_archive(path: Path, rows: Iterable[ArchivedRow]) -> int:
+    """
+    Write rows to an archive file, returning the number of rows written.
+
+    The file is written under a temporary name and renamed once complete,
+    so an archive file is never partially written.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    count = 0
+    with open(tmp_path, 'wb') as raw_file:
+        with gzip.GzipFile(fileobj=raw_file, mode='wb') as archive:
+            for row in rows:
+                line = json.dumps({
+                    'id': row.id,
+                    'date': row.date.isoformat(),
+                    'subtopic': row.subtopic,
+                    'payload': row.payload,
+                })
+                archive.write(line.encode('utf-8') + b'\n')
+                count += 1
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+class RunArchive:
+    """Read the rows of an archived run."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def rows(
+        self,
+        subtopic: str | None = None,
+        end_filter: str | None = None,
+    ) -> Iterator[ArchivedRow]:
+        """
+        Yield the rows of the run in date order.
+
+        Rows can be limited to one subtopic and to rows dated no later than
+        `end_filter`, matching the `date__lte` filter used for stored rows.
+        """
+        end = _parse_end_filter(end_filter) if end_filter else None
+
+        with gzip.open(self.path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                data = json.loads(line)
+                if subtopic is not None and data['subtopic'] != subtopic:
+                    continue
+                date = datetime.fromisoformat(data['date'])
+                if end is not None and date > end:
+                    continue
+                yield ArchivedRow(data['id'], date, data['subtopic'], data['payload'])
+
+
+def get_run_archive(user: str, run_uuid: str) -> RunArchive | None:
+    """Return the archive of a user's run if the run has been archived."""
+    config_id = (
+        Run.objects
+        .filter(config__user__username=user, run_uuid=run_uuid, archived=True)
+        .values_list('config_id', flat=True)
+        .first()
+    )
+    if config_id is None:
+        return None
+
+    path = archive_path(config_id, run_uuid)
+    if not path.exists():
+        return None
+    return RunArchive(path)
+
+
+def _parse_end_filter(end_filter: str) -> datetime:
+    # Parsed as the DateTimeField would for the date__lte filter
+    end = MqttData._meta.get_field('date').to_python(end_filter)
+    if timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    return end  # type: ignore[no-any-return]
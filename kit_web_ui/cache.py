@@ -0,0 +1,99 @@
+"""
+Caching of the data computed for the dashboard and summary views.
+
+Values are held in the default Django cache for a short time. Each value
+belongs to a group, and run-ingest invalidates a group once it has written
+messages that change the values in it. Invalidating a group increments the
+group's generation, which is part of the key of every value in the group, so
+the next read of each value misses and the old values are left to expire.
+
+Invalidation from run-ingest only reaches the web server processes when they
+share the cache (the file or redis backends). With the local-memory cache,
+values are only refreshed when they time out.
+
+Cache hits and misses are counted in the cache, see the cache-stats command.
+"""
+from __future__ import annotations
+
+from typing import Callable, Iterable, TypeVar, cast
+
+from django.core.cache import cache
+
+from kit_web_ui.models import MqttData
+
+T = TypeVar('T')
+
+# Groups of cached values and the time in seconds values in them are cached for
+ROBOT_STATE = 'robot-state'
+RUNS = 'runs'
+TEAMS = 'teams'
+TIMEOUTS = {
+    ROBOT_STATE: 5,
+    RUNS: 60,
+    # Includes when each robot was last seen so isn't invalidated by every write
+    TEAMS: 10,
+}
+
+STATS = ('hits', 'misses')
+
+_MISSING = object()
+
+
+def _generation(group: str) -> int:
+    return cast(int, cache.get_or_set(f'generation:{group}', 0, timeout=None))
+
+
+def count(stat: str) -> None:
+    """Increment a counter held in the cache."""
+    key = f'stats:{stat}'
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter didn't exist yet
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def cached(group: str, name: str, compute: Callable[[], T]) -> T:
+    """Return the cached value `name` in `group`, computing and caching it on a miss."""
+    key = f'{group}:{_generation(group)}:{name}'
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        count('hits')
+        return cast(T, value)
+
+    count('misses')
+    value = compute()
+    cache.set(key, value, timeout=TIMEOUTS[group])
+    return value
+
+
+def invalidate(*groups: str) -> None:
+    """Make the cached values in the given groups be recomputed on their next read."""
+    for group in groups:
+        key = f'generation:{group}'
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+def invalidate_rows(rows: Iterable[MqttData]) -> None:
+    """Invalidate the groups with values changed by writing `rows`."""
+    groups = set()
+    for row in rows:
+        if row.subtopic in ('state', 'connected'):
+            groups.add(ROBOT_STATE)
+        if row.subtopic == 'state' or row.subtopic.startswith('camera'):
+            # Runs start on a state message, the run summary counts images
+            groups.add(RUNS)
+    invalidate(*groups)
+
+
+def get_stats(stats: Iterable[str] = STATS) -> dict[str, int]:
+    values = cache.get_many([f'stats:{stat}' for stat in stats])
+    return {stat: values.get(f'stats:{stat}', 0) for stat in stats}
+
+
+def reset_stats(stats: Iterable[str] = STATS) -> None:
+    cache.delete_many([f'stats:{stat}' for stat in stats])
@@ -0,0 +1,36 @@
+"""
+Setup applied to each new database connection, and connection churn counters.
+
+The number of connections opened and requests served are counted in the
+cache, see kit_web_ui/cache.py and the connection-stats command. With
+persistent connections (CONN_MAX_AGE) there should be far fewer connections
+than requests.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from django.conf import settings
+from django.db.backends.base.base import BaseDatabaseWrapper
+
+from kit_web_ui.cache import count
+
+STATS = ('connections', 'requests')
+
+
+def configure_sqlite(sender: Any, connection: BaseDatabaseWrapper, **kwargs: Any) -> None:
+    """Apply settings.SQLITE_PRAGMAS to a new SQLite connection."""
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def count_connection(sender: Any, connection: BaseDatabaseWrapper, **kwargs: Any) -> None:
+    count('connections')
+
+
+def count_request(sender: Any, **kwargs: Any) -> None:
+    count('requests')
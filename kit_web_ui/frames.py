@@ -0,0 +1,195 @@
+"""
+Content-addressed storage of camera frames.
+
+Camera messages carry a JPEG as a base64 data URL. For the subtopics in
+FRAME_SUBTOPICS, the annotated images shown on the dashboard and put in run
+bundles, run-ingest decodes it once and writes the raw bytes to a file under
+KIT_UI['FRAME_DIR'] named by the SHA-256 of the bytes, at
+`<first 2 hex digits>/<sha256>`, so identical frames are stored once. The
+stored payload only holds a reference:
+`{"frame": <sha256>, "content_type": <type>, "size": <bytes>}`. Other camera
+subtopics, such as camera/raw, are only stored as a `camera image` tag.
+
+Frames are served directly from their files, see the frame view, and read
+into run bundles without decoding. Payloads stored before frames were kept
+in files hold the data URL, or only a `camera image` tag, and are still
+handled by `payload_image`.
+
+Files no longer referenced by any row or run archive are removed by
+`collect_frames`, which apply-retention runs after applying its rules.
+"""
+from __future__ import annotations
+
+import binascii
+import hashlib
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Any, Iterator
+
+from django.conf import settings
+
+from kit_web_ui.archive import RunArchive, archive_path
+from kit_web_ui.models import MqttData, Run
+
+logger = logging.getLogger(__name__)
+
+_DIGEST = re.compile(r'[0-9a-f]{64}')
+_DATA_URL = re.compile(r'data:(?P<content_type>[\w.+-]+/[\w.+-]+)?(;base64)?,')
+# Payload stored for camera images before frames were kept in files
+CAMERA_TAG = 'camera image'
+# Camera subtopics whose images are kept in the frame store
+FRAME_SUBTOPICS = ('camera/annotated',)
+# Files younger than this aren't collected, their row may not be committed yet
+COLLECT_MIN_AGE = 3600
+
+
+def frame_dir() -> Path:
+    return Path(settings.KIT_UI['FRAME_DIR'])
+
+
+def frame_path(digest: str) -> Path:
+    """Return the file of a frame, raises ValueError if `digest` isn't a SHA-256."""
+    if not _DIGEST.fullmatch(digest):
+        raise ValueError(f"Invalid frame digest: {digest!r}")
+    return frame_dir() / digest[:2] / digest
+
+
+def decode_data_url(data: str) -> tuple[bytes, str]:
+    """
+    Decode an image data URL, returning the image and its content type.
+
+    The `data:image/jpeg;base64,` prefix is optional. Raises ValueError if
+    the data isn't valid base64.
+    """
+    content_type = 'image/jpeg'
+    match = _DATA_URL.match(data)
+    if match is not None:
+        content_type = match.group('content_type') or content_type
+        data = data[match.end():]
+    try:
+        return binascii.a2b_base64(data.strip()), content_type
+    except binascii.Error as e:
+        raise ValueError(f"Invalid image data: {e}")
+
+
+def store_frame(image: bytes, content_type: str = 'image/jpeg') -> dict[str, Any]:
+    """Write an image to the frame store, returning the payload referencing it."""
+    digest = hashlib.sha256(image).hexdigest()
+    path = frame_path(digest)
+    if path.exists():
+        # Mark the frame as in use so it isn't collected before its row is written
+        os.utime(path)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written under a unique temporary name and renamed, so a frame file is
+        # never partially written even if two writers store the same frame
+        tmp_path = path.with_name(f'{digest}.{os.getpid()}.{time.monotonic_ns()}.tmp')
+        with open(tmp_path, 'wb') as frame_file:
+            frame_file.write(image)
+        os.replace(tmp_path, path)
+    return {'frame': digest, 'content_type': content_type, 'size': len(image)}
+
+
+def store_payload(payload: dict[str, Any]) -> dict[str, Any]:
+    """
+    Replace the image data URL of a camera payload with a stored frame reference.
+
+    Payloads without image data, or whose frame can't be written, are replaced
+    with the camera image tag. Other fields of the payload, such as the run
+    UUID, are kept.
+    """
+    data = payload.get('data')
+    if not isinstance(data, str) or not data or data == CAMERA_TAG:
+        return {'data': CAMERA_TAG}
+
+    try:
+        image, content_type = decode_data_url(data)
+    except ValueError as e:
+        logger.warning(f"Not storing camera frame: {e}")
+        return {'data': CAMERA_TAG}
+
+    try:
+        frame = store_frame(image, content_type)
+    except OSError as e:
+        # Such as FRAME_DIR not being writable, the message is still stored
+        logger.warning(f"Failed to store camera frame, storing only a tag: {e}")
+        return {'data': CAMERA_TAG}
+
+    stored = {key: value for key, value in payload.items() if key != 'data'}
+    stored.update(frame)
+    return stored
+
+
+def payload_image(payload: dict[str, Any]) -> bytes | None:
+    """Return the image of a camera payload, or None if the image wasn't kept."""
+    if payload.get('frame'):
+        try:
+            return frame_path(payload['frame']).read_bytes()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Missing camera frame: {e}")
+            return None
+
+    data = payload.get('data')
+    if not data or data == CAMERA_TAG:
+        # Only a tag was stored for this image
+        return None
+    try:
+        return decode_data_url(data)[0]
+    except ValueError:
+        return None
+
+
+def _referenced_frames() -> set[str]:
+    referenced = set(
+        MqttData.objects
+        .filter(subtopic__startswith='camera', payload__has_key='frame')
+        .order_by()
+        .values_list('payload__frame', flat=True)
+        .distinct()
+    )
+    for config_id, run_uuid in Run.objects.filter(archived=True).values_list(
+        'config_id', 'run_uuid',
+    ):
+        try:
+            path = archive_path(config_id, run_uuid)
+        except ValueError:
+            continue
+        if not path.exists():
+            continue
+        for row in RunArchive(path).rows():
+            if row.subtopic.startswith('camera') and row.payload.get('frame'):
+                referenced.add(row.payload['frame'])
+    return referenced
+
+
+def _frame_files() -> Iterator[Path]:
+    if not frame_dir().is_dir():
+        return
+    for directory in frame_dir().iterdir():
+        if directory.is_dir():
+            yield from directory.iterdir()
+
+
+def collect_frames(dry_run: bool = False) -> int:
+    """
+    Delete frame files no longer referenced by stored or archived rows.
+
+    Returns the number of files deleted, or that would be deleted with `dry_run`.
+    """
+    # Listed before finding the referenced frames, so any frame stored in
+    # between is either too new to collect or already referenced
+    min_mtime = time.time() - COLLECT_MIN_AGE
+    candidates = [path for path in _frame_files() if path.stat().st_mtime < min_mtime]
+    referenced = _referenced_frames()
+
+    deleted = 0
+    for path in candidates:
+        if path.name in referenced:
+            continue
+        if not dry_run:
+            path.unlink(missing_ok=True)
+        deleted += 1
+    return deleted
@@ -0,0 +1,966 @@
+"""
+Support code for the run-ingest management command.
+
+These helpers are kept out of the command module so they can be imported
+(management command modules have hyphenated names) and run off the paho
+network thread.
+
+The paho network thread only wraps each message in a RawMessage and puts it
+on an IngestQueue. One or more BatchWriter threads take messages from the
+queue, decode them and write them to the database in batches.
+Changes to the robot states are then published by a StatusPublisher.
+
+With a write-ahead spool, each message is appended to the spool before it is
+queued and acknowledged once written, see spool.py.
+
+Payloads are decoded with orjson when it is installed (the orjson extra),
+otherwise with the json module.
+"""
+from __future__ import annotations
+
+import base64
+import json
+import logging
+import queue
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterable, NamedTuple
+
+from django.conf import settings
+from django.db import (
+    IntegrityError, InterfaceError, OperationalError,
+    close_old_connections, connection, transaction,
+)
+from django.db.models import Case, F, Q, Value, When
+
+from kit_web_ui.frames import CAMERA_TAG, FRAME_SUBTOPICS, store_payload
+from kit_web_ui.models import MqttConfig, MqttData, RobotState, Run
+from kit_web_ui.utils import iter_robot_states
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+if TYPE_CHECKING:
+    import paho.mqtt.client as mqtt
+
+    from kit_web_ui.metrics import IngestMetrics
+    from kit_web_ui.spool import Spool
+
+logger = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ('block', 'drop-oldest', 'spill')
+SHARD_MODES = ('hash', 'shared')
+JSON_BACKEND = 'json' if orjson is None else 'orjson'
+
+# The start of the value of a "data" field, following the key
+_DATA_VALUE = re.compile(rb'\s*:\s*"')
+
+
+class RawMessage(NamedTuple):
+    """An undecoded MQTT message as received from the broker."""
+
+    topic: str
+    payload: bytes
+    received: float
+    # The segment, record number and offset of the message in the write-ahead spool
+    spool_position: tuple[int, int, int] | None = None
+
+
+class _TopicNode:
+    __slots__ = ('children', 'config')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TopicNode] = {}
+        self.config: MqttConfig | None = None
+
+
+class TopicRouter:
+    """
+    Map message topics to the MqttConfig of the topic root they are published under.
+
+    Topic roots are stored in a trie keyed on topic levels, so routing a message
+    costs a dict lookup per topic level rather than a comparison per team.
+    While every root is a single level without wildcards, routing is a single
+    dict lookup on the first level of the topic.
+
+    A `+` level in a topic root matches any single level. When several roots
+    match, exact levels are preferred over `+` at each level, then longer
+    roots over shorter ones. If two configs have the same root, the first one
+    added is used.
+
+    Messages on subtopics matching the `ignored_subtopics` filters of their
+    config, or the `ignored_subtopics` given for all configs, aren't stored.
+
+    A router isn't modified once it is in use, a changed set of configs is
+    loaded into a new router which replaces the old one.
+    """
+
+    def __init__(
+        self,
+        configs: Iterable[MqttConfig] = (),
+        ignored_subtopics: Iterable[str] = (),
+    ) -> None:
+        # The id of the config used for each topic root
+        self.roots: dict[str, int] = {}
+        # The subtopic filters not stored for each config id, if any
+        self.ignored: dict[int, tuple[str, ...]] = {}
+        self._ignored_subtopics = tuple(ignored_subtopics)
+        self._trie = _TopicNode()
+        self._first_level: dict[str, MqttConfig] = {}
+        self._single_level = True
+        for config in configs:
+            self.add(config)
+
+    def add(self, config: MqttConfig) -> None:
+        """Add a config, raises ValueError if its topic root can't be routed."""
+        levels = config.topic_root.split('/')
+        if not config.topic_root or '#' in levels:
+            raise ValueError(f"Invalid topic root for {config}: {config.topic_root!r}")
+
+        node = self._trie
+        for level in levels:
+            node = node.children.setdefault(level, _TopicNode())
+        if node.config is None:
+            node.config = config
+            self.roots[config.topic_root] = config.pk
+            ignored = self._ignored_subtopics + tuple(
+                parse_topic_filters(config.ignored_subtopics))
+            if ignored:
+                self.ignored[config.pk] = ignored
+
+        if len(levels) == 1 and levels[0] != '+':
+            self._first_level.setdefault(levels[0], config)
+        else:
+            self._single_level = False
+
+    def route(self, topic: str) -> tuple[MqttConfig | None, str]:
+        """Return the config the topic belongs to and the topic below its root."""
+        if self._single_level:
+            root, sep, subtopic = topic.partition('/')
+            config = self._first_level.get(root) if sep else None
+            if config is None:
+                return None, topic
+            return config, subtopic
+
+        levels = topic.split('/')
+        match = self._match(self._trie, levels, 0)
+        if match is None:
+            return None, topic
+        config, depth = match
+        return config, '/'.join(levels[depth:])
+
+    def ignores(self, config: MqttConfig, subtopic: str) -> bool:
+        """Return whether messages on a subtopic of a config aren't stored."""
+        filters = self.ignored.get(config.pk)
+        if not filters:
+            return False
+        return any(topic_matches(topic_filter, subtopic) for topic_filter in filters)
+
+    def subscriptions(self) -> list[str]:
+        """Return the MQTT topic filters receiving the messages of every topic root."""
+        return [f'{root}/#' for root in sorted(self.roots)]
+
+    def _match(
+        self,
+        node: _TopicNode,
+        levels: list[str],
+        depth: int,
+    ) -> tuple[MqttConfig, int] | None:
+        # A root must be followed by at least one more level
+        if depth >= len(levels):
+            return None
+
+        for key in (levels[depth], '+'):
+            child = node.children.get(key)
+            if child is not None:
+                match = self._match(child, levels, depth + 1)
+                if match is not None:
+                    return match
+
+        if node.config is not None:
+            return node.config, depth
+        return None
+
+
+def parse_topic_filters(value: str) -> list[str]:
+    """
+    Parse comma separated MQTT topic filters, such as `camera/raw, debug/#`.
+
+    Raises ValueError if a filter has a wildcard that isn't a whole level or
+    a `#` that isn't the last level.
+    """
+    filters = [topic_filter.strip() for topic_filter in value.split(',')]
+    filters = [topic_filter for topic_filter in filters if topic_filter]
+    for topic_filter in filters:
+        levels = topic_filter.split('/')
+        for num, level in enumerate(levels):
+            if level in ('+', '#'):
+                if level == '#' and num != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level of {topic_filter!r}")
+            elif '+' in level or '#' in level:
+                raise ValueError(f"Wildcards must be a whole level of {topic_filter!r}")
+    return filters
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Return whether an MQTT topic filter, with `+` and `#` wildcards, matches a topic."""
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for num, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if num >= len(levels) or (level != '+' and level != levels[num]):
+            return False
+    return len(levels) == len(filter_levels)
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """Parse a shard given as `<index>/<count>`, raises ValueError if it is invalid."""
+    index, sep, count = value.partition('/')
+    try:
+        shard = int(index), int(count)
+    except ValueError:
+        shard = (-1, 0)
+    if not sep or not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Invalid shard {value!r}, expected <index>/<count>")
+    return shard
+
+
+def shard_of(topic: str, count: int) -> int:
+    """
+    Return the shard of `count` shards that handles a topic.
+
+    Topics are sharded by a hash of their first level, so all of a team's
+    messages are handled by the same shard in the order they were received.
+    """
+    return zlib.crc32(topic.partition('/')[0].encode('utf-8')) % count
+
+
+def shared_subscription(group: str, topic_filter: str) -> str:
+    """Return an MQTTv5 shared subscription, which the broker splits between the group."""
+    return f'$share/{group}/{topic_filter}'
+
+
+def load_json(data: bytes) -> Any:
+    """
+    Decode JSON, with orjson if it is installed, raises ValueError if it isn't valid.
+
+    orjson rejects some JSON the json module accepts, such as NaN, so data it
+    rejects is decoded again with the json module.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def strip_data(payload: bytes) -> bytes | None:
+    """
+    Empty the string value of the "data" field of a JSON payload without decoding it.
+
+    Used for camera payloads whose image isn't stored, so the image needn't be
+    decoded to read the other fields. Returns None if the value can't be found
+    without decoding, such as when it contains escaped quotes.
+    """
+    key = payload.find(b'"data"')
+    if key < 0:
+        return None
+    match = _DATA_VALUE.match(payload, key + len(b'"data"'))
+    if match is None:
+        return None
+    # Base64 has no quotes or escapes, so the value ends at the next quote
+    end = payload.find(b'"', match.end())
+    if end < 0 or payload[end - 1:end] == b'\\':
+        return None
+    return payload[:match.end()] + payload[end:]
+
+
+def decode_message(
+    message: RawMessage,
+    router: TopicRouter,
+    metrics: IngestMetrics | None = None,
+) -> MqttData | None:
+    """
+    Decode a received message to the row to store, or None if it isn't a JSON object.
+
+    The lag from the timestamp in the payload to receiving the message is
+    recorded in `metrics`, if given.
+    """
+    # Extract the topic root from the message topic
+    message_config, subtopic = router.route(message.topic)
+    camera = subtopic.startswith('camera')
+    store_frame = settings.KIT_UI['STORE_FRAMES'] and subtopic in FRAME_SUBTOPICS
+
+    data = message.payload
+    if camera and not store_frame:
+        # Only a tag is stored for the image, so it isn't decoded
+        data = strip_data(data) or data
+
+    try:
+        payload = load_json(data)
+    except ValueError:
+        logger.warning(
+            f"Failed to decode message on topic {message.topic}: {message.payload!r}")
+        return None
+    if not isinstance(payload, dict):
+        logger.warning(f"Message on topic {message.topic} isn't a JSON object")
+        return None
+
+    # Attempt to extract timestamp from the message payload
+    try:
+        date = datetime.fromtimestamp(payload['timestamp'], timezone.utc)
+    except (KeyError, TypeError, ValueError, OverflowError, OSError):
+        date = datetime.fromtimestamp(message.received, timezone.utc)
+    else:
+        if metrics is not None:
+            metrics.observe_lag(message.received - payload['timestamp'])
+
+    run_uuid = payload.get('run_uuid', '')
+
+    if camera:
+        if store_frame:
+            # Save the image to a file, referenced from the payload
+            payload = store_payload(payload)
+        else:
+            # Save only a tag for camera images
+            payload = {'data': CAMERA_TAG}
+
+    return MqttData(
+        date=date,
+        config=message_config,
+        subtopic=subtopic,
+        payload=payload,
+        run_uuid=run_uuid,
+    )
+
+
+class SpillFile:
+    """
+    Append-only overflow file for messages that don't fit in memory.
+
+    Messages are stored one JSON object per line. The file is truncated
+    once every message in it has been read back. Messages left in the file
+    by a previous run are read back first.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self._file = open(self.path, 'a+b')
+        self._read_offset = 0
+
+        self._file.seek(0)
+        self.pending = sum(1 for _ in self._file)
+
+    def append(self, message: RawMessage) -> None:
+        line = json.dumps({
+            'topic': message.topic,
+            'payload': base64.b64encode(message.payload).decode('ascii'),
+            'received': message.received,
+        })
+        self._file.write(line.encode('utf-8') + b'\n')
+        self._file.flush()
+        self.pending += 1
+
+    def read(self, count: int) -> list[RawMessage]:
+        """Read back up to `count` of the oldest messages in the file."""
+        messages = []
+        self._file.seek(self._read_offset)
+        for _ in range(count):
+            line = self._file.readline()
+            if not line:
+                break
+            data = json.loads(line)
+            messages.append(RawMessage(
+                data['topic'],
+                base64.b64decode(data['payload']),
+                data['received'],
+            ))
+        self._read_offset = self._file.tell()
+        self.pending -= len(messages)
+
+        if self.pending <= 0:
+            self._file.truncate(0)
+            self._read_offset = 0
+            self.pending = 0
+
+        return messages
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class IngestQueue:
+    """
+    Bounded queue between the MQTT receive thread and the database writers.
+
+    When the queue is full, the backpressure policy decides what happens to
+    a new message:
+    - block: the receive thread waits until a writer takes a message,
+      this also stalls MQTT keepalives and acknowledgements
+    - drop-oldest: the oldest queued message is discarded
+    - spill: the message is appended to a spill file and read back once
+      the writers have caught up, new messages are also appended to the
+      spill file until it is empty so messages are taken in order
+
+    With a write-ahead spool, messages that are already in the spool are
+    instead left there, to be put back on the queue by a SpoolReplayer.
+    Messages taken from the queue are acknowledged in the spool with `done`
+    once they have been written to the database.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10000,
+        policy: str = 'block',
+        spill_file: str | Path | None = None,
+        spool: Spool | None = None,
+    ) -> None:
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        if policy == 'spill' and spill_file is None:
+            raise ValueError("The spill backpressure policy requires a spill file")
+
+        self.maxsize = max(maxsize, 1)
+        self.policy = policy
+        self._items: deque[RawMessage] = deque()
+        self._spill = SpillFile(spill_file) if policy == 'spill' and spill_file else None
+        self.spool = spool
+        self._closed = False
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        self.received = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.deferred = 0
+        self.max_depth = 0
+        self.blocked_time = 0.0
+
+    @property
+    def depth(self) -> int:
+        """The number of messages waiting, including any in the spill file."""
+        if self._spill is not None:
+            return len(self._items) + self._spill.pending
+        return len(self._items)
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            return {
+                'depth': self.depth,
+                'max_depth': self.max_depth,
+                'received': self.received,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'deferred': self.deferred,
+                'blocked_time': round(self.blocked_time, 3),
+            }
+
+    def put(self, message: RawMessage) -> None:
+        with self._lock:
+            self.received += 1
+
+            if self._spill is not None and self._spill.pending:
+                # Queued after the spilled messages, so messages stay in order
+                self._spill.append(message)
+                self.spilled += 1
+                self.max_depth = max(self.max_depth, self.depth)
+                self._not_empty.notify()
+                return
+
+            if len(self._items) >= self.maxsize:
+                if self.spool is not None and message.spool_position is not None:
+                    # Replayed from the spool once the writers have caught up
+                    self.spool.release([message])
+                    self.deferred += 1
+                    return
+                elif self.policy == 'drop-oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                elif self._spill is not None:
+                    self._spill.append(message)
+                    self.spilled += 1
+                    self.max_depth = max(self.max_depth, self.depth)
+                    self._not_empty.notify()
+                    return
+                else:
+                    start = time.monotonic()
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+                    self.blocked_time += time.monotonic() - start
+
+            self._items.append(message)
+            self.max_depth = max(self.max_depth, self.depth)
+            self._not_empty.notify()
+
+    def get(self, timeout: float | None = None) -> RawMessage | None:
+        """
+        Remove and return the oldest message.
+
+        Returns None once the queue is closed and empty.
+        Raises queue.Empty if no message arrives within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._lock:
+            while True:
+                if (
+                    self._spill is not None
+                    and self._spill.pending
+                    and len(self._items) < self.maxsize // 2
+                ):
+                    self._items.extend(self._spill.read(self.maxsize // 2 or 1))
+
+                if self._items:
+                    message = self._items.popleft()
+                    self._not_full.notify()
+                    return message
+
+                if self._closed:
+                    return None
+
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def free(self) -> int:
+        """The number of messages that can be queued before the queue is full."""
+        with self._lock:
+            return self.maxsize - len(self._items)
+
+    def done(self, messages: list[RawMessage]) -> None:
+        """Mark messages taken from the queue as written or discarded."""
+        if self.spool is not None:
+            self.spool.ack(messages)
+
+    def reject(self, messages: list[RawMessage]) -> None:
+        """Mark messages taken from the queue that couldn't be written."""
+        if self.spool is not None:
+            self.spool.reject(messages)
+
+    def close(self) -> None:
+        """Stop accepting new messages, writers exit once the queue is drained."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def release(self) -> None:
+        """Close the spill file, once all writers have exited."""
+        if self._spill is not None:
+            self._spill.close()
+
+
+class BatchWriter(threading.Thread):
+    """
+    Decode queued messages and write them to the database in batches.
+
+    Decoded rows are written with a single bulk_create inside one transaction
+    once `batch_size` rows are waiting or the oldest waiting row has been
+    waiting for `max_latency` seconds, whichever happens first.
+    Any remaining rows are written once the source queue is closed and drained.
+    After a batch is committed it is passed to `on_flush`, if given.
+
+    The database connection is reused between batches, subject to CONN_MAX_AGE
+    and CONN_HEALTH_CHECKS as for a web request. If the database can't be
+    reached, such as while it restarts, the batch is retried on a new
+    connection with an increasing delay of up to `max_retry_delay` seconds.
+    Meanwhile messages wait in the queue and its backpressure policy applies.
+    Once the queue is closed a failing batch is given up on rather than
+    delaying shutdown, it is left unacknowledged in the spool if there is one.
+
+    If a batch fails for another reason, such as a value too long for its
+    column, its rows are written one at a time so only the failing rows are
+    lost. Their messages are logged and rejected, which moves them to the
+    rejected file of the spool if there is one, see kit_web_ui/spool.py.
+
+    Messages that fail to decode and the written batches are recorded in
+    `metrics`, if given.
+    """
+
+    def __init__(
+        self,
+        source: IngestQueue,
+        decode: Callable[[RawMessage], MqttData | None],
+        batch_size: int = 100,
+        max_latency: float = 1.0,
+        name: str = "ingest-writer",
+        on_flush: Callable[[list[MqttData]], None] | None = None,
+        max_retry_delay: float = 30.0,
+        metrics: IngestMetrics | None = None,
+    ) -> None:
+        super().__init__(name=name, daemon=True)
+        self.source = source
+        self.decode = decode
+        self.on_flush = on_flush
+        self.metrics = metrics
+        self.batch_size = max(batch_size, 1)
+        self.max_latency = max_latency
+        self.max_retry_delay = max_retry_delay
+
+        # Batches retried after the database couldn't be reached, and given up on
+        self.retries = 0
+        self.failed = 0
+        # Rows that couldn't be written, such as a value too long for its column
+        self.failed_rows = 0
+
+    def run(self) -> None:
+        batch: list[MqttData] = []
+        # The message of each row in the batch
+        row_messages: list[RawMessage] = []
+        # Every message taken for the batch, including those not decoded to a row
+        messages: list[RawMessage] = []
+        deadline: float | None = None
+
+        try:
+            while True:
+                if deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(deadline - time.monotonic(), 0)
+
+                try:
+                    message = self.source.get(timeout=timeout)
+                except queue.Empty:
+                    # The oldest row has waited max_latency seconds
+                    self._finish(batch, row_messages, messages)
+                    batch = []
+                    row_messages = []
+                    messages = []
+                    deadline = None
+                    continue
+
+                if message is None:
+                    break
+
+                messages.append(message)
+                try:
+                    row = self.decode(message)
+                except Exception:
+                    logger.exception(f"Failed to decode message on topic {message.topic}")
+                    row = None
+
+                if row is not None:
+                    batch.append(row)
+                    row_messages.append(message)
+                elif self.metrics is not None:
+                    self.metrics.count_decode_failure()
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_latency
+
+                if len(batch) >= self.batch_size:
+                    self._finish(batch, row_messages, messages)
+                    batch = []
+                    row_messages = []
+                    messages = []
+                    deadline = None
+        finally:
+            self._finish(batch, row_messages, messages)
+            # Each writer thread owns its own database connection
+            connection.close()
+
+    def _finish(
+        self,
+        batch: list[MqttData],
+        row_messages: list[RawMessage],
+        messages: list[RawMessage],
+    ) -> None:
+        failed = self.flush(batch)
+        if failed is None:
+            return
+        if failed:
+            # Rejected rather than acknowledged, so they can still be inspected
+            failed_ids = {id(row) for row in failed}
+            rejected = [
+                message
+                for row, message in zip(batch, row_messages)
+                if id(row) in failed_ids
+            ]
+            self.source.reject(rejected)
+            rejected_ids = {id(message) for message in rejected}
+            messages = [message for message in messages if id(message) not in rejected_ids]
+        if messages:
+            self.source.done(messages)
+
+    def flush(self, batch: list[MqttData]) -> list[MqttData] | None:
+        """
+        Write a batch of rows to the database in a single transaction.
+
+        Returns the rows that couldn't be written, or None if the batch was
+        given up on because the database couldn't be reached while stopping.
+        """
+        if not batch:
+            return []
+
+        delay = 1.0
+        while True:
+            # As at the start of a request, close the connection if it is past
+            # CONN_MAX_AGE or broken, and health check it before it is reused
+            close_old_connections()
+            start = time.perf_counter()
+            try:
+                with transaction.atomic():
+                    _write_rows(batch)
+                failed = []
+                break
+            except (OperationalError, InterfaceError) as e:
+                connection.close()
+                if self.source.closed:
+                    self.failed += 1
+                    logger.error(f"Failed to write {len(batch)} messages to the database: {e}")
+                    return None
+                self.retries += 1
+                # Ids set by an insert that was rolled back may since have been reused
+                for row in batch:
+                    row.pk = None
+                logger.warning(
+                    f"Failed to write {len(batch)} messages to the database, "
+                    f"retrying in {delay:.0f} s: {e}"
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+            except Exception as e:
+                logger.warning(
+                    f"Failed to write {len(batch)} messages to the database, "
+                    f"writing them one at a time: {e}"
+                )
+                failed = self._write_each(batch)
+                break
+
+        if failed:
+            self.failed_rows += len(failed)
+            failed_ids = {id(row) for row in failed}
+            batch = [row for row in batch if id(row) not in failed_ids]
+        if self.metrics is not None and batch:
+            self.metrics.observe_batch(batch, time.perf_counter() - start)
+        if self.on_flush is not None and batch:
+            try:
+                self.on_flush(batch)
+            except Exception:
+                logger.exception("Failed to process written batch")
+        return failed
+
+    def _write_each(self, batch: list[MqttData]) -> list[MqttData]:
+        """Write each row in its own transaction, returning the rows that failed."""
+        failed = []
+        for row in batch:
+            # Ids set by an insert that was rolled back may since have been reused
+            row.pk = None
+            try:
+                with transaction.atomic():
+                    _write_rows([row])
+            except Exception:
+                row.pk = None
+                logger.exception(
+                    f"Failed to write message on {row.subtopic} of config {row.config_id}")
+                failed.append(row)
+        return failed
+
+
+class StatusPublisher:
+    """
+    Publish the displayed state of each robot as a retained MQTT message.
+
+    The status page subscribes to `<topic>/+` over the broker's websocket
+    listener, so each state change is sent to the broker once and fanned out
+    to every open dashboard instead of each dashboard polling the database.
+    A message is only published when a team's state differs from the state
+    last published for it. The payload is `{"name": <team name>, "state": <state>}`
+    and the last level of the topic is the id of the team's MqttConfig.
+    """
+
+    def __init__(self, client: mqtt.Client, topic: str) -> None:
+        self.client = client
+        self.topic = topic.rstrip('/')
+        self._published: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def owns(self, topic: str) -> bool:
+        """Return whether a topic is one this publisher publishes to."""
+        return topic.startswith(self.topic + '/')
+
+    def publish(self, config_ids: Iterable[int] | None = None) -> None:
+        """Publish the changed states of the given teams, or of all teams."""
+        # The lock is held over the query so an older state can't be
+        # published after a newer one by another writer thread
+        with self._lock:
+            for config_id, name, state in iter_robot_states(config_ids):
+                if self._published.get(config_id) == state:
+                    continue
+                self.client.publish(
+                    f"{self.topic}/{config_id}",
+                    json.dumps({'name': name, 'state': state}),
+                    qos=1,
+                    retain=True,
+                )
+                self._published[config_id] = state
+
+    def publish_batch(self, rows: list[MqttData]) -> None:
+        """Publish the states of the teams whose state may be changed by `rows`."""
+        config_ids = {
+            row.config_id
+            for row in rows
+            if row.config_id is not None and row.subtopic in ('state', 'connected')
+        }
+        if config_ids:
+            self.publish(config_ids)
+
+    def republish(self) -> None:
+        """Publish the state of every team, such as after reconnecting to the broker."""
+        with self._lock:
+            self._published.clear()
+        self.publish()
+
+
+def _write_rows(rows: list[MqttData]) -> None:
+    MqttData.objects.bulk_create(rows)
+    update_robot_states(rows)
+    update_runs(rows)
+
+
+def update_robot_states(rows: list[MqttData]) -> None:
+    """
+    Upsert the RobotState of each team with messages in `rows`.
+
+    Batches can be committed out of order, such as with several writers or
+    when replaying the spool, so the state and connected fields are only
+    replaced by messages at least as new as the ones that set them, recorded
+    in `state_at` and `connected_at`. `last_seen` is the newest message of any
+    subtopic.
+    """
+    changes: dict[int, dict[str, Any]] = {}
+
+    for row in rows:
+        if row.config_id is None:
+            continue
+
+        date = row.date
+        fields = changes.setdefault(row.config_id, {'last_seen': date})
+        fields['last_seen'] = max(fields['last_seen'], date)
+        # Later messages of the batch with the same date take precedence
+        if row.subtopic == 'state':
+            if 'state_at' not in fields or date >= fields['state_at']:
+                fields['state'] = row.payload.get('state', '')
+                fields['run_uuid'] = row.run_uuid
+                fields['state_at'] = date
+        elif row.subtopic == 'connected':
+            if 'connected_at' not in fields or date >= fields['connected_at']:
+                fields['connected'] = row.payload.get('state') != 'disconnected'
+                fields['connected_at'] = date
+
+    for config_id, fields in changes.items():
+        # Compared in the database so concurrent writers can't replace newer values
+        updates: dict[str, Any] = {
+            'last_seen': Case(
+                When(last_seen__gt=fields['last_seen'], then=F('last_seen')),
+                default=Value(fields['last_seen'])),
+        }
+        for date_field, names in (
+            ('state_at', ('state', 'run_uuid', 'state_at')),
+            ('connected_at', ('connected', 'connected_at')),
+        ):
+            if date_field not in fields:
+                continue
+            # Unless the stored value was set by a newer message
+            newer = Q(**{f'{date_field}__gt': fields[date_field]})
+            for name in names:
+                updates[name] = Case(When(newer, then=F(name)), default=Value(fields[name]))
+
+        existing = RobotState.objects.filter(config_id=config_id)
+        if existing.update(**updates):
+            continue
+
+        try:
+            with transaction.atomic():
+                RobotState.objects.create(config_id=config_id, **fields)
+        except IntegrityError:
+            # Another writer created the state first
+            existing.update(**updates)
+
+
+def update_runs(rows: list[MqttData]) -> None:
+    """Add the messages in `rows` to the Run summary of the run they belong to."""
+    changes: dict[tuple[int, str], dict[str, Any]] = {}
+
+    for row in rows:
+        if row.config_id is None or not row.run_uuid:
+            continue
+
+        date = row.date
+        run = changes.setdefault((row.config_id, row.run_uuid), {
+            'start': None, 'end': date, 'final_state': None, 'state_at': None,
+            'log_count': 0, 'image_count': 0,
+        })
+        run['end'] = max(run['end'], date)
+
+        if row.subtopic == 'logs':
+            run['log_count'] += 1
+        elif row.subtopic == 'camera/annotated':
+            run['image_count'] += 1
+        elif row.subtopic == 'state':
+            state = row.payload.get('state', '')
+            # Messages may arrive out of order, the newest state is the final one
+            if run['state_at'] is None or date >= run['state_at']:
+                run['final_state'] = state
+                run['state_at'] = date
+            if state == 'Running':
+                if run['start'] is None or date < run['start']:
+                    run['start'] = date
+
+    for (config_id, run_uuid), run in changes.items():
+        # Update in the database so concurrent writers can't lose each other's counts
+        updates: dict[str, Any] = {
+            'log_count': F('log_count') + run['log_count'],
+            'image_count': F('image_count') + run['image_count'],
+            'end': Case(When(end__gt=run['end'], then=F('end')), default=Value(run['end'])),
+        }
+        if run['start'] is not None:
+            updates['start'] = Case(
+                When(start__lt=run['start'], then=F('start')), default=Value(run['start']))
+        if run['final_state'] is not None:
+            # Unless the stored state was set by a newer message
+            updates['final_state'] = Case(
+                When(state_at__gt=run['state_at'], then=F('final_state')),
+                default=Value(run['final_state']))
+            updates['state_at'] = Case(
+                When(state_at__gt=run['state_at'], then=F('state_at')),
+                default=Value(run['state_at']))
+
+        existing = Run.objects.filter(config_id=config_id, run_uuid=run_uuid)
+        if existing.update(**updates):
+            continue
+
+        try:
+            with transaction.atomic():
+                Run.objects.create(
+                    config_id=config_id,
+                    run_uuid=run_uuid,
+                    start=run['start'],
+                    end=run['end'],
+                    final_state=run['final_state'] or "",
+                    state_at=run['state_at'],
+                    log_count=run['log_count'],
+                    image_count=run['image_count'],
+                )
+        except IntegrityError:
+            # Another writer created the run first
+            existing.update(**updates)
@@ -0,0 +1,62 @@
+"""
+Apply a retention policy to the stored MQTT data.
+
+The policy is a JSON file of rules which delete, thin or archive old data,
+see kit_web_ui/retention.py and retention.example.json. Rules are applied in
+the order they are listed. Camera frames no longer referenced by any stored
+or archived row are then deleted, see kit_web_ui/frames.py. This is intended
+to be run periodically, such as daily from a systemd timer or cron.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Delete, thin or archive old MQTT data according to a retention policy'
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        parser.add_argument(
+            '--policy', type=str,
+            help="The policy file to apply, defaults to KIT_UI['RETENTION_POLICY']")
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Maximum number of rows to delete in one transaction')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report the number of rows each rule would remove without changing anything')
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from django.conf import settings
+        from django.utils import timezone
+
+        from kit_web_ui.frames import collect_frames
+        from kit_web_ui.retention import apply_rule, load_policy
+
+        policy_path = options['policy'] or settings.KIT_UI['RETENTION_POLICY']
+        if not policy_path:
+            raise CommandError("No retention policy given")
+
+        try:
+            rules = load_policy(policy_path)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        now = timezone.now()
+        for rule in rules:
+            removed = apply_rule(
+                rule,
+                now,
+                batch_size=max(options['batch_size'], 1),
+                dry_run=options['dry_run'],
+            )
+            if options['dry_run']:
+                self.stdout.write(f"{rule}: would remove {removed} rows")
+            else:
+                self.stdout.write(f"{rule}: removed {removed} rows")
+
+        frames = collect_frames(dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(f"Would delete {frames} unreferenced camera frames")
+        else:
+            self.stdout.write(f"Deleted {frames} unreferenced camera frames")
+
+        self.stdout.write("Done")
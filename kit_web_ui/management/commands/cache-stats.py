@@ -0,0 +1,31 @@
+"""
+Print the hit and miss counts of the dashboard and summary cache.
+
+The counts are held in the cache, so with the local-memory cache this only
+reports the counts of this process.
+"""
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Print the hit and miss counts of the dashboard and summary cache'
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Reset the counts after printing them')
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from kit_web_ui.cache import get_stats, reset_stats
+
+        stats = get_stats()
+        lookups = stats['hits'] + stats['misses']
+        ratio = stats['hits'] / lookups if lookups else 0
+        self.stdout.write(
+            f"Hits: {stats['hits']}, misses: {stats['misses']}, hit ratio: {ratio:.1%}")
+
+        if options['reset']:
+            reset_stats()
+            self.stdout.write("Reset counts")
+
+        self.stdout.write("Done")
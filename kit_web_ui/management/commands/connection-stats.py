@@ -0,0 +1,34 @@
+"""
+Print the number of database connections opened and requests served.
+
+The counts are held in the cache, so with the local-memory cache this only
+reports the counts of this process. With a shared cache they are the totals
+of the web server processes and run-ingest, see kit_web_ui/db.py.
+"""
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Print the number of database connections opened and requests served'
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Reset the counts after printing them')
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from kit_web_ui import db
+        from kit_web_ui.cache import get_stats, reset_stats
+
+        stats = get_stats(db.STATS)
+        ratio = stats['connections'] / stats['requests'] if stats['requests'] else 0
+        self.stdout.write(
+            f"Connections: {stats['connections']}, requests: {stats['requests']}, "
+            f"connections per request: {ratio:.2f}"
+        )
+
+        if options['reset']:
+            reset_stats(db.STATS)
+            self.stdout.write("Reset counts")
+
+        self.stdout.write("Done")
@@ -0,0 +1,75 @@
+"""
+Manage time partitions of the MQTT data table on PostgreSQL.
+
+--convert converts the existing table to one partitioned by month or by day
+(--interval), ingest should be stopped while it runs. Afterwards, run this
+command periodically, such as daily from a systemd timer or cron, to create
+the partitions for the next --ahead periods and, with --drop-older-than, drop
+partitions whose data is all older than the given number of days.
+See kit_web_ui/partitions.py.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Create, rotate and drop time partitions of the MQTT data table on PostgreSQL'
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        from kit_web_ui.partitions import PARTITION_INTERVALS
+
+        parser.add_argument(
+            '--convert', action='store_true',
+            help='Convert the MQTT data table to a partitioned table')
+        parser.add_argument(
+            '--interval', choices=PARTITION_INTERVALS, default='month',
+            help='The period each partition holds when converting')
+        parser.add_argument(
+            '--ahead', type=int, default=3,
+            help='Number of future periods to create partitions for')
+        parser.add_argument(
+            '--drop-older-than', type=float,
+            help='Drop partitions holding only data older than this many days')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='List the partitions that would be dropped without dropping them')
+        parser.add_argument(
+            '--list', action='store_true',
+            help='List the existing partitions')
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from datetime import timedelta
+
+        from django.utils import timezone
+
+        from kit_web_ui import partitions
+
+        try:
+            partitions.check_postgres()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['convert']:
+            if partitions.is_partitioned():
+                raise CommandError("The MQTT data table is already partitioned")
+            created = partitions.convert_table(options['interval'], options['ahead'])
+            self.stdout.write(f"Converted to {len(created)} {options['interval']} partitions")
+        elif not partitions.is_partitioned():
+            raise CommandError("The MQTT data table isn't partitioned, use --convert")
+        elif not options['list']:
+            for partition in partitions.create_ahead(options['ahead']):
+                self.stdout.write(f"Created {partition.name}")
+
+        if options['drop_older_than'] is not None:
+            before = timezone.now() - timedelta(days=options['drop_older_than'])
+            dropped = partitions.drop_partitions(before, dry_run=options['dry_run'])
+            for partition in dropped:
+                if options['dry_run']:
+                    self.stdout.write(f"Would drop {partition.name}")
+                else:
+                    self.stdout.write(f"Dropped {partition.name}")
+
+        if options['list']:
+            for partition in partitions.list_partitions():
+                self.stdout.write(f"{partition.name}: {partition.start} to {partition.end}")
+
+        self.stdout.write("Done")
@@ -0,0 +1,66 @@
+"""
+Rebuild the current robot state of every team from the stored MQTT data.
+
+The robot state is normally maintained by run-ingest as messages arrive.
+This command is used to populate it from existing data, or to correct it
+after data has been edited or deleted.
+"""
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the current robot state of every team from stored MQTT data'
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from django.db import transaction
+        from django.db.models import Max, OuterRef, Subquery
+
+        from kit_web_ui.models import MqttConfig, MqttData, RobotState
+
+        newest_state = (
+            MqttData.objects
+            .filter(config=OuterRef("id"), subtopic='state')
+            .order_by('-date')
+        )
+        newest_connected = (
+            MqttData.objects
+            .filter(config=OuterRef("id"), subtopic='connected')
+            .order_by('-date')
+        )
+
+        configs = MqttConfig.objects.annotate(
+            latest_state=Subquery(newest_state.values("payload__state")[:1]),
+            latest_run=Subquery(newest_state.values("run_uuid")[:1]),
+            latest_connected=Subquery(newest_connected.values("payload__state")[:1]),
+            state_at=Subquery(newest_state.values("date")[:1]),
+            connected_at=Subquery(newest_connected.values("date")[:1]),
+            last_seen=Max('data__date'),
+        )
+
+        states = [
+            RobotState(
+                config=config,
+                state=config.latest_state or "",
+                connected=(
+                    config.latest_connected is not None
+                    and config.latest_connected != 'disconnected'
+                ),
+                last_seen=config.last_seen,
+                run_uuid=config.latest_run or "",
+                state_at=config.state_at,
+                connected_at=config.connected_at,
+            )
+            for config in configs
+        ]
+
+        with transaction.atomic():
+            RobotState.objects.all().delete()
+            RobotState.objects.bulk_create(states)
+
+        for state in states:
+            self.stdout.write(
+                f"{state.config}: {state.state or 'Unknown'} "
+                f"({'connected' if state.connected else 'disconnected'})"
+            )
+
+        self.stdout.write("Done")
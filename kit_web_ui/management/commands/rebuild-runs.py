@@ -0,0 +1,85 @@
+"""
+Rebuild the summary of every run from the stored MQTT data.
+
+Run summaries are normally maintained by run-ingest as messages arrive.
+This command is used to populate them from existing data, or to correct them
+after data has been edited or deleted. Archived runs are left as they are,
+as their messages are no longer in the database. Logs and images removed by
+a thin retention rule are still counted, as recorded on the existing runs.
+"""
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the summary of every run from stored MQTT data'
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from django.db import transaction
+        from django.db.models import Count, Max, Min, OuterRef, Q, Subquery
+
+        from kit_web_ui.models import MqttData, Run
+
+        final_state = (
+            MqttData.objects
+            .filter(
+                config=OuterRef('config'),
+                run_uuid=OuterRef('run_uuid'),
+                subtopic='state',
+            )
+            .order_by('-date')
+        )
+
+        run_data = (
+            MqttData.objects
+            .filter(config__isnull=False)
+            .exclude(run_uuid='')
+            .values('config', 'run_uuid')
+            .annotate(
+                start=Min('date', filter=Q(subtopic='state', payload__state='Running')),
+                end=Max('date'),
+                log_count=Count('pk', filter=Q(subtopic='logs')),
+                image_count=Count('pk', filter=Q(subtopic='camera/annotated')),
+                final_state=Subquery(final_state.values('payload__state')[:1]),
+                state_at=Subquery(final_state.values('date')[:1]),
+            )
+            .order_by()
+        )
+
+        archived = set(
+            Run.objects.filter(archived=True).values_list('config_id', 'run_uuid'))
+        thinned = {
+            (config_id, run_uuid): (log_count, image_count)
+            for config_id, run_uuid, log_count, image_count in (
+                Run.objects
+                .filter(archived=False)
+                .filter(Q(thinned_log_count__gt=0) | Q(thinned_image_count__gt=0))
+                .values_list(
+                    'config_id', 'run_uuid', 'thinned_log_count', 'thinned_image_count')
+            )
+        }
+
+        runs = []
+        for run in run_data.iterator():
+            key = (run['config'], run['run_uuid'])
+            if key in archived:
+                continue
+            thinned_logs, thinned_images = thinned.get(key, (0, 0))
+            runs.append(Run(
+                config_id=run['config'],
+                run_uuid=run['run_uuid'],
+                start=run['start'],
+                end=run['end'],
+                final_state=run['final_state'] or "",
+                state_at=run['state_at'],
+                log_count=run['log_count'] + thinned_logs,
+                image_count=run['image_count'] + thinned_images,
+                thinned_log_count=thinned_logs,
+                thinned_image_count=thinned_images,
+            ))
+
+        with transaction.atomic():
+            Run.objects.filter(archived=False).delete()
+            Run.objects.bulk_create(runs, batch_size=1000)
+
+        self.stdout.write(f"Rebuilt {len(runs)} runs")
+        self.stdout.write("Done")
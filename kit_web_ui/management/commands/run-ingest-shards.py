@@ -0,0 +1,169 @@
+"""
+Run several run-ingest processes that share the MQTT messages.
+
+One run-ingest process is started for each of --shards shards, each with its
+own MQTT connection, writer threads and database connection, so ingest isn't
+limited to a single core. With --mode hash every process subscribes to all
+topics and only handles the teams whose topic root hashes to its shard, so a
+team's messages are always written in order by one process. With --mode shared
+the processes subscribe with an MQTTv5 shared subscription of --group and the
+broker gives each message to one of them, which spreads the load evenly even
+with a few busy teams, but a team's messages may be written out of order.
+
+When the spool is enabled, each process uses a `shard-<index>` directory in
+the spool directory. With --metrics-port, the processes serve their metrics on
+consecutive ports starting from the given port. Processes that exit are
+restarted, waiting up to a minute if they keep failing. SIGTERM and SIGINT
+stop all the processes, letting them flush their queued messages, and SIGHUP
+is passed on to reload the MQTT configs.
+Any arguments after the options are passed to each run-ingest process, e.g.
+    django-admin run-ingest-shards --shards 4 -- --workers 2 --batch-size 200
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import subprocess
+    from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+
+# Seconds a process must run before its restart delay is reset
+STABLE_RUNTIME = 60
+MAX_RESTART_DELAY = 60
+
+
+class Shard:
+    """A run-ingest process and when to restart it."""
+
+    def __init__(self, index: int, args: list[str]) -> None:
+        self.index = index
+        self.args = args
+        self.process: subprocess.Popen[bytes] | None = None
+        self.started = 0.0
+        self.restart_at = 0.0
+        self.restart_delay = 1.0
+
+    def start(self) -> None:
+        import subprocess
+        import time
+
+        # In their own session, so Ctrl-C only reaches the supervisor which stops them in turn
+        self.process = subprocess.Popen(self.args, start_new_session=True)
+        self.started = time.monotonic()
+
+    def signal(self, signum: int) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signum)
+
+
+class Command(BaseCommand):
+    help = 'Run several run-ingest processes that share the MQTT messages'
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        import argparse
+
+        from django.conf import settings
+
+        from kit_web_ui.ingest import SHARD_MODES
+
+        parser.add_argument(
+            '--shards', type=int, default=settings.KIT_UI['INGEST_SHARDS'],
+            help="Number of run-ingest processes, defaults to KIT_UI['INGEST_SHARDS']")
+        parser.add_argument(
+            '--mode', choices=SHARD_MODES, default='hash',
+            help='Split the messages by a hash of the topic root or by the broker')
+        parser.add_argument(
+            '--group', type=str, default='kit-web-ui-ingest',
+            help='Name of the shared subscription group with --mode shared')
+        parser.add_argument(
+            '--spool-dir', type=str,
+            help="Directory of the spools of the processes, defaults to KIT_UI['SPOOL_DIR']")
+        parser.add_argument(
+            '--metrics-port', type=int, default=settings.KIT_UI['METRICS_PORT'],
+            help="Port the first process serves its metrics on, 0 to disable, "
+            "defaults to KIT_UI['METRICS_PORT']")
+        parser.add_argument(
+            'ingest_args', nargs=argparse.REMAINDER,
+            help='Arguments passed to each run-ingest process')
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        import signal
+        import sys
+        import threading
+        import time
+        from pathlib import Path
+
+        from django.conf import settings
+
+        if options['shards'] < 1:
+            raise CommandError("--shards must be at least 1")
+
+        ingest_args = list(options['ingest_args'])
+        if ingest_args[:1] == ['--']:
+            ingest_args = ingest_args[1:]
+        spool_dir = options['spool_dir'] or settings.KIT_UI['SPOOL_DIR']
+
+        shards = []
+        for index in range(options['shards']):
+            shard_args = [sys.executable, '-m', 'django', 'run-ingest', *ingest_args]
+            if options['mode'] == 'hash':
+                shard_args += ['--shard', f"{index}/{options['shards']}"]
+            else:
+                shard_args += ['--shard-group', options['group']]
+            if spool_dir:
+                # A spool can only be used by one process
+                shard_args += ['--spool-dir', str(Path(spool_dir) / f'shard-{index}')]
+            metrics_port = options['metrics_port'] + index if options['metrics_port'] else 0
+            shard_args += ['--metrics-port', str(metrics_port)]
+            shards.append(Shard(index, shard_args))
+
+        stop = threading.Event()
+
+        def stop_shards(signum: int, frame: Any) -> None:
+            stop.set()
+            for shard in shards:
+                # run-ingest flushes its queue on SIGTERM
+                shard.signal(signal.SIGTERM)
+
+        def reload_shards(signum: int, frame: Any) -> None:
+            for shard in shards:
+                shard.signal(signal.SIGHUP)
+
+        signal.signal(signal.SIGTERM, stop_shards)
+        signal.signal(signal.SIGINT, stop_shards)
+        signal.signal(signal.SIGHUP, reload_shards)
+
+        self.stdout.write(f"Starting {len(shards)} ingest shards ({options['mode']})")
+        for shard in shards:
+            shard.start()
+
+        while not stop.is_set() or any(
+            shard.process is not None and shard.process.poll() is None for shard in shards
+        ):
+            now = time.monotonic()
+            for shard in shards:
+                if stop.is_set():
+                    break
+                if shard.process is None:
+                    if now >= shard.restart_at:
+                        self.stdout.write(f"Restarting shard {shard.index}")
+                        shard.start()
+                    continue
+
+                returncode = shard.process.poll()
+                if returncode is None:
+                    continue
+                if now - shard.started > STABLE_RUNTIME:
+                    shard.restart_delay = 1.0
+                self.stderr.write(
+                    f"Shard {shard.index} exited with {returncode}, "
+                    f"restarting in {shard.restart_delay:.0f}s"
+                )
+                shard.process = None
+                shard.restart_at = now + shard.restart_delay
+                shard.restart_delay = min(shard.restart_delay * 2, MAX_RESTART_DELAY)
+            time.sleep(0.5)
+
+        self.stdout.write("Done")
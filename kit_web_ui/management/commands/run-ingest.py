@@ -2,51 +2,193 @@
 Save received MQTT data to the database.
 
 This script connects to the MQTT broker using the configuration from the Django settings file.
+Received messages are placed on a bounded queue by the MQTT network thread. One or more
+writer threads (--workers) decode the queued messages and write them to the database in
+batches, a batch is written once --batch-size messages are waiting or the oldest has waited
+--max-latency seconds.
+
+When the queue is full (--queue-size), --backpressure selects whether the network thread
+blocks, the oldest queued message is dropped or new messages are spilled to --spill-file.
+Queue depth counters are printed every --stats-interval seconds.
+
+With --spool-dir, every message is first appended to a write-ahead spool on disk, synced
+every --spool-sync-interval seconds, and acknowledged once written to the database. When the
+queue is full, such as while the database is unreachable, messages are left in the spool
+rather than applying --backpressure, and are replayed at up to --replay-rate messages a second
+once the writers catch up. Messages not acknowledged when ingest stopped are replayed on the
+next start.
+See kit_web_ui/spool.py and the spool command.
+
+Several run-ingest processes can share the messages, see the run-ingest-shards command. With
+--shard <index>/<count> a process only handles the topics whose first level hashes to its
+index, so each team's messages are handled by one process in order. With --shard-group the
+processes subscribe with an MQTTv5 shared subscription of that group, and the broker splits
+messages between them, which spreads the load more evenly but a team's messages may be written
+out of order by different processes.
+
+Only the topic roots of the MQTT configs are subscribed to, as `<topic_root>/#`, so messages
+of other topics aren't received. Messages on subtopics matching the ignored_subtopics filters
+of their config or KIT_UI['INGEST_IGNORE_SUBTOPICS'], such as `camera/raw`, are dropped before
+they are spooled or decoded. The MQTT configs are reloaded from the database every
+--config-refresh seconds, or immediately on SIGHUP, and the subscriptions updated, so teams
+added or edited while running are received without restarting.
+
+Database connections are kept open and reused according to CONN_MAX_AGE. While the database
+is unreachable, such as during a restart, batches are retried on a new connection and messages
+wait in the queue, so a database restart doesn't stop ingest. The number of connections opened
+and batches retried are printed with the queue statistics.
+
+Annotated camera images are decoded and written to the frame store, with the stored payload
+referencing the file, see kit_web_ui/frames.py. Only a tag is stored for other camera
+subtopics, such as camera/raw, and for every image with KIT_UI['STORE_FRAMES'] disabled.
+
+Messages received, ignored, stored and failing to decode are counted by topic class, and the
+batch write time, batch size and lag from the payload timestamps kept as histograms, see
+kit_web_ui/metrics.py. A summary is printed with the queue statistics, and with --metrics-port
+the metrics are served in the Prometheus text format at http://<--metrics-host>:<port>/metrics.
+
+Cached dashboard data changed by each written batch is invalidated, see kit_web_ui/cache.py.
+When MQTT_STATUS_FEED['TOPIC'] is set, changes to the robot states are published to it as
+retained messages for the status page.
 """
 from __future__ import annotations
 
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from typing import Any, Dict
+    import threading
+    from typing import Any
 
     import paho.mqtt.client as mqtt
 
-    from kit_web_ui.models import MqttConfig
-
-from django.core.management.base import BaseCommand
-
-PROGRESS_COUNT = 0
+    from kit_web_ui.ingest import (
+        BatchWriter, IngestQueue, RawMessage, StatusPublisher, TopicRouter,
+    )
+    from kit_web_ui.metrics import IngestMetrics
+    from kit_web_ui.models import MqttData
+    from kit_web_ui.spool import Spool
 
-
-def progress(char: str = ".") -> None:
-    global PROGRESS_COUNT
-    print(char, end="", flush=True)
-
-    PROGRESS_COUNT += 1
-    if PROGRESS_COUNT > 80:
-        PROGRESS_COUNT = 0
-        print()
+from django.core.management.base import BaseCommand, CommandError
 
 
 class Command(BaseCommand):
     help = 'Save received MQTT data to the database'
-    topic_root_mapping: Dict[str, MqttConfig] = {}
+    router: TopicRouter
+    queue: IngestQueue
+    writers: list[BatchWriter]
+    reload_requested: threading.Event
+    status: StatusPublisher | None
+    spool: Spool | None
+    shard: tuple[int, int] | None
+    shard_group: str | None
+    client: mqtt.Client
+    # The topic filters currently subscribed to
+    subscribed: set[str]
+    subscription_lock: threading.Lock
+    metrics: IngestMetrics
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        from kit_web_ui.ingest import BACKPRESSURE_POLICIES
+
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of threads writing messages to the database')
+        parser.add_argument(
+            '--queue-size', type=int, default=10000,
+            help='Maximum number of messages held in memory waiting to be written')
+        parser.add_argument(
+            '--backpressure', choices=BACKPRESSURE_POLICIES, default='block',
+            help='What to do with new messages when the queue is full')
+        parser.add_argument(
+            '--spill-file', type=str,
+            help='File to hold overflow messages, required for --backpressure=spill')
+        parser.add_argument(
+            '--stats-interval', type=float, default=60,
+            help='Seconds between printing queue statistics and metrics, 0 to disable')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Maximum number of messages to write to the database in one transaction')
+        parser.add_argument(
+            '--max-latency', type=float, default=1.0,
+            help='Maximum time in seconds a message is buffered before being written')
+        parser.add_argument(
+            '--config-refresh', type=float, default=60,
+            help='Seconds between reloading the MQTT configs, 0 to only reload on SIGHUP')
+        parser.add_argument(
+            '--shard', type=str, metavar='INDEX/COUNT',
+            help='Only handle the topics hashed to this shard of COUNT processes')
+        parser.add_argument(
+            '--shard-group', type=str,
+            help='Share the messages between the processes of this group using the broker')
+        parser.add_argument(
+            '--metrics-port', type=int,
+            help="Port to serve the metrics on, 0 to disable, defaults to "
+            "KIT_UI['METRICS_PORT']")
+        parser.add_argument(
+            '--metrics-host', type=str, default='127.0.0.1',
+            help='Address to serve the metrics on')
+        parser.add_argument(
+            '--spool-dir', type=str,
+            help="Directory of the write-ahead spool, defaults to KIT_UI['SPOOL_DIR']")
+        parser.add_argument(
+            '--spool-sync-interval', type=float, default=0.2,
+            help='Seconds between syncing the spool to disk')
+        parser.add_argument(
+            '--replay-rate', type=float, default=1000,
+            help='Maximum messages a second to replay from the spool, 0 for no limit')
 
     def handle(self, *args, **options) -> None:  # type: ignore
+        import signal
+        import threading
+
         import paho.mqtt.client as mqtt
         from django.conf import settings
-        from kit_web_ui.models import MqttConfig
 
-        # Prepopulate mapping of topic root to MqttConfig
+        from kit_web_ui.ingest import (
+            BatchWriter, IngestQueue, StatusPublisher, parse_shard,
+        )
+        from kit_web_ui.metrics import IngestMetrics, MetricsServer
+        from kit_web_ui.spool import Spool, SpoolReplayer
+
+        if options['shard'] and options['shard_group']:
+            raise CommandError("Only one of --shard and --shard-group can be given")
+        self.shard_group = options['shard_group']
+
+        spool_dir = options['spool_dir'] or settings.KIT_UI['SPOOL_DIR']
+        try:
+            self.shard = parse_shard(options['shard']) if options['shard'] else None
+            self.spool = Spool(spool_dir) if spool_dir else None
+            self.queue = IngestQueue(
+                maxsize=options['queue_size'],
+                policy=options['backpressure'],
+                spill_file=options['spill_file'],
+                spool=self.spool,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        if self.spool is not None and self.spool.recovered:
+            self.stdout.write(f"Replaying {self.spool.recovered} messages from the spool")
+
+        # Prepopulate the routing of topic roots to MqttConfig
         # to avoid querying the database for each message
-        mqtt_configs = MqttConfig.objects.all()
-        self.topic_root_mapping = {
-            config.topic_root: config
-            for config in mqtt_configs
-        }
+        self.router = self._wait_for_router()
+        self.subscribed = set()
+        self.subscription_lock = threading.Lock()
+        self.metrics = IngestMetrics()
+
+        metrics_port = options['metrics_port']
+        if metrics_port is None:
+            metrics_port = settings.KIT_UI['METRICS_PORT']
+        metrics_server = None
+        if metrics_port:
+            try:
+                metrics_server = MetricsServer(
+                    options['metrics_host'], metrics_port, self._render_metrics)
+            except OSError as e:
+                raise CommandError(f"Failed to serve metrics on port {metrics_port}: {e}")
+            metrics_server.start()
 
-        client = mqtt.Client(
+        client = self.client = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
             protocol=mqtt.MQTTProtocolVersion.MQTTv5,
         )
@@ -65,6 +207,60 @@ class Command(BaseCommand):
         client.on_connect = self._on_connect
         client.on_message = self._on_message
 
+        if settings.MQTT_STATUS_FEED['TOPIC']:
+            self.status = StatusPublisher(client, settings.MQTT_STATUS_FEED['TOPIC'])
+        else:
+            self.status = None
+
+        self.writers = [
+            BatchWriter(
+                self.queue,
+                self._decode_message,
+                batch_size=options['batch_size'],
+                max_latency=options['max_latency'],
+                name=f"ingest-writer-{num}",
+                on_flush=self._on_flush,
+                metrics=self.metrics,
+            )
+            for num in range(max(options['workers'], 1))
+        ]
+        for writer in self.writers:
+            writer.start()
+
+        stop_stats = threading.Event()
+        if options['stats_interval'] > 0:
+            threading.Thread(
+                target=self._report_stats,
+                args=(options['stats_interval'], stop_stats),
+                name="ingest-stats",
+                daemon=True,
+            ).start()
+
+        stop_sync = threading.Event()
+        replayer = None
+        if self.spool is not None:
+            threading.Thread(
+                target=self.spool.run_sync,
+                args=(options['spool_sync_interval'], stop_sync),
+                name="ingest-spool-sync",
+                daemon=True,
+            ).start()
+            replayer = SpoolReplayer(self.spool, self.queue, rate=options['replay_rate'])
+            replayer.start()
+
+        stop_refresh = threading.Event()
+        self.reload_requested = threading.Event()
+        threading.Thread(
+            target=self._refresh_router,
+            args=(options['config_refresh'] or None, stop_refresh),
+            name="ingest-config",
+            daemon=True,
+        ).start()
+
+        # Stopping the service should flush buffered messages, as with Ctrl-C
+        signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_requested.set())
+
         client.connect(
             host=settings.MQTT_BROKER['HOST'],
             port=settings.MQTT_BROKER['PORT'],
@@ -76,8 +272,132 @@ class Command(BaseCommand):
         except KeyboardInterrupt:
             client.disconnect()
             client.loop_forever()
+        finally:
+            self.stdout.write("Writing buffered messages")
+            stop_stats.set()
+            stop_refresh.set()
+            self.reload_requested.set()
+            if replayer is not None:
+                # Messages left in the spool are replayed on the next start
+                replayer.stop.set()
+                replayer.join()
+            self.queue.close()
+            for writer in self.writers:
+                writer.join()
+            self.queue.release()
+            stop_sync.set()
+            if self.spool is not None:
+                self.spool.close()
+            self._write_stats()
+            if metrics_server is not None:
+                metrics_server.shutdown()
         self.stdout.write("Done")
 
+    def _on_flush(self, batch: list[MqttData]) -> None:
+        from kit_web_ui.cache import invalidate_rows
+
+        # Runs after the batch is committed so the new values are read
+        invalidate_rows(batch)
+        if self.status is not None:
+            self.status.publish_batch(batch)
+
+    def _load_router(self, warn: bool = True) -> TopicRouter:
+        from django.conf import settings
+
+        from kit_web_ui.ingest import TopicRouter
+        from kit_web_ui.models import MqttConfig
+
+        router = TopicRouter(ignored_subtopics=settings.KIT_UI['INGEST_IGNORE_SUBTOPICS'])
+        for config in MqttConfig.objects.all():
+            try:
+                router.add(config)
+            except ValueError as e:
+                if warn:
+                    self.stderr.write(f"Ignoring config: {e}")
+        return router
+
+    def _wait_for_router(self) -> TopicRouter:
+        import time
+
+        from django.db import DatabaseError, connection
+
+        # Wait for the database rather than exit, such as when it is still starting
+        delay = 1.0
+        while True:
+            try:
+                return self._load_router()
+            except DatabaseError as e:
+                self.stderr.write(
+                    f"Failed to load MQTT configs, retrying in {delay:.0f} s: {e}")
+                connection.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _refresh_router(self, interval: float | None, stop: threading.Event) -> None:
+        from django.db import DatabaseError, close_old_connections, connection
+
+        while True:
+            self.reload_requested.wait(interval)
+            self.reload_requested.clear()
+            if stop.is_set():
+                break
+
+            close_old_connections()
+            try:
+                router = self._load_router(warn=False)
+            except DatabaseError as e:
+                self.stderr.write(f"Failed to reload MQTT configs: {e}")
+                # Reconnect on the next attempt
+                connection.close()
+                continue
+
+            if router.roots == self.router.roots and router.ignored == self.router.ignored:
+                continue
+            added = router.roots.keys() - self.router.roots.keys()
+            removed = self.router.roots.keys() - router.roots.keys()
+            self.stdout.write(
+                f"Reloaded MQTT configs: {len(router.roots)} topic roots, "
+                f"added {sorted(added)}, removed {sorted(removed)}"
+            )
+            # Replacing the reference is atomic, so the writer threads
+            # only ever see a complete router and never wait on a lock
+            self.router = router
+            self._update_subscriptions()
+
+        connection.close()
+
+    def _report_stats(self, interval: float, stop: threading.Event) -> None:
+        while not stop.wait(interval):
+            self._write_stats()
+
+    def _write_stats(self) -> None:
+        from kit_web_ui import db
+        from kit_web_ui.cache import get_stats
+
+        stats = self.queue.stats()
+        self.stdout.write("Queue: " + " ".join(f"{key}={val}" for key, val in stats.items()))
+        if self.spool is not None:
+            spool_stats = self.spool.stats()
+            self.stdout.write(
+                "Spool: " + " ".join(f"{key}={val}" for key, val in spool_stats.items()))
+        self.stdout.write(
+            f"Database: connections={get_stats(db.STATS)['connections']} "
+            f"retried_batches={sum(writer.retries for writer in self.writers)} "
+            f"failed_batches={sum(writer.failed for writer in self.writers)} "
+            f"failed_rows={sum(writer.failed_rows for writer in self.writers)}"
+        )
+        self.stdout.write(f"Subscriptions: topics={len(self.subscribed)}")
+        self.stdout.write("Metrics: " + self.metrics.summary())
+
+    def _render_metrics(self) -> str:
+        gauges: dict[str, float] = {
+            'queue_depth': self.queue.depth,
+            'subscriptions': len(self.subscribed),
+        }
+        if self.spool is not None:
+            gauges['spool_pending'] = self.spool.pending
+        return self.metrics.render(gauges)
+
     def _on_connect(
         self,
         client: mqtt.Client,
@@ -93,8 +413,58 @@ class Command(BaseCommand):
             )
         else:
             self.stdout.write("Connected to MQTT broker.")
-            # Subscribe to all topics
-            client.subscribe("#", qos=1)
+            with self.subscription_lock:
+                # The broker may not have kept the session
+                self.subscribed = set()
+            self._update_subscriptions()
+            if self.status is not None:
+                import threading
+
+                # The broker may have restarted and lost the retained states.
+                # Queried from another thread so the network loop isn't blocked
+                threading.Thread(
+                    target=self._republish_status,
+                    args=(self.status,),
+                    name="ingest-status",
+                    daemon=True,
+                ).start()
+
+    def _republish_status(self, status: StatusPublisher) -> None:
+        from django.db import DatabaseError, close_old_connections, connection
+
+        close_old_connections()
+        try:
+            status.republish()
+        except DatabaseError as e:
+            # Each team's state is still published when it next changes
+            self.stderr.write(f"Failed to republish robot states: {e}")
+        finally:
+            connection.close()
+
+    def _update_subscriptions(self) -> None:
+        from kit_web_ui.ingest import shard_of, shared_subscription
+
+        wanted = set()
+        for topic_filter in self.router.subscriptions():
+            root_level = topic_filter.partition('/')[0]
+            # Roots starting with a wildcard can have messages for any shard
+            if (
+                self.shard is not None and root_level != '+'
+                and shard_of(topic_filter, self.shard[1]) != self.shard[0]
+            ):
+                continue
+            if self.shard_group:
+                topic_filter = shared_subscription(self.shard_group, topic_filter)
+            wanted.add(topic_filter)
+
+        with self.subscription_lock:
+            added = sorted(wanted - self.subscribed)
+            removed = sorted(self.subscribed - wanted)
+            if added:
+                self.client.subscribe([(topic_filter, 1) for topic_filter in added])
+            if removed:
+                self.client.unsubscribe(removed)
+            self.subscribed = wanted
 
     def _on_message(
         self,
@@ -102,43 +472,31 @@ class Command(BaseCommand):
         userdata: Any,
         message: mqtt.MQTTMessage,
     ) -> None:
-        import json
-        from datetime import datetime, timezone
-        from kit_web_ui.models import MqttData
-        now = datetime.now(tz=timezone.utc)
+        import time
 
-        try:
-            payload = json.loads(message.payload)
-        except json.JSONDecodeError:
-            self.stdout.write(f"Failed to decode message on topic {message.topic}: {message.payload!r}")
+        from kit_web_ui.ingest import RawMessage, shard_of
+
+        if self.status is not None and self.status.owns(message.topic):
+            return
+        if self.shard is not None and shard_of(message.topic, self.shard[1]) != self.shard[0]:
+            return
+        config, subtopic = self.router.route(message.topic)
+        if config is None:
+            # Such as a root removed since subscribing
+            self.metrics.count_unmapped()
+            return
+        if self.router.ignores(config, subtopic):
+            self.metrics.count_ignored()
             return
+        self.metrics.count_received(subtopic)
 
-        # Extract the topic root from the message topic
-        message_config = None
-        subtopic = message.topic
-        for topic_root, config in self.topic_root_mapping.items():
-            if message.topic.startswith(topic_root + "/"):
-                message_config = config
-                subtopic = message.topic[len(topic_root) + 1:]
-                break
+        raw_message = RawMessage(message.topic, message.payload, time.time())
+        if self.spool is not None:
+            raw_message = self.spool.append(raw_message)
+        # Decoding and saving happens in the writer threads
+        self.queue.put(raw_message)
 
-        # Attempt to extract timestamp from the message payload
-        timestamp_val = payload.get('timestamp')
-        try:
-            timestamp = datetime.fromtimestamp(timestamp_val, timezone.utc).isoformat()
-        except Exception:
-            timestamp = now.isoformat()
-
-        if subtopic.startswith('camera'):
-            # Save only a tag for camera images
-            payload = {'data': 'camera image'}
-
-        # Save the message to the database
-        MqttData.objects.create(
-            date=timestamp,
-            config=message_config,
-            subtopic=subtopic,
-            payload=payload,
-            run_uuid=payload.get('run_uuid', ''),
-        )
-        progress()
+    def _decode_message(self, message: RawMessage) -> MqttData | None:
+        from kit_web_ui.ingest import decode_message
+
+        return decode_message(message, self.router, self.metrics)
@@ -0,0 +1,132 @@
+"""
+Inspect or replay the write-ahead spool of run-ingest.
+
+Lists the segments of the spool with the number of messages not yet written
+to the database, or with --show prints the topic, receive time and size of
+each such message in a segment. --replay writes the messages left in the
+spool to the database and removes the segments once written, such as after
+moving a spool from another machine. As with run-ingest, messages not under
+the topic root of a config, or on ignored subtopics, are dropped rather than
+written. run-ingest replays its spool on start, and while it is running the
+spool is locked, so --replay can only be used while it is stopped.
+--rejected prints the messages that couldn't be written to the database,
+with their payload, the file can be deleted once they've been looked at. See
+kit_web_ui/spool.py.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Inspect or replay the write-ahead spool of run-ingest'
+
+    def add_arguments(self, parser) -> None:  # type: ignore
+        parser.add_argument(
+            '--spool-dir', type=str,
+            help="Directory of the spool, defaults to KIT_UI['SPOOL_DIR']")
+        parser.add_argument(
+            '--show', type=int, metavar='SEGMENT',
+            help='Print the messages of a segment not yet written to the database')
+        parser.add_argument(
+            '--rejected', action='store_true',
+            help="Print the messages that couldn't be written to the database")
+        parser.add_argument(
+            '--replay', action='store_true',
+            help='Write the messages left in the spool to the database')
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='Maximum messages a second to replay, 0 for no limit')
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Maximum number of messages to write to the database in one transaction')
+
+    def handle(self, *args, **options) -> None:  # type: ignore
+        from datetime import datetime, timezone
+        from pathlib import Path
+
+        from django.conf import settings
+
+        from kit_web_ui import spool
+
+        spool_dir = options['spool_dir'] or settings.KIT_UI['SPOOL_DIR']
+        if not spool_dir:
+            raise CommandError("No spool directory given")
+        if not Path(spool_dir).is_dir():
+            raise CommandError(f"The spool {spool_dir} doesn't exist")
+
+        if options['show'] is not None:
+            if options['show'] not in spool.segment_numbers(spool_dir):
+                raise CommandError(f"No segment {options['show']} in the spool")
+            for message in spool.iter_pending(spool_dir, options['show']):
+                received = datetime.fromtimestamp(message.received, timezone.utc)
+                self.stdout.write(
+                    f"{received.isoformat()} {message.topic} {len(message.payload)} bytes")
+        elif options['rejected']:
+            rejected = Path(spool_dir) / spool.REJECTED_NAME
+            if rejected.exists():
+                for _, _, message in spool.read_records(rejected):
+                    received = datetime.fromtimestamp(message.received, timezone.utc)
+                    payload = message.payload.decode('utf-8', errors='replace')
+                    self.stdout.write(f"{received.isoformat()} {message.topic} {payload}")
+        elif options['replay']:
+            self._replay(spool_dir, options['rate'], options['batch_size'])
+        else:
+            for number in spool.segment_numbers(spool_dir):
+                info = spool.segment_info(spool_dir, number)
+                self.stdout.write(
+                    f"{info.number}: {info.pending} of {info.messages} messages pending, "
+                    f"{info.size} bytes"
+                )
+            rejected = Path(spool_dir) / spool.REJECTED_NAME
+            if rejected.exists():
+                count = sum(1 for _ in spool.read_records(rejected))
+                self.stdout.write(f"rejected: {count} messages")
+
+        self.stdout.write("Done")
+
+    def _replay(self, spool_dir: str, rate: float, batch_size: int) -> None:
+        from django.conf import settings
+
+        from kit_web_ui.ingest import (
+            BatchWriter, IngestQueue, RawMessage, TopicRouter, decode_message,
+        )
+        from kit_web_ui.models import MqttConfig, MqttData
+        from kit_web_ui.spool import Spool, SpoolReplayer
+
+        try:
+            replay_spool = Spool(spool_dir)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        router = TopicRouter(ignored_subtopics=settings.KIT_UI['INGEST_IGNORE_SUBTOPICS'])
+        for config in MqttConfig.objects.all():
+            try:
+                router.add(config)
+            except ValueError as e:
+                self.stderr.write(f"Ignoring config: {e}")
+
+        dropped = 0
+
+        def decode(message: RawMessage) -> MqttData | None:
+            nonlocal dropped
+            config, subtopic = router.route(message.topic)
+            if config is None or router.ignores(config, subtopic):
+                # Not stored by run-ingest either, but removed from the spool
+                dropped += 1
+                return None
+            return decode_message(message, router)
+
+        self.stdout.write(f"Replaying {replay_spool.recovered} messages")
+        queue = IngestQueue(maxsize=batch_size * 10, spool=replay_spool)
+        writer = BatchWriter(queue, decode, batch_size=batch_size)
+        replayer = SpoolReplayer(replay_spool, queue, rate=rate, interval=0.1, drain=True)
+        writer.start()
+        replayer.start()
+        replayer.join()
+        queue.close()
+        writer.join()
+        replay_spool.close()
+
+        self.stdout.write(
+            f"Replayed {replay_spool.replayed} messages, dropped {dropped} not routed "
+            f"to a config or on ignored subtopics, {replay_spool.pending} left in the spool"
+        )
@@ -0,0 +1,208 @@
+"""
+Counters and histograms of run-ingest.
+
+Messages are counted when received, ignored or not routed to a config, when
+they fail to decode and when stored, by the class of their subtopic. The time
+to write each batch, the size of the batches and the lag between the
+timestamp in a payload and receiving it are kept as histograms.
+
+run-ingest serves the metrics in the Prometheus text format on --metrics-port,
+see MetricsServer, and prints a summary with its queue statistics.
+"""
+from __future__ import annotations
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Any, Callable, Iterable
+
+if TYPE_CHECKING:
+    from kit_web_ui.models import MqttData
+
+# Subtopics are counted by their first level, any others as `other`
+TOPIC_CLASSES = ('logs', 'state', 'connected', 'camera', 'other')
+
+WRITE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+LAG_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 5, 10, 60, 300, 3600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def topic_class(subtopic: str) -> str:
+    level = subtopic.partition('/')[0]
+    return level if level in TOPIC_CLASSES else 'other'
+
+
+class Histogram:
+    """Counts of observed values in buckets, with the upper bound of each bucket."""
+
+    def __init__(self, buckets: Iterable[float]) -> None:
+        self.buckets = sorted(buckets)
+        # The last count is of values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Return the upper bound of the bucket holding the `q` quantile, inf if above all."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, name: str) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+
+class IngestMetrics:
+    """
+    The counters and histograms of a run-ingest process.
+
+    Updated from the MQTT network thread and the writer threads, so every
+    update holds a lock.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.received = dict.fromkeys(TOPIC_CLASSES, 0)
+        self.stored = dict.fromkeys(TOPIC_CLASSES, 0)
+        # Messages on ignored subtopics, and on topics not under a topic root
+        self.ignored = 0
+        self.unmapped = 0
+        self.decode_failures = 0
+        self.write_seconds = Histogram(WRITE_SECONDS_BUCKETS)
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.lag_seconds = Histogram(LAG_SECONDS_BUCKETS)
+
+    def count_received(self, subtopic: str) -> None:
+        with self._lock:
+            self.received[topic_class(subtopic)] += 1
+
+    def count_ignored(self) -> None:
+        with self._lock:
+            self.ignored += 1
+
+    def count_unmapped(self) -> None:
+        with self._lock:
+            self.unmapped += 1
+
+    def count_decode_failure(self) -> None:
+        with self._lock:
+            self.decode_failures += 1
+
+    def observe_lag(self, seconds: float) -> None:
+        with self._lock:
+            self.lag_seconds.observe(seconds)
+
+    def observe_batch(self, rows: list[MqttData], seconds: float) -> None:
+        """Record a batch of rows written to the database in `seconds`."""
+        classes = [topic_class(row.subtopic) for row in rows]
+        with self._lock:
+            for name in classes:
+                self.stored[name] += 1
+            self.batch_size.observe(len(rows))
+            self.write_seconds.observe(seconds)
+
+    def render(self, gauges: dict[str, float] | None = None) -> str:
+        """
+        Return the metrics in the Prometheus text format.
+
+        `gauges` are added as `kit_ingest_<name>`, such as the queue depth.
+        """
+        lines = []
+        with self._lock:
+            for name, counts, help_text in (
+                ('received', self.received, 'Messages received'),
+                ('stored', self.stored, 'Messages written to the database'),
+            ):
+                metric = f'kit_ingest_messages_{name}_total'
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+                lines += [
+                    f'{metric}{{topic_class="{topic}"}} {count}'
+                    for topic, count in counts.items()
+                ]
+            for name, value, help_text in (
+                ('ignored', self.ignored, 'Messages on ignored subtopics'),
+                ('unmapped', self.unmapped, 'Messages on topics not under a topic root'),
+                ('decode_failures', self.decode_failures, 'Messages that failed to decode'),
+            ):
+                metric = f'kit_ingest_messages_{name}_total'
+                lines += [
+                    f'# HELP {metric} {help_text}',
+                    f'# TYPE {metric} counter',
+                    f'{metric} {value}',
+                ]
+            for name, histogram, help_text in (
+                ('write_seconds', self.write_seconds, 'Time to write a batch'),
+                ('batch_size', self.batch_size, 'Messages written in a batch'),
+                ('lag_seconds', self.lag_seconds, 'Time from a message timestamp to receipt'),
+            ):
+                metric = f'kit_ingest_{name}'
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+                lines += histogram.render(metric)
+        for name, gauge in (gauges or {}).items():
+            lines += [f'# TYPE kit_ingest_{name} gauge', f'kit_ingest_{name} {gauge}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Return a one line summary of the metrics."""
+        with self._lock:
+            return (
+                f"received={sum(self.received.values())} "
+                f"stored={sum(self.stored.values())} ignored={self.ignored} "
+                f"unmapped={self.unmapped} decode_failures={self.decode_failures} "
+                f"write_p99<={self.write_seconds.quantile(0.99)}s "
+                f"batch_size_p50<={self.batch_size.quantile(0.5)} "
+                f"lag_p99<={self.lag_seconds.quantile(0.99)}s"
+            )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    server: MetricsServer
+
+    def do_GET(self) -> None:
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Scrapes aren't logged
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serve the text returned by `render` at /metrics, from a daemon thread once started."""
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, render: Callable[[], str]) -> None:
+        super().__init__((host, port), _MetricsHandler)
+        self.render = render
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, name="ingest-metrics", daemon=True).start()
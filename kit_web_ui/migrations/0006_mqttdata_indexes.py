@@ -0,0 +1,33 @@
+# Generated by Django 4.2.2 on 2026-10-18 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0005_mqttdata'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='mqttdata',
+            options={'default_permissions': (), 'get_latest_by': ['date'], 'ordering': ['-date']},
+        ),
+        migrations.AddIndex(
+            model_name='mqttdata',
+            index=models.Index(fields=['config', 'subtopic', 'run_uuid', 'date'], name='mqttdata_config_run_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mqttdata',
+            index=models.Index(fields=['config', 'subtopic', 'date'], name='mqttdata_config_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mqttdata',
+            index=models.Index(fields=['subtopic', 'config'], name='mqttdata_subtopic_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mqttdata',
+            index=models.Index(condition=models.Q(('payload__state', 'Running'), ('subtopic', 'state')), fields=['config', 'run_uuid', 'date'], name='mqttdata_running_idx'),
+        ),
+    ]
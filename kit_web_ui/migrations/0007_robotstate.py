@@ -0,0 +1,29 @@
+# Generated by Django 4.2.2 on 2026-10-18 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0006_mqttdata_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RobotState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(blank=True, default='', max_length=32)),
+                ('connected', models.BooleanField(default=False)),
+                ('last_seen', models.DateTimeField(blank=True, null=True)),
+                ('run_uuid', models.CharField(blank=True, default='', max_length=32)),
+                ('config', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='robot_state', to='kit_web_ui.mqttconfig')),
+            ],
+            options={
+                'ordering': ['config__team_number'],
+                'default_permissions': (),
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.2 on 2026-10-18 10:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0007_robotstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Run',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_uuid', models.CharField(max_length=32)),
+                ('start', models.DateTimeField(blank=True, null=True)),
+                ('end', models.DateTimeField(blank=True, null=True)),
+                ('final_state', models.CharField(blank=True, default='', max_length=32)),
+                ('log_count', models.IntegerField(default=0)),
+                ('image_count', models.IntegerField(default=0)),
+                ('config', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='kit_web_ui.mqttconfig')),
+            ],
+            options={
+                'ordering': ['start'],
+                'default_permissions': (),
+                'indexes': [models.Index(fields=['config', 'start'], name='run_config_start_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='run',
+            constraint=models.UniqueConstraint(fields=('config', 'run_uuid'), name='run_config_uuid_unique'),
+        ),
+    ]
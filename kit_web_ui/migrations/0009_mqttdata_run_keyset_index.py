@@ -0,0 +1,21 @@
+# Generated by Django 4.2.2 on 2026-10-18 10:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0008_run'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mqttdata',
+            index=models.Index(fields=['config', 'run_uuid', 'subtopic', 'date', 'id'], name='mqttdata_run_keyset_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='mqttdata',
+            name='mqttdata_config_run_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0009_mqttdata_run_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='archived',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:07
+
+from django.db import migrations, models
+import kit_web_ui.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0010_run_archived'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mqttconfig',
+            name='ignored_subtopics',
+            field=models.CharField(blank=True, default='', max_length=500, validators=[kit_web_ui.models.validate_topic_filters]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0011_mqttconfig_ignored_subtopics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='state_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0012_run_state_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='thinned_image_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='thinned_log_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0013_run_thinned_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='robotstate',
+            name='connected_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='robotstate',
+            name='state_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,113 @@
+"""
+Populate the run summaries and robot states from the stored MQTT data.
+
+The Run and RobotState tables were created empty, and are otherwise only
+filled in by run-ingest as new messages arrive or by the rebuild-runs and
+rebuild-robot-state commands. This does the same work as those commands,
+for each table that is still empty, so existing teams and runs are shown
+straight after `migrate`.
+"""
+from django.db import migrations
+from django.db.models import Count, Max, Min, OuterRef, Q, Subquery
+
+
+def populate_runs(apps, schema_editor):  # type: ignore
+    MqttData = apps.get_model('kit_web_ui', 'MqttData')
+    Run = apps.get_model('kit_web_ui', 'Run')
+    if Run.objects.exists():
+        return
+
+    final_state = (
+        MqttData.objects
+        .filter(
+            config=OuterRef('config'),
+            run_uuid=OuterRef('run_uuid'),
+            subtopic='state',
+        )
+        .order_by('-date')
+    )
+    run_data = (
+        MqttData.objects
+        .filter(config__isnull=False)
+        .exclude(run_uuid='')
+        .values('config', 'run_uuid')
+        .annotate(
+            start=Min('date', filter=Q(subtopic='state', payload__state='Running')),
+            end=Max('date'),
+            log_count=Count('pk', filter=Q(subtopic='logs')),
+            image_count=Count('pk', filter=Q(subtopic='camera/annotated')),
+            final_state=Subquery(final_state.values('payload__state')[:1]),
+            state_at=Subquery(final_state.values('date')[:1]),
+        )
+        .order_by()
+    )
+    Run.objects.bulk_create(
+        (
+            Run(
+                config_id=run['config'],
+                run_uuid=run['run_uuid'],
+                start=run['start'],
+                end=run['end'],
+                final_state=run['final_state'] or "",
+                state_at=run['state_at'],
+                log_count=run['log_count'],
+                image_count=run['image_count'],
+            )
+            for run in run_data.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+def populate_robot_states(apps, schema_editor):  # type: ignore
+    MqttConfig = apps.get_model('kit_web_ui', 'MqttConfig')
+    MqttData = apps.get_model('kit_web_ui', 'MqttData')
+    RobotState = apps.get_model('kit_web_ui', 'RobotState')
+    if RobotState.objects.exists():
+        return
+
+    newest_state = (
+        MqttData.objects
+        .filter(config=OuterRef("id"), subtopic='state')
+        .order_by('-date')
+    )
+    newest_connected = (
+        MqttData.objects
+        .filter(config=OuterRef("id"), subtopic='connected')
+        .order_by('-date')
+    )
+    configs = MqttConfig.objects.annotate(
+        latest_state=Subquery(newest_state.values("payload__state")[:1]),
+        latest_run=Subquery(newest_state.values("run_uuid")[:1]),
+        latest_connected=Subquery(newest_connected.values("payload__state")[:1]),
+        state_at=Subquery(newest_state.values("date")[:1]),
+        connected_at=Subquery(newest_connected.values("date")[:1]),
+        last_seen=Max('data__date'),
+    )
+    RobotState.objects.bulk_create([
+        RobotState(
+            config=config,
+            state=config.latest_state or "",
+            connected=(
+                config.latest_connected is not None
+                and config.latest_connected != 'disconnected'
+            ),
+            last_seen=config.last_seen,
+            run_uuid=config.latest_run or "",
+            state_at=config.state_at,
+            connected_at=config.connected_at,
+        )
+        for config in configs
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kit_web_ui', '0014_robotstate_state_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_runs, migrations.RunPython.noop),
+        migrations.RunPython(populate_robot_states, migrations.RunPython.noop),
+    ]
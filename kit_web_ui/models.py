@@ -6,6 +6,7 @@ from django.contrib.auth import (
     user_logged_in, user_logged_out, user_login_failed,
 )
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.dispatch import receiver
 
@@ -44,6 +45,15 @@ class BrokerListener(models.Model):
         return f"{self.name} ({self.generate_url()})"
 
 
+def validate_topic_filters(value: str) -> None:
+    from kit_web_ui.ingest import parse_topic_filters
+
+    try:
+        parse_topic_filters(value)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
 class MqttConfig(models.Model):
     name = models.CharField(max_length=200)
     user = models.OneToOneField(
@@ -54,6 +64,9 @@ class MqttConfig(models.Model):
     password = models.CharField(max_length=200, default="", blank=True)
     topic_root = models.CharField(max_length=200)
     team_number = models.IntegerField(default=100)
+    # Comma separated topic filters below topic_root whose messages run-ingest doesn't store
+    ignored_subtopics = models.CharField(
+        max_length=500, default="", blank=True, validators=[validate_topic_filters])
 
     class Meta:
         ordering = ["team_number", "name"]
@@ -92,6 +105,30 @@ class MqttData(models.Model):
         ordering = ["-date"]
         get_latest_by = ["date"]
         default_permissions = ()
+        indexes = [
+            # A single team's messages for a run in order, i.e. logs, recall and
+            # run bundles. The id allows keyset pagination of messages with equal dates
+            models.Index(
+                fields=["config", "run_uuid", "subtopic", "date", "id"],
+                name="mqttdata_run_keyset_idx",
+            ),
+            # The latest message on a subtopic for each team, i.e. robot state
+            models.Index(
+                fields=["config", "subtopic", "date"],
+                name="mqttdata_config_latest_idx",
+            ),
+            # Messages on a subtopic grouped by team, i.e. image counts
+            models.Index(
+                fields=["subtopic", "config"],
+                name="mqttdata_subtopic_idx",
+            ),
+            # The start of each run
+            models.Index(
+                fields=["config", "run_uuid", "date"],
+                condition=models.Q(subtopic="state", payload__state="Running"),
+                name="mqttdata_running_idx",
+            ),
+        ]
 
     def __str__(self) -> str:
         if self.config is None:
@@ -100,6 +137,63 @@ class MqttData(models.Model):
             return f"{self.date} {self.config.topic_root}/{self.subtopic}"
 
 
+class RobotState(models.Model):
+    """The latest known state of each team's robot, maintained by run-ingest."""
+
+    config = models.OneToOneField(
+        MqttConfig, related_name='robot_state', on_delete=models.CASCADE)
+    state = models.CharField(max_length=32, default="", blank=True)
+    connected = models.BooleanField(default=False)
+    # The newest message of any subtopic
+    last_seen = models.DateTimeField(null=True, blank=True)
+    run_uuid = models.CharField(max_length=32, default="", blank=True)
+    # The dates of the messages that set state and run_uuid, and connected
+    state_at = models.DateTimeField(null=True, blank=True)
+    connected_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["config__team_number"]
+        default_permissions = ()
+
+    def __str__(self) -> str:
+        return f"{self.config} {self.state}"
+
+
+class Run(models.Model):
+    """A summary of each robot run, maintained by run-ingest."""
+
+    config = models.ForeignKey(MqttConfig, related_name='runs', on_delete=models.CASCADE)
+    run_uuid = models.CharField(max_length=32)
+    # When the robot first reported the Running state, unset if it never started
+    start = models.DateTimeField(null=True, blank=True)
+    # The newest message received for the run
+    end = models.DateTimeField(null=True, blank=True)
+    final_state = models.CharField(max_length=32, default="", blank=True)
+    # The date of the state message that set final_state
+    state_at = models.DateTimeField(null=True, blank=True)
+    log_count = models.IntegerField(default=0)
+    image_count = models.IntegerField(default=0)
+    # Messages of the counts removed by a thin retention rule, for rebuild-runs
+    thinned_log_count = models.IntegerField(default=0)
+    thinned_image_count = models.IntegerField(default=0)
+    # The messages of the run have been moved to an archive file, see archive.py
+    archived = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ["start"]
+        default_permissions = ()
+        constraints = [
+            models.UniqueConstraint(
+                fields=["config", "run_uuid"], name="run_config_uuid_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["config", "start"], name="run_config_start_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.config} {self.run_uuid} ({self.start})"
+
+
 class AuditEvent(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -0,0 +1,272 @@
+"""
+Time partitioning of the MqttData table on PostgreSQL.
+
+The table can be converted to one partitioned by range of date, with a
+partition per month or per day in the server's timezone, using the
+partition-mqttdata command. Queries are unchanged, PostgreSQL only scans the
+partitions a query's date filter can match and applies the indexes defined
+on the model to every partition. Old data is removed by dropping whole
+partitions rather than deleting rows.
+
+Partitions are named `<table>_p<YYYYMM>` or `<table>_p<YYYYMMDD>`. A default
+partition holds any rows outside the created partitions, so ingest never
+fails if partitions aren't created in time. Rows are moved out of it when a
+partition covering them is created.
+
+PostgreSQL requires the primary key of a partitioned table to include the
+partition key, so the primary key becomes (id, date). Ids remain unique as
+they are taken from a single sequence.
+"""
+from __future__ import annotations
+
+import re
+from datetime import datetime, timedelta
+from typing import Iterator, NamedTuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from kit_web_ui.models import MqttConfig, MqttData
+
+PARTITION_INTERVALS = ('month', 'day')
+_PARTITION_SUFFIX = re.compile(r'_p(\d{6}|\d{8})')
+
+
+class Partition(NamedTuple):
+    name: str
+    start: datetime
+    end: datetime
+
+
+def table_name() -> str:
+    return MqttData._meta.db_table
+
+
+def default_partition_name() -> str:
+    return f'{table_name()}_default'
+
+
+def check_postgres() -> None:
+    """Raise ValueError unless the database is PostgreSQL."""
+    if connection.vendor != 'postgresql':
+        raise ValueError("Partitioning is only supported on PostgreSQL")
+
+
+def is_partitioned() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [table_name()])
+        (relkind,) = cursor.fetchone()
+    return bool(relkind == 'p')
+
+
+def period_start(date: datetime, interval: str) -> datetime:
+    """Return the start of the month or day containing `date` in the current timezone."""
+    local = timezone.localtime(date)
+    if interval == 'month':
+        start = local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    # Recalculate the offset in case the period starts either side of a DST change
+    return timezone.make_aware(start.replace(tzinfo=None))
+
+
+def next_period(start: datetime, interval: str) -> datetime:
+    if interval == 'month':
+        # The 28th of any month plus 4 days is in the next month
+        return period_start(start.replace(day=28) + timedelta(days=4), interval)
+    return period_start(start + timedelta(days=1, hours=12), interval)
+
+
+def partition_for(start: datetime, interval: str) -> Partition:
+    suffix = f'{start:%Y%m}' if interval == 'month' else f'{start:%Y%m%d}'
+    return Partition(f'{table_name()}_p{suffix}', start, next_period(start, interval))
+
+
+def list_partitions() -> list[Partition]:
+    """Return the date partitions of the table, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = %s::regclass
+            """,
+            [table_name()],
+        )
+        names = [name for (name,) in cursor.fetchall()]
+
+    partitions = []
+    for name in names:
+        match = _PARTITION_SUFFIX.fullmatch(name[len(table_name()):])
+        if not name.startswith(table_name()) or not match:
+            continue
+        suffix = match.group(1)
+        interval = 'month' if len(suffix) == 6 else 'day'
+        start = timezone.make_aware(
+            datetime.strptime(suffix, '%Y%m' if interval == 'month' else '%Y%m%d'))
+        partitions.append(partition_for(start, interval))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def partition_interval() -> str:
+    """Return the interval of the existing partitions, defaulting to month."""
+    partitions = list_partitions()
+    if partitions and len(partitions[0].name) == len(f'{table_name()}_p00000000'):
+        return 'day'
+    return 'month'
+
+
+def _periods(start: datetime, end: datetime, interval: str) -> Iterator[Partition]:
+    period = period_start(start, interval)
+    while period < end:
+        partition = partition_for(period, interval)
+        yield partition
+        period = partition.end
+
+
+def create_partition(partition: Partition) -> bool:
+    """
+    Create a partition if it doesn't exist, returning whether it was created.
+
+    Rows in the default partition within the partition's range are moved into it.
+    """
+    table = connection.ops.quote_name(table_name())
+    name = connection.ops.quote_name(partition.name)
+    default = connection.ops.quote_name(default_partition_name())
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [partition.name])
+        if cursor.fetchone()[0] is not None:
+            return False
+
+        # Created detached so the rows can be moved from the default partition
+        # before attaching, which would otherwise fail
+        cursor.execute(
+            f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM {default} WHERE date >= %s AND date < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """,
+            [partition.start, partition.end],
+        )
+        cursor.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+            [partition.start, partition.end],
+        )
+    return True
+
+
+def create_partitions(start: datetime, end: datetime, interval: str) -> list[Partition]:
+    """Create the partitions covering `start` to `end`, returning those created."""
+    return [
+        partition
+        for partition in _periods(start, end, interval)
+        if create_partition(partition)
+    ]
+
+
+def drop_partitions(before: datetime, dry_run: bool = False) -> list[Partition]:
+    """Drop the partitions only holding data from before `before`, returning them."""
+    dropped = [partition for partition in list_partitions() if partition.end <= before]
+    if dry_run:
+        return dropped
+
+    table = connection.ops.quote_name(table_name())
+    for partition in dropped:
+        name = connection.ops.quote_name(partition.name)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            cursor.execute(f"DROP TABLE {name}")
+    return dropped
+
+
+def convert_table(interval: str, ahead: int = 3) -> list[Partition]:
+    """
+    Convert the table to a partitioned table, copying the existing rows.
+
+    Partitions are created covering the existing rows and `ahead` periods after
+    the current one. This runs in a single transaction which locks the table
+    while the rows are copied, so ingest should be stopped first.
+    Returns the partitions created.
+    """
+    table = table_name()
+    quoted = connection.ops.quote_name(table)
+    old = connection.ops.quote_name(f'{table}_unpartitioned')
+    default = connection.ops.quote_name(default_partition_name())
+    config_table = connection.ops.quote_name(MqttConfig._meta.db_table)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Indexes are recreated with the same names and definitions
+            cursor.execute(
+                """
+                SELECT indexdef FROM pg_indexes
+                WHERE tablename = %s AND indexname <> %s
+                """,
+                [table, f'{table}_pkey'],
+            )
+            index_definitions = [definition for (definition,) in cursor.fetchall()]
+            cursor.execute(f"SELECT min(date) FROM {quoted}")
+            (first_date,) = cursor.fetchone()
+
+            cursor.execute(f"ALTER TABLE {quoted} RENAME TO {old}")
+            cursor.execute(
+                f"""
+                CREATE TABLE {quoted} (
+                    id bigint GENERATED BY DEFAULT AS IDENTITY,
+                    date timestamp with time zone NOT NULL,
+                    subtopic varchar(200) NOT NULL,
+                    payload jsonb NOT NULL,
+                    run_uuid varchar(32) NOT NULL,
+                    config_id bigint NULL REFERENCES {config_table} (id)
+                        ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED
+                ) PARTITION BY RANGE (date)
+                """
+            )
+            cursor.execute(f"CREATE TABLE {default} PARTITION OF {quoted} DEFAULT")
+
+        now = timezone.now()
+        created = create_partitions(
+            first_date or now,
+            _periods_after(now, interval, ahead),
+            interval,
+        )
+
+        with connection.cursor() as cursor:
+            # Indexes are built after copying the rows, which is faster than
+            # updating them for each row
+            cursor.execute(
+                f"""
+                INSERT INTO {quoted} (id, date, subtopic, payload, run_uuid, config_id)
+                SELECT id, date, subtopic, payload, run_uuid, config_id FROM {old}
+                """
+            )
+            cursor.execute(f"DROP TABLE {old}")
+            cursor.execute(f"ALTER TABLE {quoted} ADD PRIMARY KEY (id, date)")
+            for definition in index_definitions:
+                cursor.execute(definition)
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                f"coalesce((SELECT max(id) FROM {quoted}), 0) + 1, false)",
+                [table],
+            )
+
+    return created
+
+
+def _periods_after(now: datetime, interval: str, ahead: int) -> datetime:
+    end = partition_for(period_start(now, interval), interval).end
+    for _ in range(ahead):
+        end = next_period(end, interval)
+    return end
+
+
+def create_ahead(ahead: int = 3) -> list[Partition]:
+    """Create any missing partitions for the current and next `ahead` periods."""
+    interval = partition_interval()
+    now = timezone.now()
+    return create_partitions(now, _periods_after(now, interval, ahead), interval)
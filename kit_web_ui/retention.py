@@ -0,0 +1,282 @@
+"""
+Retention policies for stored MQTT data, applied by the apply-retention command.
+
+A policy is a JSON list of rules, applied in order. Each rule has an `action`,
+the age in days of the data it applies to (`older_than_days`) and, except for
+archive rules, a `subtopic` glob pattern (default `*`):
+
+- `delete`: delete matching rows.
+- `thin`: keep at most one matching row per `interval` seconds in each run and
+  subtopic. The first and last row of each are always kept, and the state and
+  connected subtopics are never thinned so run boundaries are preserved. The
+  logs and images removed are counted on the run, so rebuild-runs keeps them.
+- `archive`: move every row of runs with no messages in the period to a per-run
+  archive file, see archive.py. Rows without a run are left in the database.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+from django.db import transaction
+from django.db.models import F, QuerySet
+from django.utils import timezone
+
+from kit_web_ui.archive import ArchivedRow, archive_path, write_archive
+from kit_web_ui.models import MqttData, Run
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ACTIONS = ('delete', 'thin', 'archive')
+# Subtopics that thinning would lose run boundaries or robot state from
+UNTHINNED_SUBTOPICS = ('state', 'connected')
+# The Run fields counting the thinned rows of the subtopics in its counts
+THINNED_COUNT_FIELDS = {
+    'logs': 'thinned_log_count',
+    'camera/annotated': 'thinned_image_count',
+}
+
+
+class RetentionRule(NamedTuple):
+    action: str
+    older_than_days: float
+    subtopic: str = '*'
+    # Seconds between kept rows when thinning
+    interval: float = 0
+
+    def __str__(self) -> str:
+        if self.action == 'archive':
+            return f"archive runs older than {self.older_than_days} days"
+        description = f"{self.action} {self.subtopic} older than {self.older_than_days} days"
+        if self.action == 'thin':
+            description += f" to one per {self.interval} s"
+        return description
+
+    def cutoff(self, now: datetime) -> datetime:
+        return now - timedelta(days=self.older_than_days)
+
+
+def load_policy(path: str | Path) -> list[RetentionRule]:
+    """Load the rules of a policy file, raises ValueError if it is invalid."""
+    try:
+        with open(path) as policy_file:
+            data = json.load(policy_file)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Unable to read retention policy {path}: {e}")
+
+    if not isinstance(data, list):
+        raise ValueError("A retention policy must be a list of rules")
+
+    rules = []
+    for num, rule_data in enumerate(data, 1):
+        try:
+            rule = RetentionRule(
+                action=rule_data['action'],
+                older_than_days=float(rule_data['older_than_days']),
+                subtopic=rule_data.get('subtopic', '*'),
+                interval=float(rule_data.get('interval', 0)),
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid retention rule {num}: {e!r}")
+
+        if rule.action not in RETENTION_ACTIONS:
+            raise ValueError(f"Invalid retention rule {num}: unknown action {rule.action!r}")
+        if rule.older_than_days < 0:
+            raise ValueError(f"Invalid retention rule {num}: older_than_days is negative")
+        if rule.action == 'thin' and rule.interval <= 0:
+            raise ValueError(f"Invalid retention rule {num}: thin requires an interval")
+        if rule.action == 'archive' and 'subtopic' in rule_data:
+            raise ValueError(f"Invalid retention rule {num}: archive applies to whole runs")
+        rules.append(rule)
+
+    return rules
+
+
+def matching_subtopics(pattern: str) -> list[str]:
+    """Return the stored subtopics matching a glob pattern."""
+    subtopics = MqttData.objects.order_by().values_list('subtopic', flat=True).distinct()
+    return [subtopic for subtopic in subtopics if fnmatchcase(subtopic, pattern)]
+
+
+def _delete_thinned(
+    config_id: int | None,
+    rows: list[tuple[int, str, str]],
+    batch_size: int,
+) -> int:
+    deleted = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        thinned: dict[str, dict[str, int]] = {}
+        for _, run_uuid, subtopic in batch:
+            field = THINNED_COUNT_FIELDS.get(subtopic)
+            if field is not None and run_uuid:
+                run_counts = thinned.setdefault(run_uuid, {})
+                run_counts[field] = run_counts.get(field, 0) + 1
+
+        with transaction.atomic():
+            deleted += MqttData.objects.filter(id__in=[row[0] for row in batch]).delete()[0]
+            for run_uuid, run_counts in thinned.items():
+                Run.objects.filter(config_id=config_id, run_uuid=run_uuid).update(**{
+                    field: F(field) + count for field, count in run_counts.items()
+                })
+    return deleted
+
+
+def delete_rows(
+    rule: RetentionRule,
+    now: datetime,
+    batch_size: int = 1000,
+    dry_run: bool = False,
+) -> int:
+    """Delete the rows matching a delete rule, returning the number of rows deleted."""
+    rows = MqttData.objects.filter(
+        subtopic__in=matching_subtopics(rule.subtopic),
+        date__lt=rule.cutoff(now),
+    )
+    if dry_run:
+        return rows.count()
+
+    # Deleted in batches to keep each transaction short while ingest is writing
+    deleted = 0
+    while True:
+        ids = list(rows.order_by().values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += MqttData.objects.filter(id__in=ids).delete()[0]
+
+
+def _thinned_rows(
+    rows: QuerySet[MqttData],
+    interval: timedelta,
+) -> Iterator[tuple[int, str, str]]:
+    # Rows are ordered by run, subtopic and date. The row before a change of
+    # group is the last of its group, so whether to delete a row is only
+    # decided once the next row is seen.
+    group = None
+    last_kept = None
+    pending = None
+    for row_id, run_uuid, subtopic, date in rows.values_list(
+        'id', 'run_uuid', 'subtopic', 'date',
+    ).iterator(chunk_size=5000):
+        if (run_uuid, subtopic) != group:
+            # The pending row is the last of its group and is kept
+            group = (run_uuid, subtopic)
+            last_kept = date
+            pending = None
+            continue
+
+        if pending is not None:
+            yield pending
+            pending = None
+
+        if last_kept is not None and date - last_kept < interval:
+            pending = (row_id, run_uuid, subtopic)
+        else:
+            last_kept = date
+
+
+def thin_rows(
+    rule: RetentionRule,
+    now: datetime,
+    batch_size: int = 1000,
+    dry_run: bool = False,
+) -> int:
+    """Thin the rows matching a thin rule, returning the number of rows deleted."""
+    subtopics = [
+        subtopic for subtopic in matching_subtopics(rule.subtopic)
+        if subtopic not in UNTHINNED_SUBTOPICS
+    ]
+    interval = timedelta(seconds=rule.interval)
+    config_ids = (
+        MqttData.objects
+        .order_by()
+        .values_list('config_id', flat=True)
+        .distinct()
+    )
+
+    deleted = 0
+    # One team at a time to bound the rows held in memory
+    for config_id in config_ids:
+        rows = (
+            MqttData.objects
+            .filter(
+                config_id=config_id,
+                subtopic__in=subtopics,
+                date__lt=rule.cutoff(now),
+            )
+            .order_by('run_uuid', 'subtopic', 'date', 'id')
+        )
+        thinned = list(_thinned_rows(rows, interval))
+        if dry_run:
+            deleted += len(thinned)
+        else:
+            deleted += _delete_thinned(config_id, thinned, batch_size)
+    return deleted
+
+
+def archive_runs(
+    rule: RetentionRule,
+    now: datetime,
+    dry_run: bool = False,
+) -> int:
+    """Archive the runs matching an archive rule, returning the number of rows archived."""
+    runs = (
+        Run.objects
+        .filter(archived=False, end__lt=rule.cutoff(now))
+        .exclude(run_uuid='')
+        .values_list('pk', 'config_id', 'run_uuid')
+    )
+
+    archived = 0
+    for run_id, config_id, run_uuid in runs:
+        try:
+            path = archive_path(config_id, run_uuid)
+        except ValueError as e:
+            logger.warning(f"Not archiving run: {e}")
+            continue
+
+        rows = MqttData.objects.filter(config_id=config_id, run_uuid=run_uuid)
+        if dry_run:
+            archived += rows.count()
+            continue
+
+        last_id = 0
+
+        def archive_rows() -> Iterator[ArchivedRow]:
+            nonlocal last_id
+            for row in rows.order_by('date', 'id').values_list(
+                'id', 'date', 'subtopic', 'payload',
+            ).iterator(chunk_size=2000):
+                last_id = max(last_id, row[0])
+                yield ArchivedRow(*row)
+
+        count = write_archive(path, archive_rows())
+        with transaction.atomic():
+            # Rows received while the archive was written stay in the database
+            rows.filter(id__lte=last_id).delete()
+            Run.objects.filter(pk=run_id).update(archived=True)
+        archived += count
+
+    return archived
+
+
+def apply_rule(
+    rule: RetentionRule,
+    now: datetime | None = None,
+    batch_size: int = 1000,
+    dry_run: bool = False,
+) -> int:
+    """Apply a retention rule, returning the number of rows removed from the database."""
+    if now is None:
+        now = timezone.now()
+
+    if rule.action == 'delete':
+        return delete_rows(rule, now, batch_size=batch_size, dry_run=dry_run)
+    elif rule.action == 'thin':
+        return thin_rows(rule, now, batch_size=batch_size, dry_run=dry_run)
+    else:
+        return archive_runs(rule, now, dry_run=dry_run)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 from os import environ
 from pathlib import Path
+from typing import Any
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -66,6 +67,7 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'kit_web_ui.wsgi.application'
 
+DATABASES: dict[str, dict[str, Any]]
 if environ.get('USE_POSTGRES', default="false").lower() == "true":
     DATABASES = {
         "default": {
@@ -82,9 +84,42 @@ else:
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': BASE_DIR / 'db.sqlite3',
+            # On disk, so the run-ingest processes started by the tests can open it
+            'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
         }
     }
 
+# Keep connections open for reuse by later requests and run-ingest batches for this
+# many seconds, empty to keep them open indefinitely or 0 to close them after each.
+# A reused connection is checked before use so one broken by a database restart
+# is replaced rather than failing the request.
+DATABASES['default']['CONN_MAX_AGE'] = (
+    int(environ.get("DB_CONN_MAX_AGE", "60")) if environ.get("DB_CONN_MAX_AGE", "60") else None
+)
+DATABASES['default']['CONN_HEALTH_CHECKS'] = (
+    environ.get('DB_CONN_HEALTH_CHECKS', default="true").lower() == "true"
+)
+
+# Pragmas run on each new SQLite connection, see kit_web_ui/db.py
+SQLITE_PRAGMAS: dict[str, str | int] = {}
+
+if DATABASES['default']['ENGINE'].endswith('sqlite3') and (
+    environ.get('SQLITE_TUNED', default="false").lower() == "true"
+):
+    # Tuned for run-ingest and the web server processes sharing the database on one machine.
+    # In WAL mode readers don't block the writer, and synchronous=NORMAL only syncs to disk
+    # at checkpoints, which may lose the last transactions on power loss but not corrupt.
+    # Waits up to 20 seconds for the write lock rather than failing immediately.
+    DATABASES['default']['OPTIONS'] = {'timeout': 20}
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 20000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -32000,
+        'temp_store': 'MEMORY',
+    }
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -116,8 +151,48 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-KIT_UI = {
+# Cache for the data computed by the dashboard and summary views, see kit_web_ui/cache.py.
+# CACHE_BACKEND is one of locmem, file or redis, with CACHE_LOCATION being the directory
+# or redis URL respectively. The file and redis caches are shared by all web server
+# processes and run-ingest, so values are invalidated as soon as new data is written.
+# The local-memory cache is per process and needs no setup, as for development and testing.
+CACHES = {
+    "default": {
+        "BACKEND": {
+            "locmem": "django.core.cache.backends.locmem.LocMemCache",
+            "file": "django.core.cache.backends.filebased.FileBasedCache",
+            "redis": "django.core.cache.backends.redis.RedisCache",
+        }.get(
+            environ.get("CACHE_BACKEND", "locmem").lower(),
+            "django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": environ.get("CACHE_LOCATION", ""),
+        "KEY_PREFIX": "kit_web_ui",
+    }
+}
+
+KIT_UI: dict[str, Any] = {
     "WORDLIST": environ.get("WORDLIST", ''),
+    # Where apply-retention writes archived runs
+    "ARCHIVE_DIR": environ.get("ARCHIVE_DIR", str(BASE_DIR / 'archive')),
+    # The default policy file of apply-retention, see retention.example.json
+    "RETENTION_POLICY": environ.get("RETENTION_POLICY", ''),
+    # Where run-ingest stores camera frames, see kit_web_ui/frames.py
+    "FRAME_DIR": environ.get("FRAME_DIR", str(BASE_DIR / 'frames')),
+    # Store camera frames, otherwise only a tag is stored for each image
+    "STORE_FRAMES": environ.get("STORE_FRAMES", "true").lower() == "true",
+    # The write-ahead spool of run-ingest, see kit_web_ui/spool.py, disabled if empty
+    "SPOOL_DIR": environ.get("INGEST_SPOOL_DIR", ''),
+    # Subtopic filters whose messages run-ingest doesn't store for any topic root
+    "INGEST_IGNORE_SUBTOPICS": [
+        topic_filter.strip()
+        for topic_filter in environ.get("INGEST_IGNORE_SUBTOPICS", '').split(',')
+        if topic_filter.strip()
+    ],
+    # Port run-ingest serves its metrics on, disabled if 0, see kit_web_ui/metrics.py
+    "METRICS_PORT": int(environ.get("INGEST_METRICS_PORT", "0")),
+    # Number of run-ingest processes started by run-ingest-shards
+    "INGEST_SHARDS": int(environ.get("INGEST_SHARDS", "2")),
 }
 
 MQTT_BROKER = {
@@ -130,4 +205,17 @@ MQTT_BROKER = {
         'false': False,
         'insecure': 'insecure',
     }.get(environ.get("MQTT_BROKER_USE_TLS", "false").lower(), False),
+}
+
+# run-ingest publishes the robot states as retained messages under TOPIC,
+# set it to an empty string to disable publishing.
+# When URL is set the status page subscribes to them over websockets,
+# with credentials that only need read access to TOPIC, instead of polling.
+MQTT_STATUS_FEED = {
+    "TOPIC": environ.get("MQTT_STATUS_TOPIC", "kit-web-ui/status"),
+    "URL": environ.get("MQTT_STATUS_URL", ""),
+    "USERNAME": environ.get("MQTT_STATUS_USERNAME", ""),
+    "PASSWORD": environ.get("MQTT_STATUS_PASSWORD", ""),
+    # Subresource integrity hash of the MQTT.js script the status page loads from jsDelivr
+    "SCRIPT_INTEGRITY": environ.get("MQTT_STATUS_SCRIPT_INTEGRITY", ""),
 }
\ No newline at end of file
@@ -0,0 +1,503 @@
+"""
+Write-ahead spool of received MQTT messages for run-ingest.
+
+Each message is appended to the spool before it is queued for the writers,
+and acknowledged once the batch it is in has been written to the database.
+Messages that can't be queued, such as while the database is unreachable,
+are left in the spool and put back on the queue by a SpoolReplayer once the
+writers have caught up, at a limited rate. Messages in the spool that were
+never acknowledged, such as after ingest was killed, are replayed when
+ingest next starts.
+
+The spool is a directory of numbered segments. A segment is made of two
+append-only files:
+- `<number>.log`: the messages, each a header of the topic length, payload
+  length, received time and CRC32, followed by the topic and payload
+- `<number>.ack`: the record number of each acknowledged message in the log
+A new segment is started once the current one reaches `segment_size` bytes.
+A segment's files are deleted once every message in it is acknowledged.
+Messages that were decoded but couldn't be written to the database, such as
+with a value too long for its column, are rejected: they are appended to
+`rejected.log`, in the same format as a segment log, and acknowledged, so
+they aren't retried forever. See the spool command to list them.
+
+Appends are buffered and synced to disk every `sync_interval` seconds by
+`run_sync`, so one fsync covers every message received in that time. A crash
+can lose the messages received since the last sync, and messages
+acknowledged since the last sync are written to the database again.
+
+Only one process can use a spool directory at a time, see the spool command
+to inspect or replay a spool while ingest isn't running.
+"""
+from __future__ import annotations
+
+import fcntl
+import heapq
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple
+
+from kit_web_ui.ingest import IngestQueue, RawMessage
+
+logger = logging.getLogger(__name__)
+
+# Topic length, payload length, received time and CRC32 of the topic and payload
+RECORD_HEADER = struct.Struct('>IIdI')
+ACK_RECORD = struct.Struct('>I')
+# Messages that couldn't be written, not a segment so they aren't replayed
+REJECTED_NAME = 'rejected.log'
+
+
+class SegmentInfo(NamedTuple):
+    number: int
+    messages: int
+    acknowledged: int
+    size: int
+
+    @property
+    def pending(self) -> int:
+        return self.messages - self.acknowledged
+
+
+def _segment_number(path: Path) -> int | None:
+    try:
+        return int(path.stem)
+    except ValueError:
+        return None
+
+
+def log_path(directory: Path, number: int) -> Path:
+    return directory / f'{number:010d}.log'
+
+
+def ack_path(directory: Path, number: int) -> Path:
+    return directory / f'{number:010d}.ack'
+
+
+def segment_numbers(directory: str | Path) -> list[int]:
+    """Return the numbers of the segments in a spool directory, oldest first."""
+    numbers = (_segment_number(path) for path in Path(directory).glob('*.log'))
+    return sorted(number for number in numbers if number is not None)
+
+
+def encode_record(message: RawMessage) -> bytes:
+    topic = message.topic.encode('utf-8')
+    data = topic + message.payload
+    return RECORD_HEADER.pack(len(topic), len(message.payload), message.received,
+                              zlib.crc32(data)) + data
+
+
+class Record(NamedTuple):
+    offset: int
+    end: int
+    message: RawMessage
+
+
+def read_records(path: Path, offset: int = 0) -> Iterator[Record]:
+    """
+    Yield each record in a segment log with its start and end offsets.
+
+    Reading stops at the first incomplete or corrupt record, which is the
+    end of the log unless it was being written when ingest stopped.
+    The spool position of the messages isn't set.
+    """
+    with open(path, 'rb') as log:
+        log.seek(offset)
+        while True:
+            header = log.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            topic_length, payload_length, received, crc = RECORD_HEADER.unpack(header)
+            data = log.read(topic_length + payload_length)
+            if len(data) < topic_length + payload_length or zlib.crc32(data) != crc:
+                return
+            end = offset + RECORD_HEADER.size + len(data)
+            yield Record(offset, end, RawMessage(
+                data[:topic_length].decode('utf-8', errors='replace'),
+                data[topic_length:],
+                received,
+            ))
+            offset = end
+
+
+def read_acks(path: Path) -> set[int]:
+    """Return the acknowledged record numbers of a segment."""
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return set()
+    # An incomplete record at the end is ignored
+    end = len(data) - len(data) % ACK_RECORD.size
+    return {record for (record,) in ACK_RECORD.iter_unpack(data[:end])}
+
+
+def segment_info(directory: str | Path, number: int) -> SegmentInfo:
+    directory = Path(directory)
+    path = log_path(directory, number)
+    messages = sum(1 for _ in read_records(path))
+    acks = read_acks(ack_path(directory, number))
+    return SegmentInfo(number, messages, len(acks), path.stat().st_size)
+
+
+def iter_pending(directory: str | Path, number: int) -> Iterator[RawMessage]:
+    """Yield the messages of a segment that haven't been acknowledged."""
+    directory = Path(directory)
+    acks = read_acks(ack_path(directory, number))
+    for record, (_, _, message) in enumerate(read_records(log_path(directory, number))):
+        if record not in acks:
+            yield message
+
+
+class _Segment:
+    """The state of one segment of an open spool."""
+
+    def __init__(self, directory: Path, number: int) -> None:
+        self.number = number
+        self.log_path = log_path(directory, number)
+        self.ack_path = ack_path(directory, number)
+        # Records written, and the end of the last complete record
+        self.count = 0
+        self.size = 0
+        self.acked: set[int] = set()
+        # Messages on the queue or being written
+        self.in_flight: set[int] = set()
+        # Messages that weren't queued, as (record, offset), behind the replay cursor
+        self.released: list[tuple[int, int]] = []
+        # The next record to consider replaying and its offset
+        self.replay_record = 0
+        self.replay_offset = 0
+        self.log: BinaryIO | None = None
+        self.ack: BinaryIO | None = None
+
+    @property
+    def complete(self) -> bool:
+        return len(self.acked) >= self.count
+
+    def load(self) -> None:
+        """Read back a segment left by a previous run, truncating any incomplete record."""
+        for _, end, _ in read_records(self.log_path):
+            self.count += 1
+            self.size = end
+        if self.log_path.stat().st_size != self.size:
+            logger.warning(f"Truncating incomplete record at the end of {self.log_path}")
+            os.truncate(self.log_path, self.size)
+        self.acked = read_acks(self.ack_path)
+
+    def remove(self) -> None:
+        for file in (self.log, self.ack):
+            if file is not None:
+                file.close()
+        self.log_path.unlink(missing_ok=True)
+        self.ack_path.unlink(missing_ok=True)
+
+
+class Spool:
+    """
+    An open spool directory, see the module docstring.
+
+    Raises ValueError if the directory is in use by another process.
+    """
+
+    def __init__(self, directory: str | Path, segment_size: int = 64 * 1024 * 1024) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+
+        self._lock_file = open(self.directory / 'lock', 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise ValueError(f"The spool {self.directory} is in use by another process")
+
+        self._lock = threading.Lock()
+        self._segments: dict[int, _Segment] = {}
+        for number in segment_numbers(self.directory):
+            segment = _Segment(self.directory, number)
+            segment.load()
+            if segment.complete:
+                segment.remove()
+            else:
+                self._segments[number] = segment
+        self.recovered = sum(
+            segment.count - len(segment.acked) for segment in self._segments.values())
+
+        self.appended = 0
+        self.replayed = 0
+        self.rejected = 0
+        self._rejected_file: BinaryIO | None = None
+        self.syncs = 0
+        self._dirty: set[int] = set()
+        self._active = self._open_segment(max(self._segments, default=0) + 1)
+
+    def _open_segment(self, number: int) -> _Segment:
+        segment = _Segment(self.directory, number)
+        segment.log = open(segment.log_path, 'ab')
+        segment.ack = open(segment.ack_path, 'ab')
+        self._segments[number] = segment
+        # Make the new files durable in the directory
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return segment
+
+    def append(self, message: RawMessage) -> RawMessage:
+        """Append a message, returning it with its spool position set."""
+        record = encode_record(message)
+
+        with self._lock:
+            segment = self._active
+            if segment.size and segment.size + len(record) > self.segment_size:
+                segment = self._rotate()
+            assert segment.log is not None
+            segment.log.write(record)
+            position = (segment.number, segment.count, segment.size)
+            segment.count += 1
+            segment.size += len(record)
+            segment.in_flight.add(position[1])
+            self._dirty.add(segment.number)
+            self.appended += 1
+        return message._replace(spool_position=position)
+
+    def _rotate(self) -> _Segment:
+        old = self._active
+        self._sync_segment(old)
+        for file in (old.log, old.ack):
+            if file is not None:
+                file.close()
+        old.log = old.ack = None
+        self._dirty.discard(old.number)
+        self._active = self._open_segment(old.number + 1)
+        if old.complete:
+            self._remove(old)
+        return self._active
+
+    def _remove(self, segment: _Segment) -> None:
+        segment.remove()
+        del self._segments[segment.number]
+
+    def ack(self, messages: list[RawMessage]) -> None:
+        """Mark messages as written, removing segments once all their messages are."""
+        with self._lock:
+            for message in messages:
+                if message.spool_position is None:
+                    continue
+                number, record, _ = message.spool_position
+                segment = self._segments.get(number)
+                if segment is None or record in segment.acked:
+                    continue
+                segment.in_flight.discard(record)
+                segment.acked.add(record)
+                if segment.complete and segment is not self._active:
+                    self._remove(segment)
+                    continue
+
+                if segment.ack is None:
+                    segment.ack = open(segment.ack_path, 'ab')
+                segment.ack.write(ACK_RECORD.pack(record))
+                self._dirty.add(number)
+
+    def reject(self, messages: list[RawMessage]) -> None:
+        """Move messages that couldn't be written to the rejected file and acknowledge them."""
+        messages = [message for message in messages if message.spool_position is not None]
+        if not messages:
+            return
+        records = b''.join(encode_record(message) for message in messages)
+        with self._lock:
+            if self._rejected_file is None:
+                self._rejected_file = open(self.directory / REJECTED_NAME, 'ab')
+            self._rejected_file.write(records)
+            # Rejections are rare, and must be on disk before the acknowledgements
+            self._rejected_file.flush()
+            os.fsync(self._rejected_file.fileno())
+            self.rejected += len(messages)
+        self.ack(messages)
+
+    def release(self, messages: list[RawMessage]) -> None:
+        """Mark messages that weren't queued, so they are replayed."""
+        with self._lock:
+            for message in messages:
+                if message.spool_position is None:
+                    continue
+                number, record, offset = message.spool_position
+                segment = self._segments.get(number)
+                if segment is None or record not in segment.in_flight:
+                    continue
+                segment.in_flight.discard(record)
+                if record < segment.replay_record:
+                    heapq.heappush(segment.released, (record, offset))
+
+    def take(self, limit: int) -> list[RawMessage]:
+        """Return up to `limit` of the oldest messages to replay, marking them in flight."""
+        messages: list[RawMessage] = []
+        with self._lock:
+            for number in sorted(self._segments):
+                if len(messages) >= limit:
+                    break
+                segment = self._segments[number]
+                if segment.log is not None:
+                    # Replay can read the records appended to the active segment
+                    segment.log.flush()
+                messages.extend(self._take_from(segment, limit - len(messages)))
+            self.replayed += len(messages)
+        return messages
+
+    def _take_from(self, segment: _Segment, limit: int) -> list[RawMessage]:
+        messages: list[RawMessage] = []
+        while segment.released and len(messages) < limit:
+            record, offset = heapq.heappop(segment.released)
+            if record in segment.acked or record in segment.in_flight:
+                continue
+            message = next(read_records(segment.log_path, offset)).message
+            segment.in_flight.add(record)
+            messages.append(message._replace(
+                spool_position=(segment.number, record, offset)))
+
+        if segment.replay_record >= segment.count or len(messages) >= limit:
+            return messages
+
+        for offset, end, message in read_records(segment.log_path, segment.replay_offset):
+            if segment.replay_record >= segment.count or len(messages) >= limit:
+                break
+            record = segment.replay_record
+            segment.replay_record += 1
+            segment.replay_offset = end
+            if record in segment.acked or record in segment.in_flight:
+                continue
+            segment.in_flight.add(record)
+            messages.append(message._replace(spool_position=(segment.number, record, offset)))
+        return messages
+
+    def _sync_segment(self, segment: _Segment) -> None:
+        for file in (segment.log, segment.ack):
+            if file is not None:
+                file.flush()
+                os.fsync(file.fileno())
+
+    def sync(self) -> None:
+        """Write the buffered appends and acknowledgements to disk."""
+        with self._lock:
+            files = []
+            for number in self._dirty:
+                segment = self._segments.get(number)
+                if segment is None:
+                    continue
+                for file in (segment.log, segment.ack):
+                    if file is not None:
+                        file.flush()
+                        # Synced outside the lock, so appends aren't blocked by the disk
+                        files.append(os.dup(file.fileno()))
+            self._dirty.clear()
+
+        for fd in files:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if files:
+            self.syncs += 1
+
+    def run_sync(self, interval: float, stop: threading.Event) -> None:
+        """Sync every `interval` seconds until `stop` is set, for a background thread."""
+        while not stop.wait(interval):
+            try:
+                self.sync()
+            except OSError:
+                logger.exception("Failed to sync the spool")
+
+    @property
+    def pending(self) -> int:
+        """The number of messages not yet acknowledged, including those in flight."""
+        with self._lock:
+            return sum(
+                segment.count - len(segment.acked) for segment in self._segments.values())
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            segments = len(self._segments)
+        return {
+            'pending': self.pending,
+            'segments': segments,
+            'appended': self.appended,
+            'replayed': self.replayed,
+            'rejected': self.rejected,
+            'syncs': self.syncs,
+        }
+
+    def close(self) -> None:
+        """Sync and close the spool, once nothing else is using it."""
+        with self._lock:
+            for segment in list(self._segments.values()):
+                self._sync_segment(segment)
+                for file in (segment.log, segment.ack):
+                    if file is not None:
+                        file.close()
+                segment.log = segment.ack = None
+                if segment.complete:
+                    self._remove(segment)
+            if self._rejected_file is not None:
+                self._rejected_file.close()
+                self._rejected_file = None
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+
+class SpoolReplayer(threading.Thread):
+    """
+    Put messages left in a spool back on the ingest queue.
+
+    Every `interval` seconds, while the queue is less than half full, up to
+    `rate` messages a second are taken from the spool, oldest first. The
+    queue only empties while the writers can reach the database, so replay
+    waits for the database to be healthy. With `drain`, the thread exits
+    once the spool has nothing left to replay.
+    """
+
+    def __init__(
+        self,
+        spool: Spool,
+        queue: IngestQueue,
+        rate: float = 1000,
+        interval: float = 1.0,
+        drain: bool = False,
+        name: str = "ingest-replay",
+    ) -> None:
+        super().__init__(name=name, daemon=True)
+        self.spool = spool
+        self.queue = queue
+        self.rate = rate
+        self.interval = interval
+        self.drain = drain
+        self.stop = threading.Event()
+
+    def run(self) -> None:
+        # Messages allowed by the rate limit, up to an interval's worth
+        allowance = 0.0
+        last = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if self.rate > 0:
+                allowance = min(
+                    allowance + self.rate * (now - last), self.rate * self.interval)
+            else:
+                allowance = self.queue.maxsize
+            last = now
+
+            room = self.queue.free - self.queue.maxsize // 2
+            limit = min(room, int(allowance))
+            messages = self.spool.take(limit) if limit > 0 else []
+            allowance -= len(messages)
+            for message in messages:
+                self.queue.put(message)
+
+            if self.drain and limit > 0 and not messages:
+                return
+            if self.stop.wait(self.interval):
+                return
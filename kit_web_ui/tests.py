@@ -1,3 +1,430 @@
-from django.test import TestCase  # noqa: F401
+from __future__ import annotations
 
-# Create your tests here.
+import base64
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, cast
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import (
+    SimpleTestCase, TestCase, TransactionTestCase, override_settings,
+)
+
+from kit_web_ui import spool
+from kit_web_ui.frames import CAMERA_TAG, payload_image, store_payload
+from kit_web_ui.ingest import IngestQueue, RawMessage, TopicRouter, _write_rows
+from kit_web_ui.models import MqttConfig, MqttData, RobotState, Run
+from kit_web_ui.retention import RetentionRule, thin_rows
+from kit_web_ui.utils import get_image_counts, get_robot_state
+
+SETTINGS_MODULE = """\
+from {settings} import *  # noqa: F401,F403
+
+DATABASES['default']['NAME'] = {name!r}
+"""
+
+
+def create_team(team: int, topic_root: str | None = None) -> MqttConfig:
+    topic_root = topic_root or f"team{team}"
+    return MqttConfig.objects.create(
+        name=f"Team {team}", user=User.objects.create_user(f"user-{topic_root}"),
+        username=topic_root, topic_root=topic_root, team_number=team,
+    )
+
+
+def make_row(
+    config: MqttConfig,
+    subtopic: str,
+    timestamp: float,
+    run_uuid: str = '',
+    **payload: Any,
+) -> MqttData:
+    return MqttData(
+        date=datetime.fromtimestamp(timestamp, timezone.utc), config=config,
+        subtopic=subtopic, payload=payload, run_uuid=run_uuid,
+    )
+
+
+def write_batch(rows: list[MqttData]) -> None:
+    """Write rows as a BatchWriter does."""
+    with transaction.atomic():
+        _write_rows(rows)
+
+
+def raw_message(num: int) -> RawMessage:
+    return RawMessage(f"team1/logs/{num}", b'{"message": "test"}', float(num))
+
+
+class RobotStateTest(TestCase):
+    """Batches may be committed out of order, the newest messages must win."""
+
+    def setUp(self) -> None:
+        self.config = create_team(1)
+
+    def test_older_batch_sets_state_newer_than_stored(self) -> None:
+        write_batch([
+            make_row(self.config, 'connected', 100, state='connected'),
+            make_row(self.config, 'logs', 111, 'run1', message='log'),
+        ])
+        write_batch([make_row(self.config, 'state', 110, 'run1', state='Running')])
+
+        robot_state = RobotState.objects.get(config=self.config)
+        self.assertEqual(robot_state.state, 'Running')
+        self.assertEqual(robot_state.run_uuid, 'run1')
+        self.assertTrue(robot_state.connected)
+        self.assertEqual(robot_state.last_seen, datetime.fromtimestamp(111, timezone.utc))
+        self.assertEqual(get_robot_state(), {'Team 1': 'Running'})
+
+    def test_older_batch_doesnt_replace_newer_state(self) -> None:
+        write_batch([
+            make_row(self.config, 'state', 120, 'run1', state='Finished'),
+            make_row(self.config, 'connected', 120, state='disconnected'),
+        ])
+        write_batch([
+            make_row(self.config, 'connected', 100, state='connected'),
+            make_row(self.config, 'state', 110, 'run1', state='Running'),
+        ])
+
+        robot_state = RobotState.objects.get(config=self.config)
+        self.assertEqual(robot_state.state, 'Finished')
+        self.assertFalse(robot_state.connected)
+        self.assertEqual(robot_state.last_seen, datetime.fromtimestamp(120, timezone.utc))
+
+    def test_newest_message_of_a_batch_wins(self) -> None:
+        write_batch([
+            make_row(self.config, 'state', 130, 'run1', state='Finished'),
+            make_row(self.config, 'state', 110, 'run1', state='Running'),
+        ])
+
+        self.assertEqual(RobotState.objects.get(config=self.config).state, 'Finished')
+
+
+class RunSummaryTest(TestCase):
+    def test_batches_committed_out_of_order(self) -> None:
+        config = create_team(1)
+        write_batch([
+            make_row(config, 'state', 120, 'run1', state='Finished'),
+            make_row(config, 'logs', 115, 'run1', message='log'),
+        ])
+        write_batch([
+            make_row(config, 'state', 100, 'run1', state='Running'),
+            make_row(config, 'logs', 105, 'run1', message='log'),
+            make_row(config, 'camera/annotated', 106, 'run1', data=CAMERA_TAG),
+        ])
+        write_batch([make_row(config, 'state', 90, 'run1', state='Running')])
+
+        run = Run.objects.get(config=config, run_uuid='run1')
+        self.assertEqual(run.start, datetime.fromtimestamp(90, timezone.utc))
+        self.assertEqual(run.end, datetime.fromtimestamp(120, timezone.utc))
+        self.assertEqual(run.final_state, 'Finished')
+        self.assertEqual(run.state_at, datetime.fromtimestamp(120, timezone.utc))
+        self.assertEqual(run.log_count, 2)
+        self.assertEqual(run.image_count, 1)
+
+
+class ThinTest(TestCase):
+    def test_first_and_last_row_of_each_group_are_kept(self) -> None:
+        config = create_team(1)
+        write_batch(
+            [make_row(config, 'logs', num, 'run1', message='log') for num in range(10)]
+            + [make_row(config, 'logs', num, 'run2', message='log') for num in range(3)]
+            + [make_row(config, 'state', num, 'run1', state='Running') for num in range(3)]
+        )
+
+        rule = RetentionRule('thin', 0, 'logs', interval=5)
+        deleted = thin_rows(rule, datetime.fromtimestamp(1000, timezone.utc))
+
+        def kept(run_uuid: str, subtopic: str) -> list[float]:
+            return [
+                date.timestamp() for date in MqttData.objects
+                .filter(run_uuid=run_uuid, subtopic=subtopic)
+                .order_by('date')
+                .values_list('date', flat=True)
+            ]
+
+        self.assertEqual(deleted, 8)
+        self.assertEqual(kept('run1', 'logs'), [0, 5, 9])
+        self.assertEqual(kept('run2', 'logs'), [0, 2])
+        self.assertEqual(kept('run1', 'state'), [0, 1, 2])
+        run = Run.objects.get(config=config, run_uuid='run1')
+        self.assertEqual((run.log_count, run.thinned_log_count), (10, 7))
+
+
+class ImageCountTest(TestCase):
+    def test_counts_images_of_runs_and_without_a_run(self) -> None:
+        team1 = create_team(1)
+        team2 = create_team(2)
+        write_batch([
+            make_row(team1, 'camera/annotated', 100, 'run1', data=CAMERA_TAG),
+            make_row(team1, 'camera/annotated', 101, 'run1', data=CAMERA_TAG),
+            # Stored before the run of camera messages was kept
+            make_row(team1, 'camera/annotated', 50, data=CAMERA_TAG),
+            make_row(team2, 'camera/annotated', 50, data=CAMERA_TAG),
+        ])
+        # Images of an archived run are only counted on the run
+        Run.objects.create(config=team2, run_uuid='run2', image_count=3, archived=True)
+
+        self.assertEqual(get_image_counts(), [
+            {'name': 'Team 1', 'images': 3},
+            {'name': 'Team 2', 'images': 4},
+        ])
+
+
+class FrameStoreTest(TestCase):
+    image = b'\xff\xd8 test image'
+    data = 'data:image/jpeg;base64,' + base64.b64encode(image).decode('ascii')
+
+    def test_frame_is_stored_and_referenced(self) -> None:
+        with tempfile.TemporaryDirectory() as frame_dir, override_settings(
+            KIT_UI={**settings.KIT_UI, 'FRAME_DIR': frame_dir},
+        ):
+            payload = store_payload({'data': self.data, 'run_uuid': 'run1'})
+            self.assertEqual(payload['run_uuid'], 'run1')
+            self.assertNotIn('data', payload)
+            self.assertEqual(payload_image(payload), self.image)
+
+    def test_unwritable_frame_dir_stores_tag(self) -> None:
+        with tempfile.NamedTemporaryFile() as not_a_dir, override_settings(
+            KIT_UI={**settings.KIT_UI, 'FRAME_DIR': not_a_dir.name},
+        ), self.assertLogs('kit_web_ui.frames', 'WARNING'):
+            payload = store_payload({'data': self.data})
+        self.assertEqual(payload, {'data': CAMERA_TAG})
+
+
+class TopicRouterTest(SimpleTestCase):
+    def router(self, *topic_roots: str) -> TopicRouter:
+        return TopicRouter(
+            MqttConfig(pk=pk, topic_root=topic_root, ignored_subtopics='')
+            for pk, topic_root in enumerate(topic_roots, 1)
+        )
+
+    def route(self, router: TopicRouter, topic: str) -> tuple[str | None, str]:
+        config, subtopic = router.route(topic)
+        return (config.topic_root if config is not None else None), subtopic
+
+    def test_wildcard_roots(self) -> None:
+        router = self.router('team1', '+/robot', 'league/+')
+        self.assertEqual(self.route(router, 'team1/logs'), ('team1', 'logs'))
+        self.assertEqual(self.route(router, 'team2/robot/state'), ('+/robot', 'state'))
+        self.assertEqual(self.route(router, 'league/a/camera/raw'), ('league/+', 'camera/raw'))
+        self.assertEqual(self.route(router, 'team2/logs'), (None, 'team2/logs'))
+        # A root must be followed by a subtopic
+        self.assertEqual(self.route(router, 'league/a'), (None, 'league/a'))
+
+    def test_exact_and_longer_roots_preferred(self) -> None:
+        router = self.router('league/+', 'league/a', 'team1', 'team1/+')
+        self.assertEqual(self.route(router, 'league/a/logs'), ('league/a', 'logs'))
+        self.assertEqual(self.route(router, 'league/b/logs'), ('league/+', 'logs'))
+        self.assertEqual(self.route(router, 'team1/x/logs'), ('team1/+', 'logs'))
+        self.assertEqual(self.route(router, 'team1/logs'), ('team1', 'logs'))
+
+
+class IngestQueueTest(SimpleTestCase):
+    def test_spilled_messages_stay_in_order(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            ingest_queue = IngestQueue(
+                maxsize=2, policy='spill', spill_file=Path(directory, 'spill'))
+            for num in range(5):
+                ingest_queue.put(raw_message(num))
+            received = [ingest_queue.get(timeout=0), ingest_queue.get(timeout=0)]
+            # Queued behind the spilled messages, though the queue has room
+            ingest_queue.put(raw_message(5))
+            ingest_queue.close()
+            while (message := ingest_queue.get(timeout=0)) is not None:
+                received.append(message)
+            ingest_queue.release()
+
+        self.assertEqual(received, [raw_message(num) for num in range(6)])
+        self.assertEqual(ingest_queue.stats()['spilled'], 4)
+
+
+class SpoolTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_unacknowledged_messages_recovered_after_truncation(self) -> None:
+        test_spool = spool.Spool(self.directory)
+        messages = [test_spool.append(raw_message(num)) for num in range(3)]
+        test_spool.ack(messages[1:2])
+        test_spool.close()
+        # A record that was being written when ingest stopped
+        log = spool.log_path(self.directory, 1)
+        size = log.stat().st_size
+        with open(log, 'ab') as file:
+            file.write(spool.encode_record(raw_message(3))[:10])
+
+        with self.assertLogs('kit_web_ui.spool', 'WARNING'):
+            test_spool = spool.Spool(self.directory)
+        self.assertEqual(log.stat().st_size, size)
+        self.assertEqual(test_spool.recovered, 2)
+        replayed = test_spool.take(10)
+        self.assertEqual(
+            [message._replace(spool_position=None) for message in replayed],
+            [raw_message(0), raw_message(2)])
+        self.assertEqual(test_spool.take(10), [])
+        test_spool.ack(replayed)
+        test_spool.close()
+        self.assertEqual(spool.segment_numbers(self.directory), [])
+
+    def test_released_messages_are_replayed(self) -> None:
+        test_spool = spool.Spool(self.directory)
+        self.addCleanup(test_spool.close)
+        messages = [test_spool.append(raw_message(num)) for num in range(3)]
+        # In flight on the queue
+        self.assertEqual(test_spool.take(10), [])
+        test_spool.release([messages[2], messages[0]])
+        self.assertEqual(test_spool.take(10), [messages[0], messages[2]])
+        test_spool.release(messages[2:])
+        self.assertEqual(test_spool.take(10), messages[2:])
+        test_spool.ack(messages)
+        self.assertEqual(test_spool.pending, 0)
+
+    def test_rejected_messages_are_kept_and_acknowledged(self) -> None:
+        test_spool = spool.Spool(self.directory)
+        messages = [test_spool.append(raw_message(num)) for num in range(3)]
+        test_spool.ack(messages[:2])
+        test_spool.reject(messages[2:])
+        test_spool.close()
+
+        self.assertEqual(spool.segment_numbers(self.directory), [])
+        rejected = spool.read_records(self.directory / spool.REJECTED_NAME)
+        self.assertEqual(
+            [record.message for record in rejected], [raw_message(2)])
+
+
+def broker_settings() -> dict[str, Any]:
+    return cast('dict[str, Any]', settings.MQTT_BROKER)
+
+
+def broker_available() -> bool:
+    broker = broker_settings()
+    try:
+        socket.create_connection((broker['HOST'], broker['PORT']), timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+
+class ShardedIngestTest(TransactionTestCase):
+    """
+    Publish messages through the MQTT broker to run-ingest-shards and check
+    each is stored exactly once. Skipped when the broker can't be reached.
+    """
+
+    teams = 4
+    messages = 200
+    # Seconds for the processes to load the configs and subscribe
+    startup = 5
+    timeout = 60
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+        if not broker_available():
+            raise unittest.SkipTest("No MQTT broker at MQTT_BROKER")
+        if connection.vendor == 'sqlite' and (
+            connection.is_in_memory_db()  # type: ignore[attr-defined]
+        ):
+            raise unittest.SkipTest("run-ingest processes can't open an in-memory database")
+
+    def setUp(self) -> None:
+        # Unique topic roots, so other clients of the broker aren't received
+        prefix = uuid.uuid4().hex[:8]
+        self.topic_roots = [f"test-{prefix}-team{team}" for team in range(1, self.teams + 1)]
+        for team, topic_root in enumerate(self.topic_roots, 1):
+            MqttConfig.objects.create(
+                name=f"Team {team}", user=User.objects.create_user(topic_root),
+                username=topic_root, topic_root=topic_root, team_number=team,
+            )
+
+        # The processes load the settings themselves, so they're pointed at the test database
+        settings_dir = tempfile.mkdtemp()
+        Path(settings_dir, 'sharded_ingest_settings.py').write_text(SETTINGS_MODULE.format(
+            settings=os.environ['DJANGO_SETTINGS_MODULE'],
+            name=str(connection.settings_dict['NAME']),
+        ))
+        self.env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': 'sharded_ingest_settings',
+            'PYTHONPATH': os.pathsep.join([settings_dir, *sys.path]),
+            'INGEST_SPOOL_DIR': '',
+            'MQTT_STATUS_TOPIC': '',
+        }
+
+    def publish(self) -> None:
+        import paho.mqtt.client as mqtt
+
+        client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            protocol=mqtt.MQTTProtocolVersion.MQTTv5,
+        )
+        broker = broker_settings()
+        if broker['USERNAME']:
+            client.username_pw_set(broker['USERNAME'], broker['PASSWORD'])
+        client.connect(broker['HOST'], broker['PORT'])
+        client.loop_start()
+
+        infos = []
+        for num in range(self.messages):
+            topic_root = self.topic_roots[num % self.teams]
+            payload = {
+                'run_uuid': topic_root,
+                'timestamp': time.time(),
+                'message': f"Test Message {num}",
+                'seq': num,
+            }
+            infos.append(client.publish(f"{topic_root}/logs", json.dumps(payload), qos=1))
+        for info in infos:
+            info.wait_for_publish(timeout=self.timeout)
+            self.assertTrue(info.is_published(), "Messages weren't accepted by the broker")
+        client.loop_stop()
+        client.disconnect()
+
+    def assert_stored_once(self, mode: str) -> None:
+        # The test's connection is closed so SQLite isn't locked by it
+        connection.close()
+        supervisor = subprocess.Popen(
+            [
+                sys.executable, '-m', 'django', 'run-ingest-shards',
+                '--shards', '2', '--mode', mode, '--group', f'test-{uuid.uuid4().hex}',
+                '--metrics-port', '0', '--', '--stats-interval', '0',
+            ],
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            time.sleep(self.startup)
+            self.publish()
+            deadline = time.monotonic() + self.timeout
+            while (
+                MqttData.objects.count() < self.messages and time.monotonic() < deadline
+            ):
+                time.sleep(0.2)
+            # Any duplicate written after the last message
+            time.sleep(1)
+        finally:
+            supervisor.send_signal(signal.SIGTERM)
+            supervisor.wait(timeout=30)
+
+        seqs = sorted(MqttData.objects.values_list('payload__seq', flat=True))
+        self.assertEqual(seqs, list(range(self.messages)))
+
+    def test_hash_mode_stores_each_message_once(self) -> None:
+        self.assert_stored_once('hash')
+
+    def test_shared_mode_stores_each_message_once(self) -> None:
+        self.assert_stored_once('shared')
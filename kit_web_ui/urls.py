@@ -34,4 +34,5 @@ urlpatterns = [
     path("recall/<str:run_uuid>", views.recall, name="recall"),
     path("logs/<str:run_uuid>", views.get_run_logs, name="run_logs"),
     path("run_bundle/<str:run_uuid>", views.generate_run_bundle, name="run_bundle"),
+    path("frame/<str:run_uuid>/<str:digest>", views.view_frame, name="frame"),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
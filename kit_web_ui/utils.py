@@ -1,15 +1,19 @@
 from __future__ import annotations
 
+import zipfile
 from collections import defaultdict
-from datetime import datetime
+from datetime import date, datetime
+from itertools import islice
 from pathlib import Path
 from secrets import choice
 from string import ascii_letters, digits
-from typing import Any
+from typing import Any, Iterable, Iterator, cast
 
-from django.db.models import Min, F, OuterRef, Subquery, Count
+from django.db.models import Count, F, Q, QuerySet, Sum
+from django.db.models.functions import TruncDate
 
-from kit_web_ui.models import MqttData
+from kit_web_ui.archive import get_run_archive
+from kit_web_ui.models import MqttConfig, MqttData, Run
 
 
 def generate_wordlist(word_file: str | Path) -> list[str]:
@@ -30,76 +34,420 @@ def generate_password(wordlist: list[str] | None = None) -> str:
         return ''.join(choice(ascii_letters + digits) for _ in range(12))
 
 
+def get_team_list() -> list[dict[str, Any]]:
+    configs = MqttConfig.objects.all().select_related('broker__broker').annotate(
+        login=F('user__username'),
+        last_login=F('user__last_login'),
+        last_seen=F('robot_state__last_seen'),
+    )
+
+    return [
+        {
+            'name': config.name,
+            'username': config.login,
+            'last_login': config.last_login,
+            'last_seen': config.last_seen,
+            'broker': config.broker,
+        }
+        for config in configs
+    ]
+
+
 def get_run_data(
     user: str | None = None,
-    order_by: str = 'date',
+    order_by: str = 'start',
 ) -> dict[str, list[tuple[str, datetime]]]:
+    # Runs are summarised by run-ingest, only runs that started are listed
+    run_data = Run.objects.filter(start__isnull=False)
     if user is not None:
-        base_query = MqttData.objects.filter(config__user__username=user)
-    else:
-        base_query = MqttData.objects
-
-    run_data = (
-        base_query
-        .filter(subtopic='state', payload__state__exact='Running')
-        .values(
-            'run_uuid',
-            team_name=F('config__name'),
-        )
-        .order_by(order_by)
-        .annotate(start=Min('date'))
-    )
+        run_data = run_data.filter(config__user__username=user)
 
-    runs = defaultdict(list)
+    runs: defaultdict[str, list[tuple[str, datetime]]] = defaultdict(list)
 
-    for run_val in run_data:
-        runs[run_val['team_name']].append((run_val['run_uuid'], run_val['start']))
+    for team_name, run_uuid, start in (
+        run_data
+        .order_by(order_by, 'start')
+        .values_list('config__name', 'run_uuid', 'start')
+    ):
+        runs[team_name].append((run_uuid, cast(datetime, start)))
 
     return dict(runs)
 
 
-def get_image_counts() -> list[dict[str, int]]:
-    return list(
-        MqttData.objects
-        .filter(subtopic='camera/annotated')
-        .values(name=F('config__name'))
-        .annotate(images=Count('pk'))
-        .order_by('config__team_number')
+def get_runs_per_day(
+    first_day: date | None = None,
+    last_day: date | None = None,
+) -> tuple[list[date], dict[str, dict[date | str, int]]]:
+    """
+    Count the runs each team started on each day between `first_day` and `last_day`.
+
+    Returns the sorted days with runs, and for each team with runs the count for
+    every one of those days in order, followed by the total under 'total'.
+    Days are in the current timezone.
+    """
+    run_data = Run.objects.filter(start__isnull=False)
+    if first_day is not None:
+        run_data = run_data.filter(start__date__gte=first_day)
+    if last_day is not None:
+        run_data = run_data.filter(start__date__lte=last_day)
+
+    day_counts = (
+        run_data
+        .annotate(day=TruncDate('start'))
+        .values_list('config__name', 'day')
+        .annotate(runs=Count('pk'))
+        .order_by('config__team_number', 'config__name', 'day')
     )
 
+    counts: defaultdict[str, dict[date, int]] = defaultdict(dict)
+    days = set()
+    for team_name, day, runs in day_counts:
+        counts[team_name][day] = runs
+        days.add(day)
+
+    sorted_days = sorted(days)
+    runs_per_day: dict[str, dict[date | str, int]] = {}
+    for team_name, team_counts in counts.items():
+        team_row: dict[date | str, int] = {day: team_counts.get(day, 0) for day in sorted_days}
+        team_row['total'] = sum(team_counts.values())
+        runs_per_day[team_name] = team_row
+
+    return sorted_days, runs_per_day
 
-def get_robot_state() -> dict[str, str]:
-    newest_state = MqttData.objects.filter(config=OuterRef("id"), subtopic='state')
-    newest_connected = MqttData.objects.filter(config=OuterRef("id"), subtopic='connected')
 
-    state_data = (
+def get_image_counts() -> list[dict[str, Any]]:
+    # Images of runs are counted from the run summaries, which are unaffected by
+    # archiving or thinning. Images without a run, such as every image stored
+    # before run-ingest kept the run of camera messages, are counted as rows.
+    run_images = (
+        Run.objects
+        .filter(image_count__gt=0)
+        .values_list('config__team_number', 'config__name')
+        .annotate(images=Sum('image_count'))
+        .order_by()
+    )
+    other_images = (
         MqttData.objects
-        .annotate(
-            latest_state=Subquery(newest_state.values("payload__state")[:1]),
-            latest_connected=Subquery(newest_connected.values("payload__state")[:1]),
-        )
-        .order_by('config__team_number')
-        .values('latest_state', 'latest_connected', name=F('config__name'))
+        .filter(subtopic='camera/annotated', run_uuid='', config__isnull=False)
+        .values_list('config__team_number', 'config__name')
+        .annotate(images=Count('pk'))
+        .order_by()
     )
 
-    states = {}
-    for entry in state_data:
-        if entry['latest_connected'] is None or entry['latest_connected'] == 'disconnected':
-            states[entry['name']] = 'Disconnected'
+    counts: defaultdict[tuple[int, str], int] = defaultdict(int)
+    for team_number, name, images in [*run_images, *other_images]:
+        counts[(team_number, name)] += images
+    return [
+        {'name': name, 'images': images}
+        for (_, name), images in sorted(counts.items())
+    ]
+
+
+def iter_robot_states(
+    config_ids: Iterable[int] | None = None,
+) -> Iterator[tuple[int, str, str]]:
+    """Yield the config id, team name and displayed robot state of each team."""
+    # RobotState is maintained by run-ingest, teams without one have never connected
+    state_data = MqttConfig.objects.order_by('team_number')
+    if config_ids is not None:
+        state_data = state_data.filter(pk__in=config_ids)
+
+    for pk, name, latest_state, connected in state_data.values_list(
+        'pk', 'name', 'robot_state__state', 'robot_state__connected',
+    ):
+        if not connected:
+            yield pk, name, 'Disconnected'
         else:
-            states[entry['name']] = entry['latest_state']
+            yield pk, name, latest_state
+
 
-    return states
+def get_robot_state() -> dict[str, str]:
+    return {name: state for _, name, state in iter_robot_states()}
 
 
-def get_logs(user: str, run_uuid: str, end_filter: str | None = None) -> list[dict[str, Any]]:
+def get_logs_query(
+    user: str,
+    run_uuid: str,
+    end_filter: str | None = None,
+) -> QuerySet[MqttData]:
     query = MqttData.objects.filter(
         subtopic='logs',
         run_uuid=run_uuid,
         config__user__username=user,
-    ).values_list('payload', flat=True)
+    )
 
     if end_filter:
         query = query.filter(date__lte=end_filter)
 
-    return list(query)
+    return query
+
+
+def get_logs(user: str, run_uuid: str, end_filter: str | None = None) -> list[dict[str, Any]]:
+    logs = list(get_logs_query(user, run_uuid, end_filter).values_list('payload', flat=True))
+    if not logs:
+        # The run may have been archived
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            # Newest first, as with the model's default ordering
+            logs = [row.payload for row in archive.rows('logs', end_filter)][::-1]
+    return logs
+
+
+def parse_log_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Parse a cursor of the form `<ISO date>,<id>` as generated by format_log_cursor.
+
+    Raises ValueError if the cursor is invalid.
+    """
+    date_str, _, id_str = cursor.partition(',')
+    # A '+' in an unencoded query string is decoded as a space
+    date = datetime.fromisoformat(date_str.strip().replace(' ', '+'))
+    if date.tzinfo is None:
+        raise ValueError("Cursor date must include a timezone")
+    return date, int(id_str)
+
+
+def format_log_cursor(date: datetime, row_id: int) -> str:
+    return f"{date.isoformat()},{row_id}"
+
+
+def get_logs_page(
+    user: str,
+    run_uuid: str,
+    after: tuple[datetime, int] | None = None,
+    limit: int = 1000,
+    end_filter: str | None = None,
+) -> tuple[list[dict[str, Any]], str | None, bool]:
+    """
+    Fetch up to `limit` log lines of a run, oldest first, after the `after` cursor.
+
+    Returns the log payloads, the cursor of the last line returned (or the
+    `after` cursor if there were no new lines) and whether more lines are
+    available.
+    """
+    query = get_logs_query(user, run_uuid, end_filter).order_by('date', 'id')
+
+    if after is not None:
+        after_date, after_id = after
+        # The date__gte bound lets the index on (config, run_uuid, subtopic, date, id)
+        # limit the range scanned
+        query = query.filter(date__gte=after_date).filter(
+            Q(date__gt=after_date) | Q(date=after_date, id__gt=after_id))
+
+    rows = list(query.values_list('id', 'date', 'payload')[:limit + 1])
+    if not rows:
+        # The run may have been archived, archived rows keep their ids and dates
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            archived_rows = (
+                (row.id, row.date, row.payload)
+                for row in archive.rows('logs', end_filter)
+                if after is None or (row.date, row.id) > after
+            )
+            rows = list(islice(archived_rows, limit + 1))
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if rows:
+        last_id, last_date, _ = rows[-1]
+        next_cursor: str | None = format_log_cursor(last_date, last_id)
+    elif after is not None:
+        next_cursor = format_log_cursor(*after)
+    else:
+        next_cursor = None
+
+    return [payload for _, _, payload in rows], next_cursor, has_more
+
+
+def iter_log_messages(
+    user: str,
+    run_uuid: str,
+    end_filter: str | None = None,
+    chunk_size: int = 2000,
+) -> Iterator[str]:
+    """
+    Yield the message of each log line of a run.
+
+    Only the message is read from the database, in chunks of `chunk_size`
+    rows using a server-side cursor where the database supports it. The
+    messages are decoded from JSON, so any that aren't strings are converted.
+    """
+    messages = (
+        get_logs_query(user, run_uuid, end_filter)
+        .values_list('payload__message', flat=True)
+        .iterator(chunk_size=chunk_size)
+    )
+    found = False
+    for message in messages:
+        found = True
+        yield _log_text(message)
+
+    if not found:
+        # The run may have been archived
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            # Newest first, as with the model's default ordering
+            for row in list(archive.rows('logs', end_filter))[::-1]:
+                yield _log_text(row.payload.get('message'))
+
+
+def _log_text(message: Any) -> str:
+    """Return a log message as text, such as a number or boolean in the payload."""
+    if message is None:
+        return ''
+    return message if isinstance(message, str) else str(message)
+
+
+def get_latest_camera(user: str, run_uuid: str) -> dict[str, Any] | None:
+    """Return the payload of the newest camera image of a run."""
+    camera = (
+        MqttData.objects
+        .filter(subtopic='camera/annotated', run_uuid=run_uuid, config__user__username=user)
+        .values_list('payload', flat=True)
+        .order_by('-date')
+        .first()
+    )
+    if camera is None:
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            for row in archive.rows('camera/annotated'):
+                camera = row.payload
+    return camera
+
+
+def get_run_log_date(user: str, run_uuid: str) -> datetime | None:
+    """Return the date of the first state message of a run, used to name downloads."""
+    log_date = (
+        MqttData.objects
+        .filter(subtopic='state', run_uuid=run_uuid, config__user__username=user)
+        .values_list('date', flat=True)
+        .order_by('date')
+        .first()
+    )
+    if log_date is None:
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            log_date = next((row.date for row in archive.rows('state')), None)
+    return log_date
+
+
+def iter_run_images(user: str, run_uuid: str) -> Iterator[tuple[datetime, dict[str, Any]]]:
+    """
+    Yield the date and payload of each camera image of a run.
+
+    The image of each payload is read with frames.payload_image.
+    """
+    # Only fetch the payload rather than the whole row
+    image_data = (
+        MqttData.objects
+        .filter(subtopic='camera/annotated', run_uuid=run_uuid, config__user__username=user)
+        .values_list('date', 'payload')
+        .iterator(chunk_size=20)
+    )
+    found = False
+    for img_date, payload in image_data:
+        found = True
+        yield img_date, payload
+
+    if not found:
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            for row in archive.rows('camera/annotated'):
+                yield row.date, row.payload
+
+
+def get_run_frame(user: str, run_uuid: str, digest: str) -> dict[str, Any] | None:
+    """Return the payload referencing a stored frame if it is in a user's run."""
+    payload = (
+        MqttData.objects
+        .filter(
+            subtopic__startswith='camera',
+            run_uuid=run_uuid,
+            config__user__username=user,
+            payload__frame=digest,
+        )
+        .values_list('payload', flat=True)
+        .first()
+    )
+    if payload is None:
+        archive = get_run_archive(user, run_uuid)
+        if archive is not None:
+            for row in archive.rows():
+                if row.subtopic.startswith('camera') and row.payload.get('frame') == digest:
+                    return row.payload  # type: ignore[no-any-return]
+    return payload
+
+
+def stream_lines(lines: Iterable[str], chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Join lines with newlines, yielding the encoded text in chunks of about `chunk_size`."""
+    chunk: list[str] = []
+    pending = 0
+    for num, line in enumerate(lines):
+        chunk.append(line if num == 0 else f"\n{line}")
+        pending += len(line)
+        if pending >= chunk_size:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+            pending = 0
+
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+class ZipStream:
+    """
+    A write-only file object for zipfile to write an archive into.
+
+    zipfile uses data descriptors when the output isn't seekable, so the
+    archive can be sent in pieces as each entry is written.
+    """
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        """Remove and return everything written since the last call."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(
+    text_files: Iterable[tuple[str, Iterable[str]]],
+    files: Iterable[tuple[str, bytes]],
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """
+    Generate a zip archive in chunks, holding at most one entry in memory.
+
+    `text_files` is an iterable of file names and the lines to write to them,
+    these are compressed. `files` is an iterable of file names and their
+    contents, these are stored uncompressed as they are expected to be
+    already compressed, i.e. JPEGs.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED, False) as output_file:
+        for name, lines in text_files:
+            with output_file.open(name, "w") as entry:
+                for data in stream_lines(lines, chunk_size):
+                    entry.write(data)
+                    yield stream.take()
+            yield stream.take()
+
+        for name, content in files:
+            output_file.writestr(name, content, compress_type=zipfile.ZIP_STORED)
+            yield stream.take()
+
+    # The central directory is written when the archive is closed
+    yield stream.take()
@@ -1,28 +1,38 @@
 from __future__ import annotations
 
-import base64
-import zipfile
-from collections import defaultdict, Counter
-from datetime import datetime, timezone
-from io import BytesIO
-from typing import cast
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Iterator, cast
+from urllib.parse import urlencode
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import F
 from django.http import (
-    HttpRequest, HttpResponse, HttpResponsePermanentRedirect,
-    HttpResponseRedirect, JsonResponse, FileResponse
+    FileResponse, Http404, HttpRequest, HttpResponse,
+    HttpResponseBadRequest, HttpResponsePermanentRedirect,
+    HttpResponseRedirect, JsonResponse, StreamingHttpResponse,
 )
 from django.shortcuts import redirect, render, resolve_url
-
-from .models import MqttConfig, MqttData
-from .utils import get_logs, get_robot_state, get_run_data, get_image_counts
+from django.urls import reverse
+from django.utils.timezone import localdate
+
+from . import cache
+from .frames import frame_path, payload_image
+from .models import MqttConfig
+from .utils import (
+    get_image_counts, get_latest_camera, get_logs, get_logs_page,
+    get_robot_state, get_run_data, get_run_frame, get_run_log_date,
+    get_runs_per_day, get_team_list, iter_log_messages,
+    iter_run_images, parse_log_cursor, stream_lines, stream_zip,
+)
 
 HttpRedirect = HttpResponseRedirect | HttpResponsePermanentRedirect
 
+RECALL_DEFAULT_LIMIT = 1000
+RECALL_MAX_LIMIT = 5000
+RUN_SUMMARY_DEFAULT_DAYS = 28
+
 
 def login_required_json(view_func):
     def wrapped_view(request, *args, **kwargs):
@@ -36,27 +46,12 @@ def login_required_json(view_func):
 @login_required
 def index(request: HttpRequest) -> HttpResponse | HttpRedirect:
     if request.user.is_staff:
-        configs = MqttConfig.objects.all().annotate(
-            login=F('user__username'),
-            last_login=F('user__last_login'),
-        )
-
-        configs_list = [
-            {
-                'name': config.name,
-                'username': config.login,
-                'last_login': config.last_login,
-                'broker': config.broker,
-            }
-            for config in configs
-        ]
-
         return render(
             request,
             "team_select.html",
             {
                 "now": datetime.now(timezone.utc),
-                "teams": configs_list,
+                "teams": cache.cached(cache.TEAMS, 'team_list', get_team_list),
             },
         )
     else:
@@ -90,10 +85,21 @@ def config(request: HttpRequest) -> JsonResponse:
 @login_required
 @staff_member_required
 def view_status(request: HttpRequest) -> HttpResponse:
-    states = get_robot_state()
+    states = cache.cached(cache.ROBOT_STATE, 'states', get_robot_state)
 
     configs = MqttConfig.objects.all().values_list('name', flat=True)
 
+    # Without a websocket URL the page falls back to polling status.json
+    feed = settings.MQTT_STATUS_FEED
+    status_feed = None
+    if feed['URL'] and feed['TOPIC']:
+        status_feed = {
+            "url": feed['URL'],
+            "username": feed['USERNAME'],
+            "password": feed['PASSWORD'],
+            "topic": f"{feed['TOPIC'].rstrip('/')}/+",
+        }
+
     return render(
         request,
         "status.html",
@@ -101,6 +107,8 @@ def view_status(request: HttpRequest) -> HttpResponse:
             "now": datetime.now(timezone.utc),
             "states": states,
             "configs": configs,
+            "status_feed": status_feed,
+            "status_feed_integrity": feed['SCRIPT_INTEGRITY'],
         }
     )
 
@@ -108,7 +116,7 @@ def view_status(request: HttpRequest) -> HttpResponse:
 @login_required_json
 @staff_member_required
 def view_status_json(request: HttpRequest) -> JsonResponse:
-    states = get_robot_state()
+    states = cache.cached(cache.ROBOT_STATE, 'states', get_robot_state)
 
     return JsonResponse({"states": states})
 
@@ -143,31 +151,39 @@ def view_runs(request: HttpRequest, user: str) -> HttpResponse:
 @login_required
 @staff_member_required
 def run_summary(request: HttpRequest) -> HttpResponse:
-    run_data = get_run_data(order_by='config__team_number')
-
-    runs_per_day = defaultdict(lambda: defaultdict(int))
-    days = set()
-
-    runs_per_day = {
-        team_name: Counter(x[1].date() for x in runs)
-        for team_name, runs in run_data.items()
-    }
-    days = set(
-        day
-        for team_days in runs_per_day.values()
-        for day in team_days
+    try:
+        last_day = (
+            date.fromisoformat(request.GET['to']) if request.GET.get('to')
+            else localdate()
+        )
+        first_day = (
+            date.fromisoformat(request.GET['from']) if request.GET.get('from')
+            else last_day - timedelta(days=RUN_SUMMARY_DEFAULT_DAYS - 1)
+        )
+    except ValueError:
+        return HttpResponseBadRequest("Invalid date, dates must be YYYY-MM-DD")
+    except OverflowError:
+        return HttpResponseBadRequest("Date out of range")
+    if first_day > last_day:
+        return HttpResponseBadRequest("The from date must not be after the to date")
+
+    days, runs_per_day = cache.cached(
+        cache.RUNS,
+        f'runs_per_day:{first_day}:{last_day}',
+        lambda: get_runs_per_day(first_day, last_day),
     )
 
-    # Make every day have an entry for every team
-    for team_name in run_data.keys():
-        for day in days:
-            runs_per_day[team_name].setdefault(day, 0)
-
-        # Sort the days
-        runs_per_day[team_name] = dict(sorted(runs_per_day[team_name].items()))
-
-        # Total the runs
-        runs_per_day[team_name]['total'] = sum(runs_per_day[team_name].values())
+    # The same length range immediately before and after this one, if within
+    # the dates that can be represented
+    range_length = last_day - first_day + timedelta(days=1)
+    try:
+        previous_range = (first_day - range_length, first_day - timedelta(days=1))
+    except OverflowError:
+        previous_range = None
+    try:
+        next_range = (last_day + timedelta(days=1), last_day + range_length)
+    except OverflowError:
+        next_range = None
 
     return render(
         request,
@@ -175,107 +191,156 @@ def run_summary(request: HttpRequest) -> HttpResponse:
         {
             "now": datetime.now(timezone.utc),
             "runs_by_day": runs_per_day,
-            "images": get_image_counts(),
-            "days": sorted(days),
+            "images": cache.cached(cache.RUNS, 'image_counts', get_image_counts),
+            "days": days,
+            "first_day": first_day,
+            "last_day": last_day,
+            "previous_range": previous_range,
+            "next_range": next_range,
         }
     )
 
 
+def get_camera(request: HttpRequest, user: str, run_uuid: str) -> dict[str, Any] | None:
+    """Return the latest camera payload of a run, with the URL of its stored frame."""
+    camera = get_latest_camera(user, run_uuid)
+    if camera is not None and camera.get('frame'):
+        url = reverse('frame', args=[run_uuid, camera['frame']])
+        if user != request.user.username:
+            url += '?' + urlencode({'user': user})
+        camera = {**camera, 'url': url}
+    return camera
+
+
 @login_required_json
 def recall(request: HttpRequest, run_uuid: str) -> JsonResponse:
+    """
+    Return the logs and latest camera image of a run.
+
+    If `after` or `limit` are given, only up to `limit` logs after the `after`
+    cursor are returned, oldest first, along with `next_cursor` to pass as
+    `after` on the next request to fetch only newer logs.
+
+    A camera image kept in the frame store is referenced by its `url`, older
+    images are included as a data URL in `data`.
+    """
     if request.user.is_staff and request.GET.get("user"):
         user = request.GET['user']
     else:
         user = request.user.username
 
-    logs = get_logs(user, run_uuid=run_uuid, end_filter=request.GET.get("end_time"))
+    if "after" not in request.GET and "limit" not in request.GET:
+        logs = get_logs(user, run_uuid=run_uuid, end_filter=request.GET.get("end_time"))
+
+        return JsonResponse({
+            "logs": logs,
+            "camera": get_camera(request, user, run_uuid),
+        })
+
+    try:
+        after = parse_log_cursor(request.GET["after"]) if request.GET.get("after") else None
+        limit = int(request.GET.get("limit", RECALL_DEFAULT_LIMIT))
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor or limit"}, status=400)
+    limit = min(max(limit, 1), RECALL_MAX_LIMIT)
+
+    logs, next_cursor, has_more = get_logs_page(
+        user,
+        run_uuid=run_uuid,
+        after=after,
+        limit=limit,
+        end_filter=request.GET.get("end_time"),
+    )
 
     return JsonResponse({
         "logs": logs,
-        "camera": MqttData.objects.filter(
-            subtopic='camera/annotated',
-            run_uuid=run_uuid,
-            config__user__username=user,
-        ).values_list('payload', flat=True).latest()
+        "camera": get_camera(request, user, run_uuid),
+        "next_cursor": next_cursor,
+        "has_more": has_more,
     })
 
 
 @login_required
-def get_run_logs(request: HttpRequest, run_uuid: str) -> HttpResponse:
+def get_run_logs(request: HttpRequest, run_uuid: str) -> StreamingHttpResponse:
     if request.user.is_staff and request.GET.get("user"):
         user = request.GET['user']
     else:
         user = request.user.username
 
-    logs = get_logs(user, run_uuid=run_uuid, end_filter=request.GET.get("end_time"))
-    log_lines = [
-        log['message']
-        for log in logs
-    ]
-
-    base_query = MqttData.objects.filter(run_uuid=run_uuid, config__user__username=user)
-
-    log_date = (
-        base_query
-        .filter(subtopic='state')
-        .values_list('date', flat=True)
-        .last()
-    )
+    log_date = get_run_log_date(user, run_uuid)
     if log_date:
         filename = f"log-{log_date:%Y-%m-%dT%H-%M-%S}.txt"
     else:
         filename = "log.txt"
 
-    response = HttpResponse('\n'.join(log_lines), content_type='text/plain')
+    # Log lines are read from the database as the response is sent
+    log_lines = iter_log_messages(
+        user, run_uuid=run_uuid, end_filter=request.GET.get("end_time"))
+
+    response = StreamingHttpResponse(stream_lines(log_lines), content_type='text/plain')
     response['Content-Disposition'] = f'attachment; filename={filename}'
     return response
 
 
 @login_required
-def generate_run_bundle(request: HttpRequest, run_uuid: str) -> FileResponse:
+def generate_run_bundle(request: HttpRequest, run_uuid: str) -> StreamingHttpResponse:
     # zip file with log.txt and jpgs
     if request.user.is_staff and request.GET.get("user"):
         user = request.GET['user']
     else:
         user = request.user.username
 
-    base_query = MqttData.objects.filter(run_uuid=run_uuid, config__user__username=user)
-
-    # create log.txt
-    logs = get_logs(user, run_uuid=run_uuid, end_filter=request.GET.get("end_time"))
-    log_lines = [log['message'] for log in logs]
-
-    log_date = (
-        base_query
-        .filter(subtopic='state')
-        .values_list('date', flat=True)
-        .last()
-    )
+    log_date = get_run_log_date(user, run_uuid)
     if log_date:
         filename = f"logs-{user}-{log_date:%Y-%m-%dT%H-%M-%S}.zip"
     else:
         filename = f"logs-{user}.txt"
 
-    byte_data = BytesIO()
-    with zipfile.ZipFile(byte_data, "w", zipfile.ZIP_DEFLATED, False) as output_file:
-        # write the log to the zip
-        output_file.writestr('log.txt', '\n'.join(log_lines))
+    # log.txt and the images are read from the database, or the run's archive
+    # file, as the zip file is sent
+    log_lines = iter_log_messages(
+        user, run_uuid=run_uuid, end_filter=request.GET.get("end_time"))
 
-        # Save all images as jpegs
-        for img in base_query.filter(subtopic='camera/annotated'):
-            # Remove the data:image/jpeg;base64, prefix
-            img_txt = img.payload['data'].split()[-1]
+    def images() -> Iterator[tuple[str, bytes]]:
+        for img_date, payload in iter_run_images(user, run_uuid):
+            # Read from the frame store, or decoded from older payloads
+            img_data = payload_image(payload)
+            if img_data is None:
+                continue
 
-            img_data = base64.b64decode(img_txt)
+            yield f'img-{img_date:%Y-%m-%dT%H-%M-%S}-.jpg', img_data
 
-            output_file.writestr(f'img-{img.date:%Y-%m-%dT%H-%M-%S}-.jpg', img_data)
+    response = StreamingHttpResponse(
+        stream_zip([('log.txt', log_lines)], images()),
+        content_type='application/zip',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
-    # If you don't return the buffer to the start, nothing will appear in the response
-    byte_data.seek(0)
 
-    return FileResponse(
-        byte_data,
-        content_type='application/zip',
-        as_attachment=True,
-        filename=filename
-    )
\ No newline at end of file
+@login_required
+def view_frame(request: HttpRequest, run_uuid: str, digest: str) -> FileResponse:
+    """
+    Return a stored camera frame of a run.
+
+    The file is passed to the WSGI server to send, which uwsgi does with
+    sendfile rather than copying it through Python.
+    """
+    if request.user.is_staff and request.GET.get("user"):
+        user = request.GET['user']
+    else:
+        user = request.user.username
+
+    payload = get_run_frame(user, run_uuid, digest)
+    if payload is None:
+        raise Http404("Frame not found")
+
+    try:
+        frame_file = open(frame_path(digest), 'rb')
+    except (OSError, ValueError):
+        raise Http404("Frame not found")
+
+    response = FileResponse(frame_file, content_type=payload.get('content_type', 'image/jpeg'))
+    # Frames are content addressed so never change
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response